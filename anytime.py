@@ -0,0 +1,238 @@
+import logging
+import time
+
+from compact import CompactSolution
+from deltasearch import DeltaLocalSearchSolver
+from greedy import GreedySolver
+from grasp import iteration_rng
+from models import Infeasible
+import events
+import instrumentation
+
+logger = logging.getLogger(__name__)
+
+# Why an anytime run stopped
+FINISHED = "finished"
+DEADLINE = "deadline"
+TARGET = "target"
+CANCELLED = "cancelled"
+
+
+class Progress:
+    # What the progress callback gets on every new best solution
+    def __init__(self, solution, origin, elapsed):
+        self.solution = solution
+        self.cost = solution.cost
+        self.origin = origin
+        self.elapsed = elapsed
+
+
+class Incumbent:
+    # Best feasible solution of an anytime run. Solutions with violations
+    # (see Solution.violations) are never kept. Times are seconds from
+    # start.
+    def __init__(self, d_center, target_cost=None, callback=None,
+                 start=None, verbose=True):
+        self.d_center = d_center
+        self.verbose = verbose
+        self.target_cost = target_cost
+        self.callback = callback
+        self.start = time.time() if start is None else start
+        self.solution = None
+        self.origin = None
+        self.time_to_best = None
+        self.time_to_target = None
+        self.rejected = 0
+
+    @property
+    def cost(self):
+        return None if self.solution is None else self.solution.cost
+
+    def reached(self):
+        return self.target_cost is not None and self.solution is not None \
+            and self.solution.cost <= self.target_cost
+
+    def offer(self, solution, origin):
+        # Returns True if solution is the new best
+        if solution is None:
+            return False
+        if self.solution is not None and solution.cost >= self.solution.cost:
+            return False
+        violations = solution.violations(self.d_center)
+        if violations:
+            self.rejected += 1
+            if self.verbose:
+                logger.info("Rejected a solution of cost %s from %s with %s "
+                            "violations", solution.cost, origin,
+                            len(violations))
+            return False
+
+        elapsed = time.time() - self.start
+        self.solution = solution
+        self.origin = origin
+        self.time_to_best = elapsed
+        if self.time_to_target is None and self.reached():
+            self.time_to_target = elapsed
+        if self.verbose:
+            logger.info("New best solution from %s after %.3fs, cost %s",
+                        origin, elapsed, solution.cost)
+        if events.ENABLED:
+            events.emit("incumbent", origin=origin, elapsed=elapsed,
+                        cost=solution.cost)
+        if self.callback is not None:
+            self.callback(Progress(solution, origin, elapsed))
+        return True
+
+
+class AnytimeSolver:
+    # Common interface for running the solvers under a deadline (a
+    # time.time() value). Whenever it stops, the result is the best feasible
+    # solution found so far, with the time it took to find it and, given a
+    # target cost, to reach the target. callback is called with a Progress
+    # on every new best solution.
+    #
+    # Stages, each one only while there is time left and the target is not
+    # reached:
+    #   greedy         the construction of greedy (GreedySolver or
+    #                  RegretGreedySolver)
+    #   local search   the delta local search (strategy ls) of the greedy
+    #                  solution, interrupted at the deadline
+    #   grasp          if grasp (a GRASPSolver or ReactiveGRASPSolver, run
+    #                  serially) is given, its iterations, every one
+    #                  improved with the local search, until its iteration
+    #                  count, stall limit or the deadline
+    # A greedy or GRASP construction is never interrupted, so a run can end
+    # up to one construction after the deadline. ls None skips the local
+    # search moves; the constructions still get the cheapest type that
+    # serves the cities of every center, which repairs the types the greedy
+    # leaves too small. cancelled, a function, stops the run when it returns
+    # True.
+    def __init__(self, solution, d_center, deadline=None, target_cost=None,
+                 callback=None, grasp=None, ls="first", batch=True,
+                 verbose=True, greedy=GreedySolver, cancelled=None):
+        self.solution = solution
+        self.problem = solution.problem
+        self.d_center = d_center
+        self.deadline = deadline
+        self.target_cost = target_cost
+        self.callback = callback
+        self.grasp = grasp
+        self.ls = ls
+        self.batch = batch
+        self.verbose = verbose
+        self.greedy = greedy
+        self.cancelled = cancelled
+        # Filled by solve
+        self.incumbent = None
+        self.status = None
+
+    def expired(self):
+        return self.deadline is not None and time.time() >= self.deadline
+
+    def stop(self):
+        # Sets the status if the run must stop
+        if self.incumbent.reached():
+            self.status = TARGET
+        elif self.expired():
+            self.status = DEADLINE
+        elif self.cancelled is not None and self.cancelled():
+            self.status = CANCELLED
+        return self.status is not None
+
+    def local_search(self, solution):
+        if self.ls is None:
+            # Only the retyping of the centers
+            ls = DeltaLocalSearchSolver(solution, self.d_center,
+                                        verbose=False, max_moves=0)
+        else:
+            ls = DeltaLocalSearchSolver(solution, self.d_center,
+                                        strategy=self.ls, verbose=False,
+                                        deadline=self.deadline,
+                                        stop=self.cancelled)
+        return ls.search().to_solution(self.d_center)
+
+    def solve(self):
+        self.incumbent = Incumbent(self.d_center, self.target_cost,
+                                   self.callback, verbose=self.verbose)
+        self.status = None
+        incumbent = self.incumbent
+
+        with instrumentation.timer("anytime greedy"):
+            # The greedy modifies the solution it is given
+            initial = CompactSolution.from_solution(self.solution)
+            try:
+                greedy = self.greedy(initial.to_solution(self.d_center),
+                                     self.d_center,
+                                     batch=self.batch).solve()
+            except Infeasible:
+                greedy = None
+        incumbent.offer(greedy, "greedy")
+        if greedy is not None and not self.stop():
+            with instrumentation.timer("anytime local search"):
+                incumbent.offer(self.local_search(greedy), "local search")
+        if self.grasp is not None and not self.stop():
+            with instrumentation.timer("anytime grasp"):
+                self.run_grasp()
+        if self.status is None:
+            self.stop()
+        if self.status is None:
+            self.status = FINISHED
+
+        if self.verbose:
+            logger.info("Anytime run stopped (%s) after %.3fs, best cost %s",
+                        self.status, time.time() - incumbent.start,
+                        incumbent.cost)
+        return incumbent.solution
+
+    def run_grasp(self):
+        grasp = self.grasp
+        deadline = grasp.deadline()
+        stalled = 0
+        for iter_idx in grasp.iteration_indices():
+            if self.stop():
+                break
+            if deadline is not None and time.time() >= deadline:
+                break
+            if grasp.stall is not None and stalled >= grasp.stall:
+                break
+            alpha = grasp.alpha_for(iter_idx)
+            with instrumentation.timer("grasp construction"):
+                solution = grasp.construct(alpha,
+                                           iteration_rng(grasp.seed, iter_idx))
+            grasp.record(alpha, solution)
+            if events.ENABLED:
+                events.emit("iteration", iteration=iter_idx, alpha=alpha,
+                            cost=None if solution is None else solution.cost)
+            stalled += 1
+            if solution is None:
+                # The construction boxed a city in (construct never raises),
+                # the incumbent stays
+                continue
+            if self.incumbent.offer(solution, f"grasp iteration {iter_idx}"):
+                stalled = 0
+            if self.expired():
+                continue
+            with instrumentation.timer("grasp local search"):
+                solution = self.local_search(solution)
+            if self.incumbent.offer(
+                    solution, f"grasp iteration {iter_idx} + local search"):
+                stalled = 0
+
+    def report(self):
+        incumbent = self.incumbent
+        lines = [f"Stopped by: {self.status}"]
+        if incumbent.solution is None:
+            lines.append("No feasible solution found")
+        else:
+            lines.append(f"Best found by {incumbent.origin} after "
+                         f"{incumbent.time_to_best:.3f}s")
+        if self.target_cost is not None:
+            if incumbent.time_to_target is None:
+                lines.append(f"Target cost {self.target_cost:g} not reached")
+            else:
+                lines.append(f"Target cost {self.target_cost:g} reached "
+                             f"after {incumbent.time_to_target:.3f}s")
+        if incumbent.rejected:
+            lines.append(f"Rejected {incumbent.rejected} solutions with "
+                         f"violations")
+        return "\n".join(lines)
@@ -0,0 +1,248 @@
+import argparse
+import json
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+
+from models import Solution, Infeasible
+from problem import Problem
+from greedy import GreedySolver
+from grasp import GRASPSolver
+from localsearch import LocalSearchSolver
+from deltasearch import DeltaLocalSearchSolver
+from generator import generate, DISTRIBUTIONS, POPULATIONS
+import problem as problem_module
+
+ALGORITHMS = ("greedy", "greedy+ls", "grasp+ls")
+DEFAULT_SIZES = (100, 1000)
+
+# Result file format, bump when it changes
+FORMAT_VERSION = 1
+
+
+# ---- RUNS ----
+def run_once(instance, algorithm, ls, grasp_iterations, seed):
+    # One run from scratch: precomputation, construction and local search.
+    # Returns the wall time of every phase, the cost and the violations.
+    cities, centers, types, d_center = instance
+    phases = {}
+
+    start = time.perf_counter()
+    problem = Problem(cities, centers, types, d_center)
+    problem.conflicts(d_center)
+    initial = Solution(cities, centers, types, problem)
+    phases["precompute"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    try:
+        if algorithm == "grasp+ls":
+            solution = GRASPSolver(initial, d_center,
+                                   iterations=grasp_iterations, seed=seed,
+                                   verbose=False).solve()
+            phases["grasp"] = time.perf_counter() - start
+        else:
+            solution = GreedySolver(initial, d_center).solve()
+            phases["greedy"] = time.perf_counter() - start
+    except Infeasible:
+        solution = None
+    if solution is None:
+        return phases, None, ["No solution found"]
+
+    if algorithm != "greedy":
+        start = time.perf_counter()
+        if ls == "classic":
+            solution = LocalSearchSolver(solution, d_center).solve()
+        else:
+            solution = DeltaLocalSearchSolver(
+                solution, d_center, strategy=ls, verbose=False
+                ).solve()
+        phases["ls"] = time.perf_counter() - start
+
+    return phases, solution.cost, solution.violations(d_center)
+
+def peak_memory(instance, algorithm, ls, grasp_iterations, seed):
+    # Peak traced memory of a whole run, in bytes. Measured in a run of its
+    # own because tracing slows everything down.
+    tracemalloc.start()
+    try:
+        run_once(instance, algorithm, ls, grasp_iterations, seed)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak
+
+def summary(values):
+    # Median and interquartile range
+    if len(values) == 1:
+        return {"median": values[0], "iqr": 0.0}
+    q1, _, q3 = statistics.quantiles(values, n=4)
+    return {"median": statistics.median(values), "iqr": q3 - q1}
+
+def benchmark(n_cities, n_locations, algorithm, args):
+    instance = generate(n_cities, n_locations, args.types, args.distribution,
+                        args.population, seed=args.seed)
+    runs = []
+    for _ in range(args.repeat):
+        phases, cost, violations = run_once(
+            instance, algorithm, args.ls, args.grasp_iterations, args.seed
+            )
+        phases["total"] = sum(phases.values())
+        runs.append({"phases": phases, "cost": cost,
+                     "feasible": cost is not None and not violations,
+                     "violations": len(violations)})
+
+    stats = {}
+    for phase in runs[0]["phases"]:
+        stats[phase] = summary([r["phases"][phase] for r in runs
+                                if phase in r["phases"]])
+    result = {
+        "cities": n_cities,
+        "locations": len(instance[1]),
+        "algorithm": algorithm,
+        "ls": args.ls if algorithm != "greedy" else None,
+        "runs": runs,
+        "time": stats,
+        "cost": runs[0]["cost"],
+        "feasible": all(r["feasible"] for r in runs),
+        }
+    if not args.no_memory:
+        result["peak_memory"] = peak_memory(
+            instance, algorithm, args.ls, args.grasp_iterations, args.seed
+            )
+    return result
+
+
+# ---- BASELINE ----
+def key(result):
+    return (result["cities"], result["locations"], result["algorithm"],
+            result["ls"])
+
+def compare(results, baseline, tolerance):
+    # Prints the change of every median against the baseline. A phase is a
+    # regression when it is slower by more than tolerance and by more than
+    # the larger IQR of both runs. Returns the number of regressions.
+    previous = {key(r): r for r in baseline["results"]}
+    regressions = 0
+    print("----- BASELINE COMPARISON -----")
+    for result in results:
+        old = previous.get(key(result))
+        if old is None:
+            continue
+        label = f"{result['algorithm']:<10} n={result['cities']:<7}"
+        if result["cost"] != old["cost"]:
+            print(f"{label} cost changed from {old['cost']} to "
+                  f"{result['cost']}")
+        for phase, stats in result["time"].items():
+            if phase not in old["time"]:
+                continue
+            before = old["time"][phase]
+            ratio = stats["median"] / before["median"] \
+                if before["median"] > 0 else 1.0
+            slower = stats["median"] - before["median"]
+            noise = max(before["iqr"], stats["iqr"])
+            regression = ratio > 1 + tolerance and slower > noise
+            regressions += regression
+            print(f"{label} {phase:<10} {before['median']:10.4f}s -> "
+                  f"{stats['median']:10.4f}s  x{ratio:.2f}"
+                  f"{'  REGRESSION' if regression else ''}")
+    return regressions
+
+
+# ---- OUTPUT ----
+def print_result(result):
+    times = "  ".join(
+        f"{phase} {stats['median']:.4f}s±{stats['iqr']:.4f}"
+        for phase, stats in result["time"].items()
+        )
+    memory = ""
+    if "peak_memory" in result:
+        memory = f"  peak {result['peak_memory'] / 2**20:.1f}MiB"
+    print(f"{result['algorithm']:<10} n={result['cities']:<7} "
+          f"m={result['locations']:<6} cost {result['cost']} "
+          f"{'feasible' if result['feasible'] else 'INFEASIBLE'}  "
+          f"{times}{memory}")
+
+def metadata(args):
+    return {
+        "format": FORMAT_VERSION,
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "numpy": problem_module.np is not None,
+        "arguments": vars(args),
+        }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the solvers on generated instances"
+        )
+    parser.add_argument(
+        '-n', '--cities', action='store', type=int, nargs='+',
+        default=list(DEFAULT_SIZES), help="instance sizes (default 100 1000)"
+        )
+    parser.add_argument(
+        '--ratio', action='store', type=int, default=5,
+        help="cities per candidate location (default 5)"
+        )
+    parser.add_argument(
+        '-a', '--algorithms', action='store', nargs='+', choices=ALGORITHMS,
+        default=list(ALGORITHMS)
+        )
+    parser.add_argument(
+        '--ls', action='store', choices=['classic', 'first', 'best'],
+        default='classic', help="local search after the construction"
+        )
+    parser.add_argument(
+        '-r', '--repeat', action='store', type=int, default=5,
+        help="timed runs per configuration (default 5)"
+        )
+    parser.add_argument('--grasp-iterations', action='store', type=int,
+                        default=3)
+    parser.add_argument('-t', '--types', action='store', type=int, default=3)
+    parser.add_argument('--distribution', action='store',
+                        choices=DISTRIBUTIONS, default="uniform")
+    parser.add_argument('--population', action='store', choices=POPULATIONS,
+                        default="uniform")
+    parser.add_argument(
+        '--seed', action='store', type=int, default=1,
+        help="seed of the instances and of GRASP (default 1)"
+        )
+    parser.add_argument(
+        '--no-memory', action='store_true',
+        help="skip the extra traced run measuring peak memory"
+        )
+    parser.add_argument(
+        '-o', '--output', action='store', default=None,
+        help="write the results to this JSON file"
+        )
+    parser.add_argument(
+        '--baseline', action='store', default=None,
+        help="JSON results of a previous run to compare against"
+        )
+    parser.add_argument(
+        '--tolerance', action='store', type=float, default=0.1,
+        help="relative slowdown reported as a regression (default 0.1)"
+        )
+    args = parser.parse_args()
+
+    results = []
+    for n_cities in args.cities:
+        n_locations = max(1, n_cities // args.ratio)
+        for algorithm in args.algorithms:
+            result = benchmark(n_cities, n_locations, algorithm, args)
+            print_result(result)
+            results.append(result)
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump({"meta": metadata(args), "results": results}, f,
+                      indent=1)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.tolerance) > 0:
+            sys.exit(1)
@@ -0,0 +1,379 @@
+import bisect
+import logging
+import math
+import time
+
+from compact import CompactSolution
+import events
+import instrumentation
+
+logger = logging.getLogger(__name__)
+
+# Decisions of a location in a node
+UNDECIDED = -2
+CLOSED = -1
+
+
+class SearchLimit(Exception):
+    # The node or time limit was reached
+    pass
+
+
+class BranchAndBoundSolver:
+    # Exact solver for small and medium instances. Every level of the tree
+    # decides one location: closed, or open with one of the types. The
+    # search is depth first and starts from the incumbent solution (a
+    # Solution from the greedy, GRASP or local search, optional), whose
+    # decision is tried first at every level.
+    #
+    # A node is pruned when
+    #   - some city has no location left that can serve it as primary, or
+    #     no second one for its secondary center (coverage). Undecided
+    #     locations closer than d_center to an open one count as closed.
+    #   - the open capacity plus the largest capacity of the undecided
+    #     locations can not hold the total load (capacity).
+    #   - the cost of the open locations plus a bound of what is still
+    #     missing is not better than the incumbent. What is missing costs at
+    #     least the capacity deficit at the cheapest cost per unit of
+    #     capacity, and at least the cheapest type that can reach a city no
+    #     open location covers.
+    # When every location is decided, a backtracking search looks for an
+    # assignment of the cities that fits the capacities.
+    #
+    # node_limit (nodes) and time_limit (seconds) stop the search early, the
+    # best solution found is returned and the gap is against the smallest
+    # bound of the unexplored nodes, or against lower_bound if it is larger
+    # (e.g. the Lagrangian bound).
+    #
+    # upper_bound, a function returning the cost of the best solution known
+    # elsewhere (e.g. by other solvers running at the same time), also
+    # prunes the nodes that can not beat it. cancelled, a function, stops
+    # the search when it returns True.
+    def __init__(self, solution, d_center, incumbent=None, node_limit=None,
+                 time_limit=None, lower_bound=None, verbose=True,
+                 upper_bound=None, cancelled=None):
+        self.problem = solution.problem
+        self.d_center = d_center
+        self.node_limit = node_limit
+        self.time_limit = time_limit
+        self.external_bound = lower_bound
+        self.verbose = verbose
+        self.upper_bound = upper_bound
+        self.cancelled = cancelled
+
+        problem = self.problem
+        self.types = problem.types
+        self.conflicts = problem.conflicts(d_center)
+        # A type covers the pairs of distance class up to its rank (see
+        # TypeLadder), tied types taking the last position of the tie
+        working_d = problem.ladder.working_d
+        self.ranks = [bisect.bisect_right(working_d, t.working_d) - 1
+                      for t in self.types]
+        self.unit_cost = min([t.cost / t.cap for t in self.types
+                              if t.cap > 0], default=0)
+        self.max_cap = max([t.cap for t in self.types], default=0)
+        self.total_load = 1.1 * sum(problem.populations)
+        # With integer costs a node must beat the incumbent by one unit
+        self.integral = all(float(t.cost).is_integer() for t in self.types)
+
+        # Pairs (city, distance class) every location can reach
+        n_locations = problem.n_locations
+        self.reach_primary = [[] for _ in range(n_locations)]
+        self.reach_secondary = [[] for _ in range(n_locations)]
+        for ci in range(problem.n_cities):
+            for li, k in zip(problem.candidates_primary[ci],
+                             problem.classes_primary[ci]):
+                if k is not None:
+                    self.reach_primary[li].append((ci, k))
+            for li, k in zip(problem.candidates_secondary[ci],
+                             problem.classes_secondary[ci]):
+                if k is not None:
+                    self.reach_secondary[li].append((ci, k))
+        # Cheapest type reaching every class
+        self.cheapest_primary = [
+            min([t.cost for t, r in zip(self.types, self.ranks) if r >= k])
+            for k in range(len(working_d))
+            ]
+
+        self.cheapest_type = min([t.cost for t in self.types], default=0)
+
+        # Locations reaching many cities are decided first
+        self.order = sorted(range(n_locations),
+                            key=lambda li: (-len(self.reach_primary[li]), li))
+
+        self.best = None
+        self.best_cost = math.inf
+        # Smallest of best_cost and upper_bound, nodes must beat it
+        self.cutoff = math.inf
+        self.preferred = [CLOSED] * n_locations
+        if incumbent is not None and incumbent.violations(d_center):
+            # Its cost would prune better feasible solutions
+            logger.warning("Ignoring the incumbent, it is not feasible")
+            incumbent = None
+        if incumbent is not None:
+            self.best = CompactSolution.from_solution(incumbent)
+            self.best_cost = self.best.cost
+            self.preferred = list(self.best.types)
+
+        self.nodes = 0
+        self.leaves = 0
+        self.elapsed = 0
+        self.lower_bound = None
+        self.complete = False
+
+    # ---- BOUNDS ----
+    def blocked(self, decisions, li):
+        return any(decisions[lj] >= 0 for lj in self.conflicts[li])
+
+    def bound(self, decisions):
+        # Lower bound of the cost of any solution below the node, None if it
+        # has none
+        n_cities = self.problem.n_cities
+        # Per city the locations that may still serve it
+        primary = [set() for _ in range(n_cities)]
+        secondary = [set() for _ in range(n_cities)]
+        covered_primary = [False] * n_cities
+        covered_secondary = [False] * n_cities
+        cost = 0
+        capacity = 0
+        undecided = set()
+        for li, ti in enumerate(decisions):
+            if ti >= 0:
+                t = self.types[ti]
+                cost += t.cost
+                capacity += t.cap
+                rank = self.ranks[ti]
+                for ci, k in self.reach_primary[li]:
+                    if k <= rank:
+                        primary[ci].add(li)
+                        covered_primary[ci] = True
+                for ci, k in self.reach_secondary[li]:
+                    if k <= rank:
+                        secondary[ci].add(li)
+                        covered_secondary[ci] = True
+            elif ti == UNDECIDED and not self.blocked(decisions, li):
+                undecided.add(li)
+                capacity += self.max_cap
+                for ci, _ in self.reach_primary[li]:
+                    primary[ci].add(li)
+                for ci, _ in self.reach_secondary[li]:
+                    secondary[ci].add(li)
+
+        if capacity < self.total_load - 1e-9:
+            return None
+
+        missing = 0
+        for ci in range(n_cities):
+            p, s = primary[ci], secondary[ci]
+            if not p or not s or (len(p | s) < 2):
+                return None
+            if not covered_primary[ci]:
+                # Some undecided location must open
+                missing = max(missing, self.opening_cost(ci, undecided))
+            elif not covered_secondary[ci]:
+                missing = max(missing, self.cheapest_type)
+
+        deficit = self.total_load - (capacity - self.max_cap * len(undecided))
+        missing = max(missing, deficit * self.unit_cost)
+        if self.integral:
+            return cost + math.ceil(missing - 1e-9)
+        return cost + missing
+
+    def opening_cost(self, ci, undecided):
+        # Cheapest type of an undecided location able to serve ci as primary
+        problem = self.problem
+        best = math.inf
+        for li, k in zip(problem.candidates_primary[ci],
+                         problem.classes_primary[ci]):
+            if li in undecided and k is not None:
+                best = min(best, self.cheapest_primary[k])
+        return best
+
+    # ---- ASSIGNMENT ----
+    def assignment(self, decisions):
+        # Primary and secondary location of every city fitting the
+        # capacities of the open locations, None if there is none
+        problem = self.problem
+        populations = problem.populations
+        n_cities = problem.n_cities
+        options_primary = [[] for _ in range(n_cities)]
+        options_secondary = [[] for _ in range(n_cities)]
+        remaining = {}
+        for li, ti in enumerate(decisions):
+            if ti < 0:
+                continue
+            remaining[li] = self.types[ti].cap
+            rank = self.ranks[ti]
+            for ci, k in self.reach_primary[li]:
+                if k <= rank:
+                    options_primary[ci].append(li)
+            for ci, k in self.reach_secondary[li]:
+                if k <= rank:
+                    options_secondary[ci].append(li)
+
+        # Most constrained cities first, the biggest ones on ties
+        cities = sorted(range(n_cities), key=lambda ci: (
+            len(options_primary[ci]) + len(options_secondary[ci]),
+            -populations[ci]))
+        # Load still to place after every position
+        suffix = [0] * (n_cities + 1)
+        for pos in reversed(range(n_cities)):
+            suffix[pos] = suffix[pos + 1] + 1.1 * populations[cities[pos]]
+        primary = [-1] * n_cities
+        secondary = [-1] * n_cities
+        steps = [0]
+
+        def place(pos):
+            if pos == n_cities:
+                return True
+            steps[0] += 1
+            if steps[0] % 1000 == 0:
+                self.check_limits()
+            if sum(remaining.values()) < suffix[pos] - 1e-9:
+                return False
+            ci = cities[pos]
+            pop = populations[ci]
+            # Roomiest locations first
+            for lp in sorted(options_primary[ci], key=lambda l: -remaining[l]):
+                if remaining[lp] < pop - 1e-9:
+                    continue
+                remaining[lp] -= pop
+                for ls in sorted(options_secondary[ci],
+                                 key=lambda l: -remaining[l]):
+                    if ls == lp or remaining[ls] < 0.1 * pop - 1e-9:
+                        continue
+                    remaining[ls] -= 0.1 * pop
+                    if place(pos + 1):
+                        primary[ci] = lp
+                        secondary[ci] = ls
+                        return True
+                    remaining[ls] += 0.1 * pop
+                remaining[lp] += pop
+            return False
+
+        if not place(0):
+            return None
+        return primary, secondary
+
+    # ---- SEARCH ----
+    def check_limits(self):
+        if self.node_limit is not None and self.nodes >= self.node_limit:
+            raise SearchLimit
+        if self.deadline is not None and time.time() >= self.deadline:
+            raise SearchLimit
+        if self.cancelled is not None and self.cancelled():
+            raise SearchLimit
+        self.cutoff = self.best_cost
+        if self.upper_bound is not None:
+            self.cutoff = min(self.cutoff, self.upper_bound())
+
+    def children(self, decisions, depth):
+        # Decisions of the next location, the incumbent one first
+        li = self.order[depth]
+        if self.blocked(decisions, li):
+            return li, [CLOSED]
+        options = [CLOSED] + sorted(range(len(self.types)),
+                                    key=lambda ti: self.types[ti].cost)
+        preferred = self.preferred[li]
+        options.remove(preferred)
+        return li, [preferred] + options
+
+    def solve(self):
+        start = time.time()
+        self.deadline = start + self.time_limit \
+            if self.time_limit is not None else None
+        n_locations = self.problem.n_locations
+        # Nodes to explore: (decisions, depth, bound of the parent)
+        stack = [([UNDECIDED] * n_locations, 0, 0)]
+        # Bound of the parent of the node being explored
+        current = None
+        try:
+            while stack:
+                self.check_limits()
+                decisions, depth, current = stack.pop()
+                self.nodes += 1
+                if instrumentation.ENABLED:
+                    instrumentation.count("bnb nodes")
+                bound = self.bound(decisions)
+                if bound is None or bound >= self.cutoff:
+                    if instrumentation.ENABLED:
+                        instrumentation.count("bnb pruned")
+                    continue
+                if depth == n_locations:
+                    self.leaf(decisions)
+                    continue
+                li, options = self.children(decisions, depth)
+                for ti in reversed(options):
+                    child = list(decisions)
+                    child[li] = ti
+                    stack.append((child, depth + 1, bound))
+                current = None
+            self.complete = True
+        except SearchLimit:
+            if self.verbose:
+                logger.info("Branch and bound limit reached after %s nodes",
+                            self.nodes)
+        self.elapsed = time.time() - start
+
+        if self.complete:
+            # Nothing is cheaper than the cutoff
+            self.lower_bound = min(self.best_cost, self.cutoff)
+        else:
+            # Every unexplored node is below one of the stacked ones
+            pending = [b for _, _, b in stack]
+            if current is not None:
+                pending.append(current)
+            self.lower_bound = min(pending, default=self.best_cost)
+            if self.external_bound is not None:
+                self.lower_bound = max(self.lower_bound, self.external_bound)
+            self.lower_bound = min(self.lower_bound, self.best_cost,
+                                   self.cutoff)
+
+        if self.best is None:
+            return None
+        return self.best.to_solution(self.d_center)
+
+    def leaf(self, decisions):
+        self.leaves += 1
+        if instrumentation.ENABLED:
+            instrumentation.count("bnb leaves")
+        found = self.assignment(decisions)
+        if found is None:
+            return
+        primary, secondary = found
+        compact = CompactSolution(self.problem)
+        populations = self.problem.populations
+        for li, ti in enumerate(decisions):
+            if ti >= 0:
+                compact.set_type(li, ti)
+        for ci, (lp, ls) in enumerate(zip(primary, secondary)):
+            compact.primary[ci] = lp
+            compact.secondary[ci] = ls
+            compact.population_primary[lp] += populations[ci]
+            compact.population_secondary[ls] += populations[ci]
+        self.best = compact
+        self.best_cost = compact.cost
+        if self.verbose:
+            logger.info("New incumbent with cost %s at node %s",
+                        compact.cost, self.nodes)
+        if events.ENABLED:
+            events.emit("incumbent", node=self.nodes, cost=compact.cost)
+
+    def gap(self):
+        if self.best is None or self.lower_bound is None:
+            return None
+        if self.best_cost <= 0:
+            return 0.0
+        return (self.best_cost - self.lower_bound) / self.best_cost
+
+    def report(self):
+        rate = self.nodes / self.elapsed if self.elapsed > 0 else 0
+        status = "optimal" if self.complete else "limit reached"
+        lines = [f"Nodes: {self.nodes} ({rate:.0f} nodes/s), "
+                 f"leaves: {self.leaves}, {status}"]
+        if self.best is not None:
+            lines.append(f"Best cost {self.best_cost}, lower bound "
+                         f"{self.lower_bound:g}, gap {100 * self.gap():.2f}%")
+        else:
+            lines.append("No feasible solution found")
+        return "\n".join(lines)
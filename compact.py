@@ -0,0 +1,121 @@
+from array import array
+
+from models import City, LogisticCenterLocation, Solution
+
+
+class CompactSolution:
+    # Array based solution: primary and secondary location index of every
+    # city, type index (in problem.types) of every location, -1 meaning
+    # unassigned / inactive, and the population totals of every location.
+    # Instance data lives in the shared problem, so copying a solution only
+    # copies these arrays.
+    def __init__(self, problem, primary=None, secondary=None, types=None,
+                 population_primary=None, population_secondary=None):
+        self.problem = problem
+        n_cities = problem.n_cities
+        n_locations = problem.n_locations
+        self.primary = primary if primary is not None \
+            else array('l', [-1]) * n_cities
+        self.secondary = secondary if secondary is not None \
+            else array('l', [-1]) * n_cities
+        self.types = types if types is not None \
+            else array('l', [-1]) * n_locations
+        self.population_primary = population_primary \
+            if population_primary is not None \
+            else array('d', [0]) * n_locations
+        self.population_secondary = population_secondary \
+            if population_secondary is not None \
+            else array('d', [0]) * n_locations
+        # Running cost, kept up to date by set_type
+        types = problem.types
+        self.total = sum([types[ti].cost for ti in self.types if ti >= 0])
+
+    def copy(self):
+        return CompactSolution(
+            self.problem, array('l', self.primary), array('l', self.secondary),
+            array('l', self.types), array('d', self.population_primary),
+            array('d', self.population_secondary)
+            )
+
+    def load(self, li):
+        return self.population_primary[li] + 0.1 * self.population_secondary[li]
+
+    @property
+    def cost(self):
+        return self.total
+
+    def set_type(self, li, ti):
+        # Sets the type index of li, -1 to close it. Returns the cost delta.
+        types = self.problem.types
+        old = self.types[li]
+        delta = (types[ti].cost if ti >= 0 else 0) \
+                - (types[old].cost if old >= 0 else 0)
+        self.types[li] = ti
+        self.total += delta
+        return delta
+
+    def __getstate__(self):
+        # The problem is not pickled, whoever unpickles the solution must set
+        # it back (it already has it)
+        state = self.__dict__.copy()
+        state["problem"] = None
+        return state
+
+    @classmethod
+    def from_solution(cls, solution):
+        problem = solution.problem
+        compact = cls(problem)
+        type_index = {t.tid: ti for ti, t in enumerate(problem.types)}
+        for l in solution.centers:
+            if l.active:
+                compact.set_type(l.idx, type_index[l.t.tid])
+        populations = problem.populations
+        for c in solution.cities:
+            if c.pc is not None:
+                compact.primary[c.idx] = c.pc.idx
+                compact.population_primary[c.pc.idx] += populations[c.idx]
+            if c.sc is not None:
+                compact.secondary[c.idx] = c.sc.idx
+                compact.population_secondary[c.sc.idx] += populations[c.idx]
+        return compact
+
+    def to_solution(self, d_center=None):
+        # Builds a fresh object Solution, owning its objects. The conflict
+        # counts of the locations are set for d_center (problem.d_center by
+        # default).
+        problem = self.problem
+        if d_center is None:
+            d_center = problem.d_center
+        cities = []
+        for idx, ((x, y), population) in enumerate(
+                zip(problem.city_coordinates, problem.populations)):
+            c = City(x, y, population)
+            c.idx = idx
+            cities.append(c)
+
+        centers = []
+        for idx, ((x, y), ti) in enumerate(
+                zip(problem.location_coordinates, self.types)):
+            l = LogisticCenterLocation(x, y)
+            l.idx = idx
+            l.problem = problem
+            if ti >= 0:
+                l.t = problem.types[ti]
+                l.active = True
+            centers.append(l)
+
+        if d_center is not None:
+            conflicts = problem.conflicts(d_center)
+            for l in centers:
+                if l.active:
+                    for lj in conflicts[l.idx]:
+                        centers[lj].active_conflicts += 1
+
+        for c, pc, sc in zip(cities, self.primary, self.secondary):
+            if pc >= 0:
+                centers[pc].assign_city_primary(c)
+            if sc >= 0:
+                centers[sc].assign_city_secondary(c)
+
+        return Solution(cities, centers, list(problem.types), problem,
+                        deep_copy=False)
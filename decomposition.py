@@ -0,0 +1,361 @@
+import logging
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from models import City, LogisticCenterLocation, Solution, Infeasible
+from compact import CompactSolution
+from deltasearch import DeltaLocalSearchSolver
+from greedy import GreedySolver
+from problem import Problem
+import events
+import instrumentation
+
+logger = logging.getLogger(__name__)
+
+
+class Tile:
+    # A cell of the decomposition grid: the cities inside it and the
+    # locations within overlap of it, as indices of the whole problem. box is
+    # (left, right, bottom, top) of the cell extended by overlap.
+    def __init__(self, index, cities, locations, box):
+        self.index = index
+        self.cities = cities
+        self.locations = locations
+        self.box = box
+
+    def contains(self, x, y):
+        left, right, bottom, top = self.box
+        return left <= x <= right and bottom <= y <= top
+
+
+def solve_tile(city_data, location_data, types, d_center, ls, batch):
+    # Greedy + delta local search on the sub-instance of a tile. Returns the
+    # primary and secondary position (in location_data) of every city, None
+    # if the greedy finds it infeasible.
+    cities = [City(x, y, population) for x, y, population in city_data]
+    centers = [LogisticCenterLocation(x, y) for x, y in location_data]
+    problem = Problem(cities, centers, types, d_center)
+    initial = Solution(cities, centers, types, problem)
+    try:
+        solution = GreedySolver(initial, d_center, batch=batch).solve()
+    except Infeasible:
+        return None
+    compact = CompactSolution.from_solution(solution)
+    if ls is not None:
+        compact = DeltaLocalSearchSolver(compact, d_center, strategy=ls,
+                                         verbose=False).search()
+    return list(compact.primary), list(compact.secondary)
+
+def _run_tile(profile, *task):
+    # solve_tile in a pool worker, with the instrumentation counts of the
+    # worker
+    instrumentation.ENABLED = profile
+    # Only the main process writes the event stream
+    events.ENABLED = False
+    instrumentation.reset()
+    return solve_tile(*task), instrumentation.snapshot()
+
+
+class DecompositionSolver:
+    # Solves large instances by parts. The bounding box of the cities is cut
+    # into a tiles x tiles grid; every tile gets the cities inside it and the
+    # locations within overlap of it (3 times the largest working distance
+    # by default, so every candidate of its cities), and is solved on its own
+    # with the greedy and the delta local search, in a process pool of
+    # workers processes. Cells may be narrower than the overlap: the tiles
+    # then share most of their locations, which the repair handles as any
+    # other location shared by several tiles.
+    #
+    # Merging the tiles can break two constraints between neighbouring
+    # tiles: two centers closer than d_center, and a location shared by
+    # several tiles loaded over the capacity of any type. The repair keeps
+    # the most loaded of every group of conflicting centers, unassigns the
+    # largest cities of the overloaded ones, and assigns the unassigned
+    # cities again with the greedy. A last delta local search only moves
+    # the cities of the boundary band: the ones served by a center in the
+    # overlap of several tiles, and the repaired ones. Repaired cities the
+    # greedy can not serve are tried once more after the local search, and
+    # left unassigned (see unassigned) if it still can not.
+    def __init__(self, solution, d_center, tiles=2, workers=None, ls="first",
+                 overlap=None, debug=False, batch=True, verbose=True):
+        if tiles < 1:
+            raise ValueError("The decomposition needs at least one tile")
+        self.problem = solution.problem
+        self.types = solution.types
+        self.d_center = d_center
+        self.tiles = tiles
+        self.workers = workers or os.cpu_count() or 1
+        self.ls = ls
+        if overlap is None:
+            overlap = 3 * max([t.working_d for t in self.types], default=0)
+        self.overlap = overlap
+        self.debug = debug
+        self.batch = batch
+        self.verbose = verbose
+        # Filled by solve
+        self.repaired = []
+        self.band = []
+        self.unassigned = []
+
+    # ---- DECOMPOSITION ----
+    def grid(self):
+        # The tiles with at least one city, and the tile of every city
+        problem = self.problem
+        xs = [x for x, _ in problem.city_coordinates]
+        ys = [y for _, y in problem.city_coordinates]
+        x0, y0 = min(xs), min(ys)
+        width = (max(xs) - x0) / self.tiles or 1.0
+        height = (max(ys) - y0) / self.tiles or 1.0
+
+        def cell(x, y):
+            return (min(self.tiles - 1, math.floor((x - x0) / width)),
+                    min(self.tiles - 1, math.floor((y - y0) / height)))
+
+        owner = [cell(x, y) for x, y in problem.city_coordinates]
+        tiles = []
+        for i in range(self.tiles):
+            for j in range(self.tiles):
+                cities = [ci for ci, o in enumerate(owner) if o == (i, j)]
+                if not cities:
+                    continue
+                left = x0 + i * width - self.overlap
+                right = x0 + (i + 1) * width + self.overlap
+                bottom = y0 + j * height - self.overlap
+                top = y0 + (j + 1) * height + self.overlap
+                tile = Tile((i, j), cities, [], (left, right, bottom, top))
+                tile.locations = [
+                    li for li, (x, y) in
+                    enumerate(problem.location_coordinates)
+                    if tile.contains(x, y)
+                    ]
+                tiles.append(tile)
+        return tiles, owner
+
+    def solve_tiles(self, tiles):
+        # Primary and secondary location of every city, -1 for the cities of
+        # tiles found infeasible
+        problem = self.problem
+        tasks = []
+        for tile in tiles:
+            city_data = []
+            for ci in tile.cities:
+                x, y = problem.city_coordinates[ci]
+                city_data.append((x, y, problem.populations[ci]))
+            location_data = [problem.location_coordinates[li]
+                             for li in tile.locations]
+            tasks.append((city_data, location_data, self.types,
+                          self.d_center, self.ls, self.batch))
+
+        if self.workers == 1:
+            results = [solve_tile(*task) for task in tasks]
+        else:
+            events.flush()
+            profile = [instrumentation.ENABLED] * len(tasks)
+            with ProcessPoolExecutor(
+                    max_workers=min(self.workers, len(tasks))) as pool:
+                results = []
+                for result, state in pool.map(_run_tile, profile,
+                                              *zip(*tasks)):
+                    instrumentation.merge(state)
+                    results.append(result)
+
+        primary = [-1] * problem.n_cities
+        secondary = [-1] * problem.n_cities
+        for tile, result in zip(tiles, results):
+            if result is None:
+                logger.warning("Tile %s is infeasible on its own, its %s "
+                               "cities are left to the repair", tile.index,
+                               len(tile.cities))
+                continue
+            tile_primary, tile_secondary = result
+            for ci, p, s in zip(tile.cities, tile_primary, tile_secondary):
+                primary[ci] = tile.locations[p]
+                secondary[ci] = tile.locations[s]
+            if self.verbose:
+                logger.info("Tile %s solved, %s cities and %s locations",
+                            tile.index, len(tile.cities),
+                            len(tile.locations))
+        return primary, secondary
+
+    # ---- REPAIR ----
+    def served(self, primary, secondary):
+        # Cities of every location, as (city, primary) pairs
+        served = [[] for _ in range(self.problem.n_locations)]
+        for ci, (p, s) in enumerate(zip(primary, secondary)):
+            if p >= 0:
+                served[p].append((ci, True))
+            if s >= 0:
+                served[s].append((ci, False))
+        return served
+
+    def load(self, cities):
+        # Load of serving the (city, primary) pairs, summed as curr_load does:
+        # adding 0.1 * population city by city can exceed a cap the tile
+        # filled exactly
+        populations = self.problem.populations
+        population_primary = population_secondary = 0
+        for ci, is_primary in cities:
+            if is_primary:
+                population_primary += populations[ci]
+            else:
+                population_secondary += populations[ci]
+        return population_primary + 0.1 * population_secondary
+
+    def cheapest_type(self, li, cities):
+        # Cheapest type serving the (city, primary) pairs from li, None if
+        # there is none
+        problem = self.problem
+        ladder = problem.ladder
+        k = 0
+        for ci, is_primary in cities:
+            d = problem.distances.city_to_location(ci, li)
+            k_city = ladder.distance_class(d, secondary=not is_primary)
+            if k_city is None:
+                return None
+            k = max(k, k_city)
+        return ladder.cheapest(k, self.load(cities))
+
+    def repair(self, primary, secondary):
+        # Unassigns (in place) the cities that break the constraints between
+        # tiles, and returns them
+        problem = self.problem
+        populations = problem.populations
+        conflicts = problem.conflicts(self.d_center)
+        served = self.served(primary, secondary)
+        unassigned = {ci for ci in range(problem.n_cities) if primary[ci] < 0}
+
+        def unassign(ci):
+            unassigned.add(ci)
+            for li, is_primary in ((primary[ci], True),
+                                   (secondary[ci], False)):
+                if li >= 0:
+                    served[li].remove((ci, is_primary))
+            primary[ci] = secondary[ci] = -1
+
+        # Centers too close: the most loaded ones stay open
+        kept = set()
+        for li in sorted((li for li in range(problem.n_locations)
+                          if served[li]),
+                         key=lambda li: (-self.load(served[li]), li)):
+            if any(lj in kept for lj in conflicts[li]):
+                for ci, _ in list(served[li]):
+                    unassign(ci)
+            else:
+                kept.add(li)
+
+        # Overloaded centers lose their largest cities until a type fits
+        for li in sorted(kept):
+            while served[li] and self.cheapest_type(li, served[li]) is None:
+                ci, _ = max(served[li], key=lambda s: (populations[s[0]], s))
+                unassign(ci)
+        return sorted(unassigned)
+
+    def assign(self, greedy, solution, cities):
+        # Serves cities with greedy, largest first while there is room for
+        # them. Returns the ones it can not serve, left unassigned.
+        failed = []
+        for ci in sorted(cities,
+                         key=lambda ci: (-self.problem.populations[ci], ci)):
+            c = solution.cities[ci]
+            # State of the locations the greedy may open or upgrade for c
+            before = {li: (solution.centers[li].active, solution.centers[li].t)
+                      for li in self.problem.candidates_primary[ci]}
+            try:
+                greedy.assign(c)
+            except Infeasible:
+                self.undo(greedy, solution, c, before)
+                failed.append(ci)
+        return failed
+
+    def undo(self, greedy, solution, c, before):
+        # Takes back the primary center the greedy gave c before finding no
+        # secondary one, with the activation and type it had before (as
+        # (active, type) in before)
+        l = c.pc
+        if l is None:
+            return
+        l.remove_city_primary(c)
+        c.pc = None
+        active, t = before[l.idx]
+        if not active:
+            l.deactivate(solution.centers, self.d_center)
+        l.set_type(t)
+        if greedy.kernel is not None:
+            greedy.kernel.sync(l)
+
+    def merge(self, primary, secondary):
+        # Object solution of the given assignments, every center with the
+        # cheapest type serving its cities
+        compact = CompactSolution(self.problem)
+        type_index = {t.tid: ti for ti, t in enumerate(self.problem.types)}
+        populations = self.problem.populations
+        served = self.served(primary, secondary)
+        for li, cities in enumerate(served):
+            if cities:
+                t = self.cheapest_type(li, cities)
+                compact.set_type(li, type_index[t.tid])
+        for ci, (p, s) in enumerate(zip(primary, secondary)):
+            compact.primary[ci] = p
+            compact.secondary[ci] = s
+            if p >= 0:
+                compact.population_primary[p] += populations[ci]
+            if s >= 0:
+                compact.population_secondary[s] += populations[ci]
+        return compact.to_solution(self.d_center)
+
+    def boundary_band(self, solution, tiles):
+        # Cities served by a center in the overlap of several tiles
+        shared = set()
+        seen = set()
+        for tile in tiles:
+            shared.update(seen.intersection(tile.locations))
+            seen.update(tile.locations)
+        band = set()
+        for li in shared:
+            l = solution.centers[li]
+            band.update(c.idx for c in l.cities_primary.values())
+            band.update(c.idx for c in l.cities_secondary.values())
+        return band
+
+    def solve(self):
+        tiles, owner = self.grid()
+        if self.verbose:
+            logger.info("Decomposition in %s tiles with overlap %s",
+                        len(tiles), self.overlap)
+        with instrumentation.timer("decomposition tiles"):
+            primary, secondary = self.solve_tiles(tiles)
+
+        with instrumentation.timer("decomposition repair"):
+            self.repaired = self.repair(primary, secondary)
+            solution = self.merge(primary, secondary)
+            greedy = GreedySolver(solution, self.d_center, debug=self.debug,
+                                  batch=self.batch)
+            failed = self.assign(greedy, solution, self.repaired)
+        if self.verbose:
+            logger.info("Repaired %s cities between tiles, cost %s",
+                        len(self.repaired), solution.cost)
+        if events.ENABLED:
+            events.emit("decomposition", tiles=len(tiles),
+                        repaired=len(self.repaired), cost=solution.cost)
+
+        self.band = sorted((self.boundary_band(solution, tiles)
+                            | set(self.repaired)) - set(failed))
+        if self.ls is not None and self.band:
+            with instrumentation.timer("decomposition boundary search"):
+                compact = DeltaLocalSearchSolver(
+                    solution, self.d_center, strategy=self.ls,
+                    verbose=False, cities=self.band
+                    ).search()
+            solution = compact.to_solution(self.d_center)
+
+        if failed:
+            # The local search may have made room for them
+            greedy = GreedySolver(solution, self.d_center, debug=self.debug,
+                                  batch=self.batch)
+            failed = self.assign(greedy, solution, failed)
+        self.unassigned = failed
+        if failed:
+            logger.warning("%s repaired cities could not be assigned again",
+                           len(failed))
+        return solution
@@ -0,0 +1,708 @@
+import bisect
+import logging
+import time
+
+from compact import CompactSolution
+import events
+import instrumentation
+
+logger = logging.getLogger(__name__)
+
+# Moves must improve the cost by more than this to be applied
+EPSILON = 1e-9
+
+# Neighbourhoods, in the order first improvement explores them
+MOVES = ("downgrade", "close", "reassign_primary", "reassign_secondary",
+         "swap_roles", "swap_primary", "swap_secondary")
+# Neighbourhoods generated per location, per (city, location) pair and per
+# city
+LOCATION_MOVES = ("downgrade", "close")
+PAIR_MOVES = ("reassign_primary", "reassign_secondary", "swap_primary",
+              "swap_secondary")
+
+
+class DeltaLocalSearchSolver:
+    # Local search on a CompactSolution. Every move is evaluated from the
+    # cached loads, types and distances without modifying the solution; only
+    # the chosen move is applied. After a move every touched location gets
+    # the cheapest type that still serves its cities (or is closed when it
+    # has none left), so the cost delta of a move is the difference of the
+    # cheapest type costs of the touched locations.
+    #
+    # Neighbourhoods:
+    #   downgrade            set a location to its cheapest feasible type
+    #   close                close a center, moving its cities elsewhere
+    #   reassign_primary     move the primary center of a city
+    #   reassign_secondary   move the secondary center of a city
+    #   swap_roles           exchange primary and secondary of a city
+    #   swap_primary         exchange the primary centers of two cities
+    #   swap_secondary       exchange the secondary centers of two cities
+    #
+    # strategy is "first" (apply the first improving move found) or "best"
+    # (apply the best move of the whole neighbourhood). The search stops at
+    # a local optimum, or after max_moves moves. Best improvement keeps the
+    # best move of every location (downgrade, close), city and candidate
+    # location (reassign, swap_primary, swap_secondary) or city (swap_roles),
+    # and after a move only evaluates again the ones the touched locations
+    # take part in.
+    #
+    # cities restricts the search to the moves of the given city indices
+    # (and to the locations serving them for downgrade and close), all of
+    # them by default. deadline, a time.time() value, stops the search
+    # between two move evaluations, and so does stop, a function, when it
+    # returns True. Every move keeps the solution feasible, so the
+    # interrupted search still returns a valid solution. Cities without a
+    # primary or secondary center (partial solutions, see decomposition.py)
+    # are left as they are.
+    def __init__(self, solution, d_center, strategy="first", moves=MOVES,
+                 max_moves=None, verbose=True, cities=None, deadline=None,
+                 stop=None):
+        if strategy not in ("first", "best"):
+            raise ValueError(f"Unknown local search strategy {strategy}")
+        self.d_center = d_center
+        self.strategy = strategy
+        self.moves = [m for m in MOVES if m in moves]
+        self.max_moves = max_moves
+        self.verbose = verbose
+        self.deadline = deadline
+        self.stop = stop
+        self.interrupted = False
+
+        self.problem = solution.problem
+        # Works on a copy, solution may be a Solution or a CompactSolution
+        if isinstance(solution, CompactSolution):
+            self.solution = solution.copy()
+        else:
+            self.solution = CompactSolution.from_solution(solution)
+        self.types = self.problem.types
+        self.type_index = {t.tid: ti for ti, t in enumerate(self.types)}
+        self.moves_applied = 0
+        self.restricted = None if cities is None else set(cities)
+        self.cities = range(self.problem.n_cities) if cities is None \
+            else sorted(self.restricted)
+
+        n_locations = self.problem.n_locations
+        # Cities served by each location and the sorted distances to them,
+        # the last one is the distance the type must cover
+        self.members_primary = [set() for _ in range(n_locations)]
+        self.members_secondary = [set() for _ in range(n_locations)]
+        self.dist_primary = [[] for _ in range(n_locations)]
+        self.dist_secondary = [[] for _ in range(n_locations)]
+        for ci in range(self.problem.n_cities):
+            li = self.solution.primary[ci]
+            if li >= 0:
+                self.members_primary[li].add(ci)
+                bisect.insort(self.dist_primary[li], self.distance(ci, li))
+            li = self.solution.secondary[ci]
+            if li >= 0:
+                self.members_secondary[li].add(ci)
+                bisect.insort(self.dist_secondary[li], self.distance(ci, li))
+
+        # Start from the cheapest feasible type of every center, this also
+        # repairs centers whose type does not cover their cities
+        for li in range(n_locations):
+            if self.active(li):
+                self.retype(li)
+
+        # What every city saves by leaving its primary and its secondary
+        # center, kept up to date by apply. A location never gets cheaper by
+        # receiving a city, so a move can only improve the cost if the cities
+        # it moves save more than EPSILON together.
+        self.saving_primary = [self.saving(ci, True)
+                               for ci in range(self.problem.n_cities)]
+        self.saving_secondary = [self.saving(ci, False)
+                                 for ci in range(self.problem.n_cities)]
+
+        # Best improvement state: per neighbourhood, the best improving
+        # (delta, move) by anchor (see neighbourhood), the locations touched
+        # by the last move, and the cities that have every location among
+        # their primary and their secondary candidates
+        self.best_moves = None
+        self.touched = None
+        if strategy == "best":
+            self.near_primary = self.cities_near(
+                self.problem.candidates_primary)
+            self.near_secondary = self.cities_near(
+                self.problem.candidates_secondary)
+
+    def cities_near(self, candidates):
+        near = [[] for _ in range(self.problem.n_locations)]
+        for ci, locations in enumerate(candidates):
+            for li in locations:
+                near[li].append(ci)
+        return near
+
+    # ---- EVALUATION ----
+    def distance(self, ci, li):
+        return self.problem.distances.city_to_location(ci, li)
+
+    def cheapest_type(self, population_primary, population_secondary,
+                      max_primary, max_secondary):
+        # Cheapest type index serving the given loads and distances, or None
+        ladder = self.problem.ladder
+        k_primary = ladder.distance_class(max_primary)
+        k_secondary = ladder.distance_class(max_secondary, secondary=True)
+        if k_primary is None or k_secondary is None:
+            return None
+        load = population_primary + 0.1 * population_secondary
+        t = ladder.cheapest(max(k_primary, k_secondary), load)
+        if t is None:
+            return None
+        return self.type_index[t.tid]
+
+    def location_cost(self, li, population_primary, population_secondary,
+                      max_primary, max_secondary, empty):
+        # Cost of location li in the given state, None if infeasible
+        if empty:
+            return 0
+        ti = self.cheapest_type(population_primary, population_secondary,
+                                max_primary, max_secondary)
+        if ti is None:
+            return None
+        return self.types[ti].cost
+
+    def current_cost(self, li):
+        ti = self.solution.types[li]
+        return self.types[ti].cost if ti >= 0 else 0
+
+    @staticmethod
+    def max_without(distances, d):
+        # Largest distance once d is removed from the sorted list
+        if not distances:
+            return 0
+        if distances[-1] != d:
+            return distances[-1]
+        return distances[-2] if len(distances) >= 2 else 0
+
+    @staticmethod
+    def max_of(distances):
+        return distances[-1] if distances else 0
+
+    def changed_cost(self, li, primary_out=(), primary_in=(),
+                     secondary_out=(), secondary_in=()):
+        # Cost of li after removing / adding the given cities, None if
+        # infeasible. Every argument holds at most one city in the O(1)
+        # moves; the distance maxima only support removing one city per role.
+        populations = self.problem.populations
+        pp = self.solution.population_primary[li]
+        ps = self.solution.population_secondary[li]
+        max_p = self.max_of(self.dist_primary[li])
+        max_s = self.max_of(self.dist_secondary[li])
+        n_cities = len(self.members_primary[li]) \
+            + len(self.members_secondary[li])
+        for ci in primary_out:
+            pp -= populations[ci]
+            max_p = self.max_without(self.dist_primary[li],
+                                     self.distance(ci, li))
+            n_cities -= 1
+        for ci in secondary_out:
+            ps -= populations[ci]
+            max_s = self.max_without(self.dist_secondary[li],
+                                     self.distance(ci, li))
+            n_cities -= 1
+        for ci in primary_in:
+            pp += populations[ci]
+            max_p = max(max_p, self.distance(ci, li))
+            n_cities += 1
+        for ci in secondary_in:
+            ps += populations[ci]
+            max_s = max(max_s, self.distance(ci, li))
+            n_cities += 1
+        return self.location_cost(li, pp, ps, max_p, max_s, n_cities == 0)
+
+    def delta(self, changes):
+        # changes: {li: kwargs of changed_cost}. Returns the cost delta of
+        # the move or None if some location becomes infeasible.
+        total = 0
+        for li, change in changes.items():
+            cost = self.changed_cost(li, **change)
+            if cost is None:
+                return None
+            total += cost - self.current_cost(li)
+        return total
+
+    def saving(self, ci, primary):
+        # Cost decrease of the center of ci when ci leaves it
+        if primary:
+            li = self.solution.primary[ci]
+            change = {"primary_out": (ci,)}
+        else:
+            li = self.solution.secondary[ci]
+            change = {"secondary_out": (ci,)}
+        if li < 0:
+            return 0
+        cost = self.changed_cost(li, **change)
+        if cost is None:
+            # The center has no feasible type, nothing is known
+            return float("inf")
+        return self.current_cost(li) - cost
+
+    def active(self, li):
+        return self.solution.types[li] >= 0
+
+    def locations(self):
+        # Locations the downgrade and close moves look at
+        if self.restricted is None:
+            return range(self.problem.n_locations)
+        serving = set()
+        for ci in self.cities:
+            serving.add(self.solution.primary[ci])
+            serving.add(self.solution.secondary[ci])
+        serving.discard(-1)
+        return sorted(serving)
+
+    # ---- NEIGHBOURHOODS ----
+    # Every generator yields (delta, move) for the feasible moves of the
+    # given anchors (see neighbourhood), a move being a tuple (kind,
+    # payload) understood by apply.
+    def downgrade_moves(self, locations):
+        for li in locations:
+            if not self.active(li):
+                continue
+            delta = self.delta({li: {}})
+            if delta is not None and delta < 0:
+                yield delta, ("downgrade", li)
+
+    def close_moves(self, locations):
+        for li in locations:
+            if not self.active(li):
+                continue
+            plan = self.redistribution(li)
+            if plan is not None:
+                delta, moves = plan
+                yield delta, ("close", (li, moves))
+
+    def redistribution(self, li):
+        # Moves every city of li to the cheapest other active center, taking
+        # into account the cities already moved there. Returns the cost delta
+        # of closing li and the list of (city, primary, new location), or
+        # None if some city can not be moved or closing li can not improve
+        # the cost.
+        changes = {}
+        moves = []
+        # The increments of the receivers add up to their cost delta
+        spent = 0
+        saved = self.current_cost(li)
+        for primary, members, role in (
+                (True, self.members_primary[li], "primary_in"),
+                (False, self.members_secondary[li], "secondary_in")):
+            for ci in sorted(members):
+                best, increment = self.best_receiver(ci, li, primary,
+                                                     changes)
+                if best is None:
+                    return None
+                spent += increment
+                if spent > saved:
+                    return None
+                changes.setdefault(best, {}).setdefault(role, []).append(ci)
+                moves.append((ci, primary, best))
+
+        delta = -self.current_cost(li)
+        for l2, change in changes.items():
+            cost = self.simulated_cost(l2, change)
+            if cost is None:
+                return None
+            delta += cost - self.current_cost(l2)
+        return delta, moves
+
+    def simulated_cost(self, li, change):
+        # Cost of li after receiving several cities (no removals)
+        populations = self.problem.populations
+        pp = self.solution.population_primary[li]
+        ps = self.solution.population_secondary[li]
+        max_p = self.max_of(self.dist_primary[li])
+        max_s = self.max_of(self.dist_secondary[li])
+        for ci in change.get("primary_in", ()):
+            pp += populations[ci]
+            max_p = max(max_p, self.distance(ci, li))
+        for ci in change.get("secondary_in", ()):
+            ps += populations[ci]
+            max_s = max(max_s, self.distance(ci, li))
+        return self.location_cost(li, pp, ps, max_p, max_s, False)
+
+    def best_receiver(self, ci, li, primary, changes):
+        # Receiver of ci with the smallest cost increment and the increment,
+        # (None, None) if there is none
+        if primary:
+            candidates = self.problem.candidates_primary[ci]
+            other = self.solution.secondary[ci]
+            role = "primary_in"
+        else:
+            candidates = self.problem.candidates_secondary[ci]
+            other = self.solution.primary[ci]
+            role = "secondary_in"
+
+        best = None
+        best_increment = None
+        for l2 in candidates:
+            if l2 == li or l2 == other or not self.active(l2):
+                continue
+            change = changes.get(l2, {})
+            before = self.simulated_cost(l2, change)
+            tentative = dict(change)
+            tentative[role] = list(change.get(role, ())) + [ci]
+            after = self.simulated_cost(l2, tentative)
+            if after is None:
+                continue
+            increment = after - before
+            if best_increment is None or increment < best_increment:
+                best = l2
+                best_increment = increment
+        return best, best_increment
+
+    def reassign_moves(self, primary, pairs):
+        if primary:
+            assigned = self.solution.primary
+            other = self.solution.secondary
+            saving = self.saving_primary
+            kind, out_role, in_role = \
+                "reassign_primary", "primary_out", "primary_in"
+        else:
+            assigned = self.solution.secondary
+            other = self.solution.primary
+            saving = self.saving_secondary
+            kind, out_role, in_role = \
+                "reassign_secondary", "secondary_out", "secondary_in"
+
+        for ci, l2 in pairs:
+            li = assigned[ci]
+            if li < 0 or l2 == li or l2 == other[ci] or not self.active(l2):
+                continue
+            if saving[ci] <= EPSILON:
+                # Can not improve
+                continue
+            delta = self.delta({li: {out_role: (ci,)},
+                                l2: {in_role: (ci,)}})
+            if delta is not None:
+                yield delta, (kind, (ci, l2))
+
+    def swap_roles_moves(self, cities):
+        for ci in cities:
+            lp = self.solution.primary[ci]
+            ls = self.solution.secondary[ci]
+            if lp < 0 or ls < 0:
+                continue
+            if self.saving_primary[ci] + self.saving_secondary[ci] <= EPSILON:
+                continue
+            delta = self.delta({
+                lp: {"primary_out": (ci,), "secondary_in": (ci,)},
+                ls: {"secondary_out": (ci,), "primary_in": (ci,)},
+                })
+            if delta is not None:
+                yield delta, ("swap_roles", ci)
+
+    def swap_moves(self, primary, pairs):
+        # Exchanges of city a with the cities of location lb, for every
+        # pair (a, lb)
+        if primary:
+            assigned = self.solution.primary
+            other = self.solution.secondary
+            members = self.members_primary
+            saving = self.saving_primary
+            kind, out_role, in_role = \
+                "swap_primary", "primary_out", "primary_in"
+        else:
+            assigned = self.solution.secondary
+            other = self.solution.primary
+            members = self.members_secondary
+            saving = self.saving_secondary
+            kind, out_role, in_role = \
+                "swap_secondary", "secondary_out", "secondary_in"
+
+        for a, lb in pairs:
+            la = assigned[a]
+            if la < 0 or lb == la or lb == other[a] or not self.active(lb):
+                continue
+            for b in members[lb]:
+                if other[b] == la or saving[a] + saving[b] <= EPSILON:
+                    continue
+                if b < a and (self.restricted is None
+                              or b in self.restricted):
+                    # Pair already explored from b
+                    continue
+                delta = self.delta({
+                    la: {out_role: (a,), in_role: (b,)},
+                    lb: {out_role: (b,), in_role: (a,)},
+                    })
+                if delta is not None:
+                    yield delta, (kind, (a, b))
+
+    def pairs(self, primary, cities):
+        # Every city with each of its candidate locations for the role
+        candidates = self.problem.candidates_primary if primary \
+            else self.problem.candidates_secondary
+        for ci in cities:
+            for li in candidates[ci]:
+                yield ci, li
+
+    @staticmethod
+    def is_primary(kind):
+        return kind.endswith("primary")
+
+    def neighbourhood_anchors(self, kind):
+        # Every anchor of the neighbourhood: locations (downgrade and close),
+        # (city, candidate location) pairs (reassign and swap of primary or
+        # secondary centers) or cities (swap_roles)
+        if kind in LOCATION_MOVES:
+            return self.locations()
+        if kind in PAIR_MOVES:
+            return self.pairs(self.is_primary(kind), self.cities)
+        return self.cities
+
+    def neighbourhood(self, kind, anchors=None):
+        # Moves of the given anchors, all of them by default
+        if anchors is None:
+            anchors = self.neighbourhood_anchors(kind)
+        if kind == "downgrade":
+            return self.downgrade_moves(anchors)
+        if kind == "close":
+            return self.close_moves(anchors)
+        if kind == "reassign_primary":
+            return self.reassign_moves(True, anchors)
+        if kind == "reassign_secondary":
+            return self.reassign_moves(False, anchors)
+        if kind == "swap_roles":
+            return self.swap_roles_moves(anchors)
+        if kind == "swap_primary":
+            return self.swap_moves(True, anchors)
+        return self.swap_moves(False, anchors)
+
+    # ---- MOVES ----
+    def remove(self, ci, li, primary):
+        if primary:
+            self.members_primary[li].discard(ci)
+            self.solution.population_primary[li] -= \
+                self.problem.populations[ci]
+            distances = self.dist_primary[li]
+            self.solution.primary[ci] = -1
+        else:
+            self.members_secondary[li].discard(ci)
+            self.solution.population_secondary[li] -= \
+                self.problem.populations[ci]
+            distances = self.dist_secondary[li]
+            self.solution.secondary[ci] = -1
+        del distances[bisect.bisect_left(distances, self.distance(ci, li))]
+
+    def add(self, ci, li, primary):
+        if primary:
+            self.members_primary[li].add(ci)
+            self.solution.population_primary[li] += \
+                self.problem.populations[ci]
+            bisect.insort(self.dist_primary[li], self.distance(ci, li))
+            self.solution.primary[ci] = li
+        else:
+            self.members_secondary[li].add(ci)
+            self.solution.population_secondary[li] += \
+                self.problem.populations[ci]
+            bisect.insort(self.dist_secondary[li], self.distance(ci, li))
+            self.solution.secondary[ci] = li
+
+    def retype(self, li):
+        # Sets li to its cheapest feasible type, closing it if it is empty.
+        # Returns the cost delta.
+        if not self.members_primary[li] and not self.members_secondary[li]:
+            return self.solution.set_type(li, -1)
+        ti = self.cheapest_type(
+            self.solution.population_primary[li],
+            self.solution.population_secondary[li],
+            self.max_of(self.dist_primary[li]),
+            self.max_of(self.dist_secondary[li])
+            )
+        if ti is None:
+            # No type serves the location, it keeps the one it had
+            return 0
+        return self.solution.set_type(li, ti)
+
+    def apply(self, move):
+        kind, payload = move
+        if kind == "downgrade":
+            touched = [payload]
+        elif kind == "close":
+            li, moves = payload
+            touched = [li]
+            for ci, primary, l2 in moves:
+                self.remove(ci, li, primary)
+                self.add(ci, l2, primary)
+                touched.append(l2)
+        elif kind in ("reassign_primary", "reassign_secondary"):
+            ci, l2 = payload
+            primary = kind == "reassign_primary"
+            li = self.solution.primary[ci] if primary \
+                else self.solution.secondary[ci]
+            self.remove(ci, li, primary)
+            self.add(ci, l2, primary)
+            touched = [li, l2]
+        elif kind == "swap_roles":
+            ci = payload
+            lp = self.solution.primary[ci]
+            ls = self.solution.secondary[ci]
+            self.remove(ci, lp, True)
+            self.remove(ci, ls, False)
+            self.add(ci, ls, True)
+            self.add(ci, lp, False)
+            touched = [lp, ls]
+        else:
+            a, b = payload
+            primary = kind == "swap_primary"
+            assigned = self.solution.primary if primary \
+                else self.solution.secondary
+            la, lb = assigned[a], assigned[b]
+            self.remove(a, la, primary)
+            self.remove(b, lb, primary)
+            self.add(a, lb, primary)
+            self.add(b, la, primary)
+            touched = [la, lb]
+
+        delta = 0
+        self.touched = set(touched)
+        for li in self.touched:
+            delta += self.retype(li)
+        # Only the cities of the touched locations save something else now
+        for li in self.touched:
+            for ci in self.members_primary[li]:
+                self.saving_primary[ci] = self.saving(ci, True)
+            for ci in self.members_secondary[li]:
+                self.saving_secondary[ci] = self.saving(ci, False)
+        self.moves_applied += 1
+        if instrumentation.ENABLED:
+            instrumentation.count(f"ls moves applied {kind}")
+        # The actual cost delta, the same as the evaluated one
+        return delta
+
+    # ---- SEARCH ----
+    def expired(self):
+        if self.deadline is not None and time.time() >= self.deadline:
+            self.interrupted = True
+        elif self.stop is not None and self.stop():
+            self.interrupted = True
+        return self.interrupted
+
+    def improving_move(self):
+        if self.strategy == "best":
+            return self.best_move()
+        for kind in self.moves:
+            for delta, move in self.neighbourhood(kind):
+                if instrumentation.ENABLED:
+                    instrumentation.count(f"ls moves evaluated {kind}")
+                if self.expired():
+                    return None
+                if delta < -EPSILON:
+                    return delta, move
+        return None
+
+    def evaluate(self, kind, anchors):
+        # Keeps the best improving move of every anchor of the neighbourhood.
+        # Returns False if the search expired.
+        best_moves = self.best_moves[kind]
+        for anchor in anchors:
+            best = None
+            for delta, move in self.neighbourhood(kind, (anchor,)):
+                if instrumentation.ENABLED:
+                    instrumentation.count(f"ls moves evaluated {kind}")
+                if self.expired():
+                    return False
+                if delta < -EPSILON and (best is None or delta < best[0]):
+                    best = (delta, move)
+            if best is None:
+                best_moves.pop(anchor, None)
+            else:
+                best_moves[anchor] = best
+        return True
+
+    def affected(self, kind):
+        # Anchors of the neighbourhood whose moves may have changed with the
+        # last move. A move only depends on the locations it touches: the
+        # locations of its cities and the candidates they move to.
+        touched = self.touched
+        solution = self.solution
+        keep = (lambda ci: True) if self.restricted is None \
+            else (lambda ci: ci in self.restricted)
+        # Cities served by a touched location, including the moved ones
+        served = set()
+        for li in touched:
+            served.update(self.members_primary[li])
+            served.update(self.members_secondary[li])
+
+        if kind == "downgrade":
+            return sorted(touched)
+        if kind == "close":
+            # Closing depends on the candidates the cities of the location
+            # can move to, and on their other center
+            locations = set(touched)
+            for li in touched:
+                for ci in self.near_primary[li]:
+                    locations.add(solution.primary[ci])
+                for ci in self.near_secondary[li]:
+                    locations.add(solution.secondary[ci])
+            for ci in served:
+                locations.add(solution.primary[ci])
+                locations.add(solution.secondary[ci])
+            locations.discard(-1)
+            return sorted(locations)
+        if kind == "swap_roles":
+            return sorted(ci for ci in served if keep(ci))
+
+        primary = self.is_primary(kind)
+        near = self.near_primary if primary else self.near_secondary
+        pairs = set(self.pairs(primary, [ci for ci in served if keep(ci)]))
+        for li in touched:
+            pairs.update((ci, li) for ci in near[li] if keep(ci))
+        return sorted(pairs)
+
+    def best_move(self):
+        # Best improving move, None at a local optimum or when expired. The
+        # first call evaluates every neighbourhood, the next ones only what
+        # the last move changed.
+        if self.best_moves is None:
+            self.best_moves = {}
+            for kind in self.moves:
+                self.best_moves[kind] = {}
+                if not self.evaluate(kind, self.neighbourhood_anchors(kind)):
+                    return None
+        elif self.touched:
+            # Locations that stop serving the restricted cities leave the
+            # downgrade and close neighbourhoods
+            current = None if self.restricted is None \
+                else set(self.locations())
+            for kind in self.moves:
+                anchors = self.affected(kind)
+                if kind in LOCATION_MOVES and current is not None:
+                    for li in anchors:
+                        if li not in current:
+                            self.best_moves[kind].pop(li, None)
+                    anchors = [li for li in anchors if li in current]
+                if not self.evaluate(kind, anchors):
+                    return None
+            self.touched = None
+
+        # Ties go to the first move in the order of a full scan
+        best = None
+        best_key = None
+        for k, kind in enumerate(self.moves):
+            for anchor, found in self.best_moves[kind].items():
+                key = (found[0], k, anchor)
+                if best_key is None or key < best_key:
+                    best = found
+                    best_key = key
+        return best
+
+    def solve(self):
+        return self.search().to_solution(self.d_center)
+
+    def search(self):
+        # Same as solve, returning the CompactSolution
+        while self.max_moves is None or self.moves_applied < self.max_moves:
+            found = self.improving_move()
+            if found is None:
+                # Local optimum, or out of time
+                break
+            _, move = found
+            delta = self.apply(move)
+            if self.verbose:
+                logger.debug("Applied %s move, cost %s (%+g)", move[0],
+                             self.solution.cost, delta)
+            if events.ENABLED:
+                events.emit("move", kind=move[0], delta=delta,
+                            cost=self.solution.cost)
+
+        return self.solution
@@ -0,0 +1,36 @@
+import json
+import time
+
+# Optional stream of solver events, one JSON object per line. Every emitting
+# site checks ENABLED first, so a closed stream costs one global lookup.
+ENABLED = False
+
+_stream = None
+_start = None
+
+
+def open_stream(path):
+    global ENABLED, _stream, _start
+    close_stream()
+    _stream = open(path, "w")
+    _start = time.perf_counter()
+    ENABLED = True
+
+def close_stream():
+    global ENABLED, _stream
+    ENABLED = False
+    if _stream is not None:
+        _stream.close()
+        _stream = None
+
+def flush():
+    # Call before forking, so the children do not inherit buffered events
+    if _stream is not None:
+        _stream.flush()
+
+def emit(event, **fields):
+    # fields must be JSON serializable. "t" is the time in seconds since
+    # the stream was opened.
+    record = {"event": event, "t": round(time.perf_counter() - _start, 6)}
+    record.update(fields)
+    _stream.write(json.dumps(record) + "\n")
@@ -0,0 +1,208 @@
+import argparse
+import math
+import random
+
+from models import City, LogisticCenterLocation, LogisticCenterType, distance
+from spatial import LocationGrid
+from instances import save_instance
+
+DISTRIBUTIONS = ("uniform", "clustered", "roads")
+POPULATIONS = ("uniform", "lognormal", "pareto")
+# Draws of the location placed next to an uncovered city
+COVER_ATTEMPTS = 100
+
+
+# ---- SPATIAL LAYOUTS ----
+# A layout draws points in the square [0, side] x [0, side]. Cities and
+# locations are drawn from the same layout, so candidate locations are where
+# the cities are.
+class UniformLayout:
+    def __init__(self, rng, side, n_points):
+        self.rng = rng
+        self.side = side
+
+    def point(self):
+        return (self.rng.uniform(0, self.side), self.rng.uniform(0, self.side))
+
+
+class ClusteredLayout:
+    # Gaussian clusters around uniformly placed centres, about 50 cities each
+    def __init__(self, rng, side, n_points):
+        self.rng = rng
+        self.side = side
+        n_clusters = max(1, n_points // 50)
+        self.centres = [(rng.uniform(0, side), rng.uniform(0, side))
+                        for _ in range(n_clusters)]
+        self.sigma = side / (4 * math.sqrt(n_clusters))
+
+    def point(self):
+        cx, cy = self.rng.choice(self.centres)
+        return (_clip(self.rng.gauss(cx, self.sigma), self.side),
+                _clip(self.rng.gauss(cy, self.sigma), self.side))
+
+
+class RoadsLayout:
+    # Points along random straight roads, with a little noise across them
+    def __init__(self, rng, side, n_points):
+        self.rng = rng
+        self.side = side
+        n_roads = max(1, int(math.sqrt(n_points) / 4))
+        self.roads = [
+            ((rng.uniform(0, side), rng.uniform(0, side)),
+             (rng.uniform(0, side), rng.uniform(0, side)))
+            for _ in range(n_roads)
+            ]
+        self.sigma = side / 200
+
+    def point(self):
+        (x0, y0), (x1, y1) = self.rng.choice(self.roads)
+        t = self.rng.random()
+        return (_clip(x0 + t * (x1 - x0) + self.rng.gauss(0, self.sigma),
+                      self.side),
+                _clip(y0 + t * (y1 - y0) + self.rng.gauss(0, self.sigma),
+                      self.side))
+
+
+LAYOUTS = {
+    "uniform": UniformLayout,
+    "clustered": ClusteredLayout,
+    "roads": RoadsLayout,
+}
+
+def _clip(v, side):
+    return min(max(v, 0.0), side)
+
+
+# ---- POPULATIONS ----
+def population(rng, kind, mean):
+    # Integer population >= 1 with the given mean (approximately)
+    if kind == "uniform":
+        return rng.randint(1, 2 * mean - 1)
+    if kind == "lognormal":
+        sigma = 1.0
+        mu = math.log(mean) - sigma * sigma / 2
+        return max(1, round(rng.lognormvariate(mu, sigma)))
+    if kind == "pareto":
+        # Shape 2 has mean 2 * scale
+        return max(1, round(rng.paretovariate(2.0) * mean / 2))
+    raise ValueError(f"Unknown population distribution {kind}")
+
+
+# ---- INSTANCES ----
+def generate(n_cities, n_locations, n_types=3, distribution="uniform",
+             populations="uniform", mean_population=5, seed=None, side=None):
+    # Returns cities, centers, types and d_center, as in data.py.
+    #
+    # With spacing = side / sqrt(n_locations), the typical distance between
+    # locations, the shortest working distance is 1.25 * spacing and
+    # d_center is 0.5 * spacing, so most cities have several candidate
+    # centers. Cities that still have no location close enough get one next
+    # to them, so the instance may have a few
+    # more locations than n_locations. Capacities are sized from the
+    # expected load of a center and the largest population, so every city
+    # fits in any type.
+    if distribution not in LAYOUTS:
+        raise ValueError(f"Unknown spatial distribution {distribution}")
+    rng = random.Random(seed)
+    if side is None:
+        side = 10.0 * math.sqrt(n_locations)
+    layout = LAYOUTS[distribution](rng, side, n_cities)
+
+    # Points are redrawn until they are distinct, among the cities and
+    # among the locations
+    used = set()
+    def distinct_point():
+        while True:
+            point = tuple(round(v, 2) for v in layout.point())
+            if point not in used:
+                used.add(point)
+                return point
+
+    cities = []
+    for _ in range(n_cities):
+        x, y = distinct_point()
+        cities.append(City(x, y, population(rng, populations, mean_population)))
+    used = set()
+    locations = [distinct_point() for _ in range(n_locations)]
+
+    spacing = side / math.sqrt(n_locations)
+    working_ds = [
+        round(1.25 * spacing * (1 + 1.5 * i / max(1, n_types - 1)), 2)
+        for i in range(n_types)
+        ]
+    d_center = round(0.5 * spacing, 2)
+
+    # Cover every city by some location within min_working_d - d_center.
+    # A center that blocks that location is within min_working_d of the city
+    # too, so the city always has an open or openable primary candidate.
+    cover_d = working_ds[0] - d_center
+    grid = LocationGrid(locations, cover_d)
+    for c in cities:
+        covered = any(
+            distance(c.coordinates, locations[li]) <= cover_d
+            for li in grid.near(c.x, c.y)
+            )
+        if not covered:
+            # Dropping the location would leave the city uncovered, redraw
+            # it instead
+            for _ in range(COVER_ATTEMPTS):
+                angle = rng.uniform(0, 2 * math.pi)
+                r = rng.uniform(0, cover_d / 2)
+                location = (round(_clip(c.x + r * math.cos(angle), side), 2),
+                            round(_clip(c.y + r * math.sin(angle), side), 2))
+                if location not in used:
+                    break
+            else:
+                raise ValueError(f"Can not place a location covering city "
+                                 f"({c.x}, {c.y})")
+            used.add(location)
+            locations.append(location)
+            grid.cells.setdefault(grid.cell(*location), []).append(
+                len(locations) - 1)
+    centers = [LogisticCenterLocation(x, y) for x, y in locations]
+
+    # Load of a center serving its share of the cities, primary and secondary
+    max_population = max([c.population for c in cities], default=1)
+    total_load = 1.1 * sum([c.population for c in cities])
+    share = total_load / max(1, n_locations // 8)
+    types = []
+    for tid in range(1, n_types + 1):
+        # Types are nested: type 1 has the longest range, the largest
+        # capacity and the highest cost. Upgrading a center then never
+        # leaves one of its cities out of range. Cost grows slower than
+        # capacity.
+        size = n_types - tid
+        working_d = working_ds[size]
+        cap = max(math.ceil(share * (1 + size)),
+                  math.ceil(1.5 * max_population))
+        cost = round(15 * (1 + size) ** 0.8)
+        types.append(LogisticCenterType(tid, cap, working_d, cost))
+
+    return cities, centers, types, d_center
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Random instance generator")
+    parser.add_argument('-n', '--cities', type=int, required=True)
+    parser.add_argument('-m', '--locations', type=int, required=True)
+    parser.add_argument('-t', '--types', type=int, default=3)
+    parser.add_argument('--distribution', choices=DISTRIBUTIONS,
+                        default="uniform", help="spatial distribution")
+    parser.add_argument('--population', choices=POPULATIONS,
+                        default="uniform", help="population distribution")
+    parser.add_argument('--mean-population', type=int, default=5)
+    parser.add_argument('--side', type=float, default=None,
+                        help="side of the square (default 10 * sqrt(m))")
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('-o', '--output', required=True,
+                        help="instance file (.dat, .json or .csv)")
+    args = parser.parse_args()
+
+    instance = generate(
+        args.cities, args.locations, args.types, args.distribution,
+        args.population, args.mean_population, args.seed, args.side
+        )
+    save_instance(args.output, *instance)
+    cities, centers, types, d_center = instance
+    print(f"{len(cities)} cities, {len(centers)} locations, {len(types)} "
+          f"types, d_center {d_center} written to {args.output}")
@@ -1,225 +1,424 @@
 import random
-import copy
+import itertools
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
 
 from models import City, LogisticCenterLocation, LogisticCenterType, Solution
+from compact import CompactSolution
 from models import (CapacityExceeded, CenterTooFar, CenterTooClose,
                     AlreadyPrimaryCenter, Infeasible)
+from models import FEASIBLE
+from greedy import Construction
+import events
+import instrumentation
+import kernel
 
-class GRASPSolver:
-    def __init__(self, solution, d_center, debug=False):
+logger = logging.getLogger(__name__)
+
+DEFAULT_ALPHAS = (0, 0.1, 0.2)
+# Wider set for reactive GRASP, which learns which ones pay off
+REACTIVE_ALPHAS = (0, 0.05, 0.1, 0.15, 0.2, 0.3, 0.4, 0.5)
+
+def iteration_rng(seed, iter_idx):
+    # Every iteration has its own random stream, derived from the seed and
+    # the iteration index, so results do not depend on how the iterations
+    # are spread over workers. Without seed the stream is not reproducible.
+    if seed is None:
+        return random.Random()
+    return random.Random(f"{seed}:{iter_idx}")
+
+class GRASPSolver(Construction):
+    def __init__(self, solution, d_center, debug=False, iterations=3,
+                 alphas=DEFAULT_ALPHAS, seed=None, time_budget=None,
+                 verbose=True, stall=None, target_cost=None, batch=True):
         #self.cities = copy.deepcopy(solution.cities)
         #self.centers = copy.deepcopy(solution.centers)
         #self.types = copy.deepcopy(solution.types)
         self.d_center = d_center
         self.debug = debug
         self.solution = solution
+        self.problem = solution.problem
+        # Every construction starts from a fresh copy of this
+        self.initial = CompactSolution.from_solution(solution)
+        # Number of constructions, None to run until the time budget (in
+        # seconds) is exhausted or stall iterations in a row do not improve
+        # the best solution. Iteration i uses alphas[i % len(alphas)].
+        if iterations is None and time_budget is None and stall is None:
+            raise ValueError("GRASP needs an iteration count, a time budget "
+                             "or a stall limit")
+        self.iterations = iterations
+        self.alphas = list(alphas)
+        self.seed = seed
+        self.time_budget = time_budget
+        self.verbose = verbose
+        self.stall = stall
+        # Stop as soon as a solution costs at most this, e.g. when it is
+        # within the target gap of a lower bound (see lowerbound.py)
+        self.target_cost = target_cost
+        # Evaluate the candidates of a city at once with NumPy (see
+        # kernel.py), reset at the start of every construction
+        self.kernel = None
+        if batch and kernel.np is not None and not debug:
+            self.kernel = kernel.CandidateKernel(self.problem, d_center)
 
-    def cost_and_update(self, c, l, primary=True):
-        # Returns cost increment
-        if l.active:
-            # The location is an actual logistic center
-            try:
-                if primary:
-                    l.check_city_primary(c)
-                else:
-                    l.check_city_secondary(c)
-                # No changes must be made in logistic centers
-                return 0
-            except CapacityExceeded:
-                # Try changing center type
-                initial_type = l.t
-                for t in self.types:
-                    if t.cap > l.t.cap:
-                        l.t = t
-                        try:
-                            if primary:
-                                l.check_city_primary(c)
-                            else:
-                                l.check_city_secondary(c)
-                            # Return the cost difference between the new type
-                            # and the previous type
-                            return t.cost - initial_type.cost
-                        except CapacityExceeded:
-                            l.t = initial_type
-                            continue
-                        except CenterTooFar:
-                            l.t = initial_type
-                            continue
-
-                if l.t.tid == initial_type.tid:
-                    # No feasible new center type
-                    if self.debug:
-                        print(f"Infeasible center because capacity c({c.x}, {c.y}) -> l({l.x, l.y})")
-                    raise Infeasible
-
-            except CenterTooFar:
-                if self.debug:
-                    print(f"Infeasible center because too far c({c.x}, {c.y}) -> l({l.x, l.y})")
-                raise Infeasible
-
-            except AlreadyPrimaryCenter:
-                if self.debug:
-                    print(f"Infeasible center because already primary c({c.x}, {c.y}) -> l({l.x, l.y})")
-                # Secondary and primary centers must be different
-                raise Infeasible
-
-        else:
-            # The location does not have a logistic center yet
-            # Pick the center type with the smallest cost that is feasible
-            ordered_types = sorted(self.types, key=lambda x: x.cost)
-            for t in ordered_types:
-                try:
-                    if not primary and l.t is not None:
-                        # A primary center already put a type in this iteration
-                        continue
+    def construct(self, alpha, rng):
+        # One randomized greedy construction. Returns None if some city could
+        # not get a primary or a secondary center.
+        good = True
+        start = self.initial.to_solution(self.d_center)
+        self.cities = start.cities
+        self.centers = start.centers
+        self.types = start.types
+        if self.kernel is not None:
+            self.kernel.reset(self.centers)
+        for c in self.cities:
+            problem = self.problem
+            costs_primary = self.candidate_costs(c, primary=True)
+            costs_secondary = self.candidate_costs(c, primary=False)
 
-                    l.activate(self.centers, self.d_center)
-                    l.t = t
-                    if primary:
-                        l.check_city_primary(c)
-                    else:
-                        l.check_city_secondary(c)
-                    l.active = False
-                    return t.cost
-
-                except CenterTooClose:
-                    # d_center not satisfied
-                    l.t = None
-                    l.active = False
-                    if self.debug:
-                        print(f"Infeasible center because too close to another center c({c.x}, {c.y}) -> l({l.x, l.y})")
-                    raise Infeasible
-
-                except CapacityExceeded:
-                    # City is too large for center type
-                    l.t = None
-                    l.active = False
-                    continue
+            if instrumentation.ENABLED:
+                instrumentation.count("cities constructed")
+                instrumentation.count(
+                    "candidates evaluated",
+                    len(problem.candidates_primary[c.idx])
+                    + len(problem.candidates_secondary[c.idx])
+                    )
 
-                except CenterTooFar:
-                    # Center is too far from the city
-                    l.t = None
-                    l.active = False
-                    if self.debug:
-                        print(f"Infeasible center because too far from the city c({c.x}, {c.y}) -> l({l.x, l.y})")
-                    raise Infeasible
-
-            if l.t is None:
-                if self.debug:
-                    print(f"Infeasible new center because of capacity c({c.x}, {c.y}) -> l({l.x, l.y})")
-                raise Infeasible
-            else:
-                return l.cost
+            # The random choices of the previous cities may leave none, the
+            # iteration is lost but not the run
+            if len(costs_primary) == 0:
+                logger.warning("Can not assign a primary center to city (%s, %s)!",
+                               c.x, c.y)
+                return None
 
-    def solve(self):
-        solutions = []
-        alpha = 0
-        for iter_idx in range(3):
-            good = True
-            self.cities = copy.deepcopy(self.solution.cities)
-            self.centers = copy.deepcopy(self.solution.centers)
-            self.types = copy.deepcopy(self.solution.types)
-            for c in self.cities:
-                costs_primary = []
-                costs_secondary = []
-
-                # "clean" types of not active centers from previous iterations
-                for l in self.centers:
-                    if not l.active:
-                        l.t = None
-
-                for l in self.centers:
-                    try:
-                        costs_primary.append(
-                            (l, self.cost_and_update(c, l, primary=True))
-                            )
-                    except Infeasible:
-                        pass
-
-                    try:
-                        costs_secondary.append(
-                            (l, self.cost_and_update(c, l, primary=False))
-                            )
-                    except Infeasible:
-                        pass
-
-                if len(costs_primary) == 0:
-                    print(f"Can not assign a primary center to city ({c.x}, {c.y})!")
-                    raise Infeasible
-
-                if len(costs_secondary) == 0:
-                    print(f"Can not assign a secondary center to city ({c.x}, {c.y})!")
-                    raise Infeasible
-
-                sorted_costs_p_raw = sorted(costs_primary, key=lambda x: x[1])
-                sorted_costs_s_raw = sorted(costs_secondary, key=lambda x: x[1])
-
-                qmin_primary = sorted_costs_p_raw[0][1]
-                qmax_primary = sorted_costs_p_raw[-1][1]
-                sorted_costs_p = [
-                    x for x in sorted_costs_p_raw 
-                    if x[1] <= (qmin_primary + alpha * (qmax_primary - qmin_primary))
-                    ]
-
-
-                pc_idx = random.randint(0, len(sorted_costs_p) - 1)
-                primary_center_assigned = sorted_costs_p[pc_idx][0]
-
-                print(f"City ({c.x}, {c.y}) assigned PC at ({primary_center_assigned.x},"
-                      f" {primary_center_assigned.y}). Type {primary_center_assigned.t.tid}")
-                if not primary_center_assigned.active:
-                    primary_center_assigned.activate(self.centers, self.d_center)
-
-                # XXX
-                primary_center_assigned.add_city_primary(c)
-
-                qmin_secondary = sorted_costs_s_raw[0][1]
-                qmax_secondary = sorted_costs_s_raw[-1][1]
-                sorted_costs_s = [
-                    x for x in sorted_costs_s_raw 
-                    if x[1] <= (qmin_secondary + alpha * (qmax_secondary - qmin_secondary))
-                    ]
-
-                sc_idx = random.randint(0, len(sorted_costs_p) - 1)
-                sc_found = False
-                for i in range(len(sorted_costs_s_raw)):
-                    secondary_center_assigned = \
-                        sorted_costs_s_raw[(sc_idx + i) % len(sorted_costs_s_raw)][0]
-                    activated = False
-                    try:
-                        if not secondary_center_assigned.active:
-                            activated = True
-                            secondary_center_assigned.activate(
-                                self.centers, self.d_center
-                                )
-                        secondary_center_assigned.add_city_secondary(c)
-                        sc_found = True
-                        break
-                    except CenterTooClose:
-                        secondary_center_assigned.active = False
-                        continue
-                    except AlreadyPrimaryCenter:
-                        if activated:
-                            # Deactivate
-                            secondary_center_assigned.active = False
+            if len(costs_secondary) == 0:
+                logger.warning("Can not assign a secondary center to city (%s, %s)!",
+                               c.x, c.y)
+                return None
+
+            sorted_costs_p_raw = sorted(costs_primary, key=lambda x: x[1])
+            sorted_costs_s_raw = sorted(costs_secondary, key=lambda x: x[1])
+
+            qmin_primary = sorted_costs_p_raw[0][1]
+            qmax_primary = sorted_costs_p_raw[-1][1]
+            sorted_costs_p = [
+                x for x in sorted_costs_p_raw 
+                if x[1] <= (qmin_primary + alpha * (qmax_primary - qmin_primary))
+                ]
+
+
+            pc_idx = rng.randint(0, len(sorted_costs_p) - 1)
+            primary_center_assigned, _, primary_type = sorted_costs_p[pc_idx]
+
+            if self.verbose:
+                logger.debug("City (%s, %s) assigned PC at (%s, %s). Type %s",
+                             c.x, c.y, primary_center_assigned.x,
+                             primary_center_assigned.y, primary_type.tid)
+            if not primary_center_assigned.active:
+                primary_center_assigned.activate(self.centers, self.d_center)
+            primary_center_assigned.set_type(primary_type)
+            primary_center_assigned.add_city_primary(c)
+            if self.kernel is not None:
+                self.kernel.sync(primary_center_assigned)
+
+            qmin_secondary = sorted_costs_s_raw[0][1]
+            qmax_secondary = sorted_costs_s_raw[-1][1]
+            sorted_costs_s = [
+                x for x in sorted_costs_s_raw 
+                if x[1] <= (qmin_secondary + alpha * (qmax_secondary - qmin_secondary))
+                ]
+
+            # A random candidate of the restricted list, then the rest of the
+            # list and the candidates outside it, in cost order, if it can
+            # not be used
+            sc_idx = rng.randint(0, len(sorted_costs_s) - 1)
+            order = sorted_costs_s[sc_idx:] + sorted_costs_s[:sc_idx] \
+                + sorted_costs_s_raw[len(sorted_costs_s):]
+            sc_found = False
+            for secondary_center_assigned, _, secondary_type in order:
+                if secondary_center_assigned is primary_center_assigned:
+                    # Secondary and primary centers must be different
+                    continue
+                if not secondary_center_assigned.active:
+                    if secondary_center_assigned.activation_status(
+                            self.centers, self.d_center) != FEASIBLE:
+                        # Too close to the primary center just activated
                         continue
+                    secondary_center_assigned.activate(
+                        self.centers, self.d_center
+                        )
+                secondary_center_assigned.set_type(secondary_type)
+                secondary_center_assigned.add_city_secondary(c)
+                if self.kernel is not None:
+                    self.kernel.sync(secondary_center_assigned)
+                sc_found = True
+                break
 
-                if not sc_found:
-                    print(f"Not feasible secondary center for city {c.coordinates}")
-                    good = False
+            if not sc_found:
+                logger.warning("Not feasible secondary center for city %s",
+                               c.coordinates)
+                good = False
+            elif self.verbose:
+                logger.debug("City (%s, %s) assigned SC at (%s, %s). Type %s",
+                             c.x, c.y, secondary_center_assigned.x,
+                             secondary_center_assigned.y,
+                             secondary_center_assigned.t.tid)
 
-                print(f"City ({c.x}, {c.y}) assigned SC at ({secondary_center_assigned.x},"
-                      f" {secondary_center_assigned.y}). Type {secondary_center_assigned.t.tid}")
+        if not good:
+            return None
+        return Solution(self.cities, self.centers, self.types, self.problem,
+                        deep_copy=False)
 
-            if good:
-                print(f"End of iteration {iter_idx} with alpha {alpha}")
-                solutions.append(Solution(self.cities, self.centers, self.types))
-            alpha += 0.1
+    def iteration_indices(self, start=0, step=1):
+        if self.iterations is None:
+            return itertools.count(start, step)
+        return range(start, self.iterations, step)
 
-        min_cost = float("inf")
+    def solve_iterations(self, iter_indices, deadline=None):
+        # Returns the best solution of the given iterations and the iteration
+        # that found it
         best_solution = None
-        for s in solutions:
-            if s.cost < min_cost:
-                best_solution = s
+        best_idx = None
+        stalled = 0
+        for iter_idx in iter_indices:
+            if deadline is not None and time.time() >= deadline:
+                break
+            if self.stall is not None and stalled >= self.stall:
+                break
+            alpha = self.alpha_for(iter_idx)
+            with instrumentation.timer("grasp construction"):
+                solution = self.construct(alpha,
+                                          iteration_rng(self.seed, iter_idx))
+            self.record(alpha, solution)
+            if events.ENABLED:
+                events.emit("iteration", iteration=iter_idx, alpha=alpha,
+                            cost=None if solution is None else solution.cost)
+            stalled += 1
+            if solution is None:
+                continue
+            if self.verbose:
+                logger.info("End of iteration %s with alpha %s, cost %s",
+                            iter_idx, alpha, solution.cost)
+            if best_solution is None or solution.cost < best_solution.cost:
+                best_solution = solution
+                best_idx = iter_idx
+                stalled = 0
+                if self.reached(solution):
+                    if self.verbose:
+                        logger.info("Target cost %s reached in iteration %s",
+                                    self.target_cost, iter_idx)
+                    break
+
+        return best_solution, best_idx
+
+    def reached(self, solution):
+        # Only a feasible solution reaches the target
+        return self.target_cost is not None \
+            and solution.cost <= self.target_cost \
+            and not solution.violations(self.d_center)
+
+    def alpha_for(self, iter_idx):
+        return self.alphas[iter_idx % len(self.alphas)]
 
+    def record(self, alpha, solution):
+        # Called with the result of every construction, None if infeasible
+        pass
+
+    def deadline(self):
+        if self.time_budget is None:
+            return None
+        return time.time() + self.time_budget
+
+    def solve(self):
+        best_solution, _ = self.solve_iterations(
+            self.iteration_indices(), self.deadline()
+            )
         return best_solution
+
+
+# ---- REACTIVE GRASP ----
+class ReactiveGRASPSolver(GRASPSolver):
+    # Reactive GRASP (Prais and Ribeiro): every iteration draws its alpha
+    # from a discrete set, favouring the alphas whose solutions were better
+    # on average. Every block iterations the probabilities are set
+    # proportional to q_i = (best / avg_i) ** amplification, where avg_i is
+    # the average cost of the solutions built with alpha i and best is the
+    # best cost found. The explore share of the probability is spread
+    # evenly, so no alpha is abandoned for good.
+    def __init__(self, solution, d_center, debug=False, iterations=None,
+                 alphas=REACTIVE_ALPHAS, seed=None, time_budget=None,
+                 verbose=True, stall=None, block=10, amplification=10,
+                 explore=0.05, target_cost=None, batch=True):
+        super().__init__(solution, d_center, debug, iterations, alphas, seed,
+                         time_budget, verbose, stall, target_cost, batch)
+        self.block = block
+        self.amplification = amplification
+        self.explore = explore
+        n = len(self.alphas)
+        self.probabilities = [1 / n] * n
+        # Per alpha: constructions, feasible ones and their total cost
+        self.uses = [0] * n
+        self.feasible = [0] * n
+        self.total_cost = [0] * n
+        self.best_cost = None
+        self.constructions = 0
+        self.current = None
+        # The alpha draws have their own stream, the constructions use
+        # iteration_rng as in the plain GRASP
+        self.rng = random.Random(None if seed is None else f"{seed}:reactive")
+
+    def alpha_for(self, iter_idx):
+        self.current = self.rng.choices(range(len(self.alphas)),
+                                        weights=self.probabilities)[0]
+        return self.alphas[self.current]
+
+    def record(self, alpha, solution):
+        i = self.current
+        self.uses[i] += 1
+        if solution is not None:
+            self.feasible[i] += 1
+            self.total_cost[i] += solution.cost
+            if self.best_cost is None or solution.cost < self.best_cost:
+                self.best_cost = solution.cost
+        self.constructions += 1
+        if self.constructions % self.block == 0:
+            self.update_probabilities()
+
+    def update_probabilities(self):
+        q = []
+        for i in range(len(self.alphas)):
+            if self.feasible[i] == 0:
+                # Untried alphas look as good as the best one, alphas that
+                # only built infeasible solutions are left to exploration
+                q.append(1.0 if self.uses[i] == 0 else 0.0)
+                continue
+            average = self.total_cost[i] / self.feasible[i]
+            if average == 0:
+                q.append(1.0)
+            else:
+                q.append((self.best_cost / average) ** self.amplification)
+        n = len(self.alphas)
+        total = sum(q)
+        if total == 0:
+            self.probabilities = [1 / n] * n
+            return
+        self.probabilities = [
+            (1 - self.explore) * qi / total + self.explore / n for qi in q
+            ]
+        if self.verbose:
+            logger.info("Alpha probabilities %s", ", ".join(
+                f"{alpha}: {p:.3f}"
+                for alpha, p in zip(self.alphas, self.probabilities)
+                ))
+
+    def distribution(self):
+        # Final state of every alpha: probability, constructions, feasible
+        # constructions and average cost (None if none was feasible)
+        return [
+            {"alpha": alpha, "probability": p, "uses": uses,
+             "feasible": feasible,
+             "average_cost": total / feasible if feasible else None}
+            for alpha, p, uses, feasible, total in zip(
+                self.alphas, self.probabilities, self.uses, self.feasible,
+                self.total_cost)
+            ]
+
+    def report(self):
+        lines = [f"{'alpha':>6} {'probability':>11} {'uses':>6} "
+                 f"{'feasible':>8} {'average cost':>12}"]
+        for d in self.distribution():
+            average = "-" if d["average_cost"] is None \
+                else f"{d['average_cost']:.2f}"
+            lines.append(f"{d['alpha']:>6} {d['probability']:>11.3f} "
+                         f"{d['uses']:>6} {d['feasible']:>8} {average:>12}")
+        return "\n".join(lines)
+
+
+# ---- PARALLEL GRASP ----
+# State of a pool worker process. The problem and the initial solution are
+# shipped once, when the worker starts, and not with every task.
+_worker_solver = None
+
+def _init_worker(problem, initial, d_center, debug, iterations, alphas, seed,
+                 time_budget, stall, target_cost, batch, profile):
+    global _worker_solver
+    instrumentation.ENABLED = profile
+    # Only the main process writes the event stream
+    events.ENABLED = False
+    initial.problem = problem
+    solution = initial.to_solution(d_center)
+    _worker_solver = GRASPSolver(
+        solution, d_center, debug, iterations, alphas, seed, time_budget,
+        verbose=False, stall=stall, target_cost=target_cost, batch=batch
+        )
+    # Only the iterations are counted
+    instrumentation.reset()
+
+def _run_worker(start, step, deadline):
+    # Runs iterations start, start + step, ... and only sends back the best,
+    # with the instrumentation counts of the worker
+    solution, iter_idx = _worker_solver.solve_iterations(
+        _worker_solver.iteration_indices(start, step), deadline
+        )
+    if solution is None:
+        return None, instrumentation.snapshot()
+    return ((solution.cost, iter_idx, CompactSolution.from_solution(solution)),
+            instrumentation.snapshot())
+
+class ParallelGRASPSolver(GRASPSolver):
+    # Multi-start GRASP spreading the iterations over a process pool. Worker
+    # w runs iterations w, w + workers, w + 2 * workers... until the
+    # iteration count or the time budget is exhausted. The stall limit
+    # and the target cost apply to every worker on its own.
+    def __init__(self, solution, d_center, debug=False, iterations=3,
+                 alphas=DEFAULT_ALPHAS, seed=None, time_budget=None,
+                 verbose=True, workers=None, stall=None, target_cost=None,
+                 batch=True):
+        # The kernel is built by every worker
+        super().__init__(solution, d_center, debug, iterations, alphas, seed,
+                         time_budget, verbose, stall, target_cost,
+                         batch=False)
+        self.batch = batch
+        self.workers = workers or os.cpu_count() or 1
+        if self.iterations is not None:
+            self.workers = max(1, min(self.workers, self.iterations))
+
+    def solve(self):
+        deadline = self.deadline()
+        initargs = (self.problem, self.initial, self.d_center, self.debug,
+                    self.iterations, self.alphas, self.seed, self.time_budget,
+                    self.stall, self.target_cost, self.batch,
+                    instrumentation.ENABLED)
+        events.flush()
+        with ProcessPoolExecutor(max_workers=self.workers,
+                                 initializer=_init_worker,
+                                 initargs=initargs) as pool:
+            futures = [
+                pool.submit(_run_worker, w, self.workers, deadline)
+                for w in range(self.workers)
+                ]
+            results = []
+            for future in futures:
+                result, state = future.result()
+                instrumentation.merge(state)
+                results.append(result)
+                if result is not None and events.ENABLED:
+                    # The workers only report their best iteration
+                    cost, iter_idx, _ = result
+                    events.emit("iteration", iteration=iter_idx,
+                                alpha=self.alphas[iter_idx % len(self.alphas)],
+                                cost=cost)
+
+        results = [r for r in results if r is not None]
+        if not results:
+            return None
+        # Ties go to the lowest iteration, as in the serial solver
+        cost, iter_idx, compact = min(results, key=lambda r: (r[0], r[1]))
+        if self.verbose:
+            logger.info("Best solution found in iteration %s with alpha %s",
+                        iter_idx, self.alphas[iter_idx % len(self.alphas)])
+        # Compact solutions travel without the problem
+        compact.problem = self.problem
+        return compact.to_solution(self.d_center)
@@ -1,170 +1,317 @@
+import heapq
+import logging
+
+from compact import CompactSolution
 from models import City, LogisticCenterLocation, LogisticCenterType, Solution
 from models import (CapacityExceeded, CenterTooFar, CenterTooClose,
                     AlreadyPrimaryCenter, Infeasible)
+from models import FEASIBLE, CENTER_TOO_FAR
+import events
+import instrumentation
+from instrumentation import raised
+import kernel
 
-class GreedySolver:
-    def __init__(self, solution, d_center, debug=False):
-        self.cities = solution.cities
-        self.centers = solution.centers
-        self.types = solution.types
-        self.d_center = d_center
-        self.debug = debug
+logger = logging.getLogger(__name__)
+
+class Construction:
+    # Evaluation of the candidate centers of a city, shared by the greedy
+    # constructions (GreedySolver and GRASPSolver). Subclasses set problem,
+    # centers, d_center, debug and kernel (None for the one by one
+    # evaluation).
+    def cost_increment(self, c, l, primary=True, k=None):
+        # Returns the cost increment of serving c from l and the type l needs
+        # for it, or (None, None) if l can not serve c. Does not modify l.
+        # k is the distance class of the pair, computed if not given.
+        ladder = self.problem.ladder
+        if k is None:
+            k = ladder.distance_class(l.city_distance(c), secondary=not primary)
+        if k is None:
+            if self.debug:
+                logger.debug("Infeasible center because too far c(%s, %s) -> l(%s, %s)",
+                             c.x, c.y, l.x, l.y)
+            return None, None
+
+        if primary:
+            load = l.next_load_with_city_primary(c)
+        else:
+            if l.has_primary(c):
+                if self.debug:
+                    logger.debug("Infeasible center because already primary c(%s, %s) -> l(%s, %s)",
+                                 c.x, c.y, l.x, l.y)
+                # Secondary and primary centers must be different
+                return None, None
+            load = l.next_load_with_city_secondary(c)
 
-    def cost_and_update(self, c, l, primary=True):
-        # Returns cost increment
         if l.active:
             # The location is an actual logistic center
-            try:
-                if primary:
-                    l.check_city_primary(c)
-                else:
-                    l.check_city_secondary(c)
+            status = self.status(c, l, primary)
+            if status == FEASIBLE:
                 # No changes must be made in logistic centers
-                return 0
-            except CapacityExceeded:
-                # Try changing center type
-                initial_type = l.t
-                for t in self.types:
-                    if t.cap > l.t.cap:
-                        l.t = t
-                        try:
-                            if primary:
-                                l.check_city_primary(c)
-                            else:
-                                l.check_city_secondary(c)
-                            # Return the cost difference between the new type
-                            # and the previous type
-                            return t.cost - initial_type.cost
-                        except CapacityExceeded:
-                            l.t = initial_type
-                            continue
-                        except CenterTooFar:
-                            l.t = initial_type
-                            continue
-
-                if l.t.tid == initial_type.tid:
-                    # No feasible new center type
-                    if self.debug:
-                        print(f"Infeasible center because capacity c({c.x}, {c.y}) -> l({l.x, l.y})")
-                    raise Infeasible
-
-            except CenterTooFar:
+                return 0, l.t
+            if status == CENTER_TOO_FAR:
                 if self.debug:
-                    print(f"Infeasible center because too far c({c.x}, {c.y}) -> l({l.x, l.y})")
-                raise Infeasible
+                    logger.debug("Infeasible center because too far c(%s, %s) -> l(%s, %s)",
+                                 c.x, c.y, l.x, l.y)
+                return None, None
 
-            except AlreadyPrimaryCenter:
+            # Upgrade to the cheapest type with more capacity that fits, and
+            # still reaches the cities the center already serves
+            t = ladder.cheapest(max(k, l.served_class), load, above=l.t.cap)
+            if t is None:
                 if self.debug:
-                    print(f"Infeasible center because already primary c({c.x}, {c.y}) -> l({l.x, l.y})")
-                # Secondary and primary centers must be different
-                raise Infeasible
+                    logger.debug("Infeasible center because capacity c(%s, %s) -> l(%s, %s)",
+                                 c.x, c.y, l.x, l.y)
+                return None, None
+            # Return the cost difference between the new type and the
+            # previous type
+            return t.cost - l.t.cost, t
+
+        # The location does not have a logistic center yet
+        if l.activation_status(self.centers, self.d_center) != FEASIBLE:
+            # d_center not satisfied
+            if self.debug:
+                logger.debug("Infeasible center because too close to another center c(%s, %s) -> l(%s, %s)",
+                             c.x, c.y, l.x, l.y)
+            return None, None
+
+        # Pick the center type with the smallest cost that is feasible
+        t = ladder.cheapest(k, load)
+        if t is None:
+            if self.debug:
+                logger.debug("Infeasible new center because of capacity c(%s, %s) -> l(%s, %s)",
+                             c.x, c.y, l.x, l.y)
+            return None, None
+        return t.cost, t
+
+    def status(self, c, l, primary=True):
+        if primary:
+            status, _ = l.primary_status(c)
+        else:
+            status, _ = l.secondary_status(c)
+        return status
+
+    def cost_and_update(self, c, l, primary=True):
+        # Returns cost increment
+        cost, _ = self.cost_increment(c, l, primary)
+        if cost is None:
+            raise raised(Infeasible)
+        return cost
+
+    def candidate_costs(self, c, primary=True):
+        # (location, cost increment, type) of every location that can serve
+        # c, in candidate order
+        problem = self.problem
+        if self.kernel is not None:
+            return [(self.centers[li], cost, problem.types[ti])
+                    for li, cost, ti in self.kernel.costs(c.idx, primary)]
 
+        # Only locations close enough to the city can serve it
+        if primary:
+            candidates = zip(problem.candidates_primary[c.idx],
+                             problem.classes_primary[c.idx])
         else:
-            # The location does not have a logistic center yet
-            # Pick the center type with the smallest cost that is feasible
-            ordered_types = sorted(self.types, key=lambda x: x.cost)
-            for t in ordered_types:
-                try:
-                    if not primary and l.t is not None:
-                        continue
-                    l.activate(self.centers, self.d_center)
-                    l.t = t
-                    if primary:
-                        l.check_city_primary(c)
-                    else:
-                        l.check_city_secondary(c)
-                    l.active = False
-                    return t.cost
-
-                except CenterTooClose:
-                    # d_center not satisfied
-                    l.t = None
-                    l.active = False
-                    if self.debug:
-                        print(f"Infeasible center because too close to another center c({c.x}, {c.y}) -> l({l.x, l.y})")
-                    raise Infeasible
-
-                except CapacityExceeded:
-                    # City is too large for center type
-                    l.t = None
-                    l.active = False
+            candidates = zip(problem.candidates_secondary[c.idx],
+                             problem.classes_secondary[c.idx])
+        costs = []
+        for li, k in candidates:
+            l = self.centers[li]
+            cost, t = self.cost_increment(c, l, primary=primary, k=k)
+            if cost is not None:
+                costs.append((l, cost, t))
+        return costs
+
+
+class GreedySolver(Construction):
+    def __init__(self, solution, d_center, debug=False, batch=True):
+        self.cities = solution.cities
+        self.centers = solution.centers
+        self.problem = solution.problem
+        self.types = solution.types
+        self.d_center = d_center
+        self.debug = debug
+        # Evaluate the candidates of a city at once with NumPy (see
+        # kernel.py). The debug messages need the one by one evaluation.
+        self.kernel = None
+        if batch and kernel.np is not None and not debug:
+            self.kernel = kernel.CandidateKernel(self.problem, d_center)
+            self.kernel.reset(self.centers)
+
+    def assign(self, c):
+        # Serves c from its cheapest primary and secondary centers. Returns
+        # both locations.
+        problem = self.problem
+        costs_primary = self.candidate_costs(c, primary=True)
+        costs_secondary = self.candidate_costs(c, primary=False)
+
+        if instrumentation.ENABLED:
+            instrumentation.count("cities constructed")
+            instrumentation.count(
+                "candidates evaluated",
+                len(problem.candidates_primary[c.idx])
+                + len(problem.candidates_secondary[c.idx])
+                )
+
+        if len(costs_primary) == 0:
+            logger.warning("Can not assign a primary center to city (%s, %s)!",
+                           c.x, c.y)
+            raise raised(Infeasible)
+
+        if len(costs_secondary) == 0:
+            logger.warning("Can not assign a secondary center to city (%s, %s)!",
+                           c.x, c.y)
+            raise raised(Infeasible)
+
+        sorted_costs_p = sorted(costs_primary, key=lambda x: x[1])
+        sorted_costs_s = sorted(costs_secondary, key=lambda x: x[1])
+        primary_center_assigned, _, primary_type = sorted_costs_p[0]
+
+        logger.debug("City (%s, %s) assigned PC at (%s, %s). Type %s",
+                     c.x, c.y, primary_center_assigned.x,
+                     primary_center_assigned.y, primary_type.tid)
+        if not primary_center_assigned.active:
+            primary_center_assigned.activate(self.centers, self.d_center)
+        primary_center_assigned.set_type(primary_type)
+        primary_center_assigned.add_city_primary(c)
+        if self.kernel is not None:
+            self.kernel.sync(primary_center_assigned)
+        if events.ENABLED:
+            events.emit("assign", city=c.idx, role="primary",
+                        location=primary_center_assigned.idx,
+                        type=primary_type.tid)
+
+        secondary_center_assigned = None
+        for l, _, t in sorted_costs_s:
+            if l is primary_center_assigned:
+                # Secondary and primary centers must be different
+                continue
+            if not l.active:
+                if l.activation_status(self.centers, self.d_center) \
+                        != FEASIBLE:
+                    # Too close to the primary center just activated
                     continue
+                l.activate(self.centers, self.d_center)
+            l.set_type(t)
+            l.add_city_secondary(c)
+            if self.kernel is not None:
+                self.kernel.sync(l)
+            secondary_center_assigned = l
+            break
 
-                except CenterTooFar:
-                    # Center is too far from the city
-                    l.t = None
-                    l.active = False
-                    if self.debug:
-                        print(f"Infeasible center because too far from the city c({c.x}, {c.y}) -> l({l.x, l.y})")
-                    raise Infeasible
+        if secondary_center_assigned is None:
+            logger.warning("Can not assign a secondary center to city (%s, %s)!",
+                           c.x, c.y)
+            raise raised(Infeasible)
 
-            if l.t is None:
-                if self.debug:
-                    print(f"Infeasible new center because of capacity c({c.x}, {c.y}) -> l({l.x, l.y})")
-                raise Infeasible
-            else:
-                return l.cost
+        logger.debug("City (%s, %s) assigned SC at (%s, %s). Type %s",
+                     c.x, c.y, secondary_center_assigned.x,
+                     secondary_center_assigned.y,
+                     secondary_center_assigned.t.tid)
+        if events.ENABLED:
+            events.emit("assign", city=c.idx, role="secondary",
+                        location=secondary_center_assigned.idx,
+                        type=secondary_center_assigned.t.tid)
+        return primary_center_assigned, secondary_center_assigned
 
     def solve(self):
         for c in self.cities:
-            costs_primary = []
-            costs_secondary = []
-
-            # "clean" old type assignation
-            for l in self.centers:
-                if not l.active:
-                    l.t = None
-
-            for l in self.centers:
-                try:
-                    costs_primary.append(
-                        (l, self.cost_and_update(c, l, primary=True))
-                        )
-                except Infeasible:
-                    pass
-
-                try:
-                    costs_secondary.append(
-                        (l, self.cost_and_update(c, l, primary=False))
-                        )
-                except Infeasible:
-                    pass
-
-            if len(costs_primary) == 0:
-                print(f"Can not assign a primary center to city ({c.x}, {c.y})!")
-                raise Infeasible
-
-            if len(costs_secondary) == 0:
-                print(f"Can not assign a secondary center to city ({c.x}, {c.y})!")
-                raise Infeasible
-
-            sorted_costs_p = sorted(costs_primary, key=lambda x: x[1])
-            sorted_costs_s = sorted(costs_secondary, key=lambda x: x[1])
-            primary_center_assigned = sorted_costs_p[0][0]
-
-            print(f"City ({c.x}, {c.y}) assigned PC at ({primary_center_assigned.x},"
-                  f" {primary_center_assigned.y}). Type {primary_center_assigned.t.tid}")
-            if not primary_center_assigned.active:
-                primary_center_assigned.activate(self.centers, self.d_center)
-            primary_center_assigned.add_city_primary(c)
-
-            secondary_center_assigned = None
-            for sc in sorted_costs_s:
-                try:
-                    secondary_center_assigned = sc[0]
-                    if not secondary_center_assigned.active:
-                        secondary_center_assigned.activate(
-                            self.centers, self.d_center
-                            )
-                    secondary_center_assigned.add_city_secondary(c)
-                    break
-                except CenterTooClose:
-                    secondary_center_assigned.active = None
-                    continue
-                except AlreadyPrimaryCenter:
-                    continue
+            self.assign(c)
+
+        # The solver objects are not used again, and copying the linked
+        # cities and centers recurses too deep on large instances
+        return Solution(self.cities, self.centers, self.types, self.problem,
+                        deep_copy=False)
+
+
+class RegretGreedySolver(GreedySolver):
+    # Greedy that picks the next city instead of following the order of
+    # the cities list: roughly the one with the largest regret, the
+    # difference between its second best and its best primary cost
+    # increments. Cities with a single option come first, and ties go to
+    # the larger populations, which the fixed order may leave for when the
+    # centers are full.
+    #
+    # The regrets live in a heap. Assigning a city only changes the costs
+    # of the cities with a candidate among the locations it used (or, when
+    # a location opens, among its conflicts), so those are marked stale
+    # instead of evaluated again. A stale entry reaching the top is
+    # evaluated and pushed back, and the city is assigned once its entry is
+    # both fresh and on top. The order is only approximately the regret
+    # order: a stale entry keeps the place of its old regret until it
+    # reaches the top, so a city whose regret grew can be passed by a fresh
+    # entry with a smaller one.
+    #
+    # The regret order can fill the centers so that a later city has no
+    # primary or secondary center left. The solution is then built again
+    # in the order of the cities list, as GreedySolver does.
+    def __init__(self, solution, d_center, debug=False, batch=True):
+        super().__init__(solution, d_center, debug=debug, batch=batch)
+        self.conflicts = self.problem.conflicts(d_center)
+        # Cities that have each location among their primary or secondary
+        # candidates, by location
+        self.cities_near = [[] for _ in range(self.problem.n_locations)]
+        for c in self.cities:
+            near = set(self.problem.candidates_primary[c.idx])
+            near.update(self.problem.candidates_secondary[c.idx])
+            for li in near:
+                self.cities_near[li].append(c.idx)
+
+    def regret(self, c):
+        costs = sorted(cost for _, cost, _ in
+                       self.candidate_costs(c, primary=True))
+        if len(costs) < 2:
+            # Assigned first, or found infeasible first
+            return float("inf")
+        return costs[1] - costs[0]
+
+    def entry(self, c):
+        return (-self.regret(c), -c.population, c.idx)
+
+    def solve(self):
+        # Copy of the initial solution for the fallback to the list order
+        initial = CompactSolution.from_solution(
+            Solution(self.cities, self.centers, self.types, self.problem,
+                     deep_copy=False))
+        try:
+            return self.solve_regret()
+        except Infeasible:
+            logger.warning("Regret order infeasible, building the greedy "
+                           "solution in the order of the cities")
+            if instrumentation.ENABLED:
+                instrumentation.count("regret fallbacks")
+            return GreedySolver(initial.to_solution(self.d_center),
+                                self.d_center, debug=self.debug,
+                                batch=self.kernel is not None).solve()
+
+    def solve_regret(self):
+        heap = [self.entry(c) for c in self.cities]
+        heapq.heapify(heap)
+        assigned = set()
+        stale = set()
+        while heap:
+            _, _, ci = heapq.heappop(heap)
+            if ci in assigned:
+                continue
+            c = self.cities[ci]
+            if ci in stale:
+                stale.discard(ci)
+                heapq.heappush(heap, self.entry(c))
+                if instrumentation.ENABLED:
+                    instrumentation.count("regret evaluations")
+                continue
+
+            near = set(self.problem.candidates_primary[ci])
+            near.update(self.problem.candidates_secondary[ci])
+            was_active = {li: self.centers[li].active for li in near}
+            primary, secondary = self.assign(c)
+            assigned.add(ci)
 
-            print(f"City ({c.x}, {c.y}) assigned SC at ({secondary_center_assigned.x},"
-                  f" {secondary_center_assigned.y}). Type {secondary_center_assigned.t.tid}")
+            changed = {primary.idx, secondary.idx}
+            for li in (primary.idx, secondary.idx):
+                if not was_active[li]:
+                    changed.update(self.conflicts[li])
+            for li in changed:
+                stale.update(self.cities_near[li])
+            stale -= assigned
 
-        return Solution(self.cities, self.centers, self.types)
+        return Solution(self.cities, self.centers, self.types, self.problem,
+                        deep_copy=False)
@@ -0,0 +1,288 @@
+import csv
+import hashlib
+import json
+import os
+import pickle
+import re
+
+from models import City, LogisticCenterLocation, LogisticCenterType
+from problem import Problem
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Instance fields, named as in the OPL .dat files
+FIELDS = ("posCities", "population_city", "posLocations",
+          "working_distance_center", "capacity_center", "cost_center",
+          "d_center")
+
+# Bump when the cached data changes, so old caches are not used
+CACHE_VERSION = 2
+
+CACHE_DIR = ".instance_cache"
+
+
+# ---- PARSERS ----
+# Every parser returns a dict with the FIELDS
+_DAT_TOKEN = re.compile(r"\[|\]|[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?")
+
+def _number(token):
+    if re.fullmatch(r"[-+]?\d+", token):
+        return int(token)
+    return float(token)
+
+def _dat_value(text):
+    # Scalars or (nested) arrays, with or without commas between elements
+    stack = [[]]
+    for token in _DAT_TOKEN.findall(text):
+        if token == "[":
+            stack.append([])
+        elif token == "]":
+            array = stack.pop()
+            stack[-1].append(array)
+        else:
+            stack[-1].append(_number(token))
+    if len(stack) != 1 or len(stack[0]) != 1:
+        raise ValueError(f"Can not parse value '{text.strip()}'")
+    return stack[0][0]
+
+def read_dat(path):
+    with open(path) as f:
+        text = f.read()
+    text = re.sub(r"/\*.*?\*/", " ", text, flags=re.S)
+    text = re.sub(r"//[^\n]*", " ", text)
+    data = {}
+    for statement in text.split(";"):
+        if "=" not in statement:
+            continue
+        name, value = statement.split("=", 1)
+        name = name.strip()
+        if name in FIELDS:
+            data[name] = _dat_value(value)
+    return data
+
+def read_json(path):
+    with open(path) as f:
+        return json.load(f)
+
+def read_csv(path):
+    # One record per row:
+    #   city,x,y,population
+    #   location,x,y
+    #   type,working_distance,capacity,cost
+    #   d_center,value
+    # Empty rows and rows starting with # are skipped.
+    data = {name: [] for name in FIELDS if name != "d_center"}
+    with open(path, newline="") as f:
+        for row in csv.reader(f):
+            if not row or row[0].strip().startswith("#"):
+                continue
+            kind = row[0].strip()
+            values = [_number(v.strip()) for v in row[1:]]
+            if kind == "city":
+                data["posCities"].append(values[:2])
+                data["population_city"].append(values[2])
+            elif kind == "location":
+                data["posLocations"].append(values[:2])
+            elif kind == "type":
+                data["working_distance_center"].append(values[0])
+                data["capacity_center"].append(values[1])
+                data["cost_center"].append(values[2])
+            elif kind == "d_center":
+                data["d_center"] = values[0]
+            else:
+                raise ValueError(f"Unknown record '{kind}' in {path}")
+    return data
+
+READERS = {
+    ".dat": read_dat,
+    ".json": read_json,
+    ".csv": read_csv,
+}
+
+
+# ---- WRITERS ----
+def _fields(cities, centers, types, d_center):
+    return {
+        "posCities": [list(c.coordinates) for c in cities],
+        "population_city": [c.population for c in cities],
+        "posLocations": [list(l.coordinates) for l in centers],
+        "working_distance_center": [t.working_d for t in types],
+        "capacity_center": [t.cap for t in types],
+        "cost_center": [t.cost for t in types],
+        "d_center": d_center,
+        }
+
+def _dat_format(value):
+    if isinstance(value, list):
+        return "[" + " ".join(_dat_format(v) for v in value) + "]"
+    return repr(value)
+
+def write_dat(path, data):
+    with open(path, "w") as f:
+        for name in FIELDS:
+            f.write(f"{name} = {_dat_format(data[name])};\n")
+
+def write_json(path, data):
+    with open(path, "w") as f:
+        json.dump(data, f)
+
+def write_csv(path, data):
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        for (x, y), population in zip(data["posCities"],
+                                      data["population_city"]):
+            writer.writerow(["city", x, y, population])
+        for x, y in data["posLocations"]:
+            writer.writerow(["location", x, y])
+        for row in zip(data["working_distance_center"],
+                       data["capacity_center"], data["cost_center"]):
+            writer.writerow(["type", *row])
+        writer.writerow(["d_center", data["d_center"]])
+
+WRITERS = {
+    ".dat": write_dat,
+    ".json": write_json,
+    ".csv": write_csv,
+}
+
+def save_instance(path, cities, centers, types, d_center):
+    # Type ids are not saved, loading numbers the types from 1 in order
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in WRITERS:
+        raise ValueError(f"Unknown instance format '{extension}', expected "
+                         f"one of {', '.join(sorted(WRITERS))}")
+    WRITERS[extension](path, _fields(cities, centers, types, d_center))
+
+
+# ---- MODELS ----
+def build(data, source="instance"):
+    # Model objects from the FIELDS
+    for name in FIELDS:
+        if name not in data:
+            raise ValueError(f"{source} has no {name}")
+
+    cities = [
+        City(x, y, population)
+        for (x, y), population in zip(data["posCities"],
+                                      data["population_city"])
+        ]
+    centers = [LogisticCenterLocation(x, y) for x, y in data["posLocations"]]
+    types = [
+        LogisticCenterType(tid, cap, working_d, cost)
+        for tid, (working_d, cap, cost) in enumerate(
+            zip(data["working_distance_center"], data["capacity_center"],
+                data["cost_center"]),
+            start=1)
+        ]
+    return cities, centers, types, data["d_center"]
+
+
+# ---- CACHE ----
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def cache_path(path, cache_dir=None):
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(os.path.abspath(path)),
+                                 CACHE_DIR)
+    key = f"{file_hash(path)[:16]}-v{CACHE_VERSION}"
+    extension = ".npz" if np is not None else ".pickle"
+    return os.path.join(cache_dir,
+                        f"{os.path.basename(path)}-{key}{extension}")
+
+def _pack(lists, dtype="int64"):
+    # Ragged list of lists as a flat array (of dtype) and offsets
+    offsets = [0]
+    for l in lists:
+        offsets.append(offsets[-1] + len(l))
+    flat = [x for l in lists for x in l]
+    return np.asarray(flat, dtype=dtype), np.asarray(offsets, dtype=np.int64)
+
+def _unpack(flat, offsets):
+    flat = flat.tolist()
+    offsets = offsets.tolist()
+    return [flat[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)]
+
+RAGGED = ("candidates_primary", "candidates_secondary", "classes_primary",
+          "classes_secondary")
+
+def _cache_content(cities, centers, types, d_center, problem):
+    content = _fields(cities, centers, types, d_center)
+    content.update(problem.precomputed())
+    return content
+
+def save_cache(path, cities, centers, types, d_center, problem):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    content = _cache_content(cities, centers, types, d_center, problem)
+    tmp_path = path + ".tmp"
+    if np is None:
+        with open(tmp_path, "wb") as f:
+            pickle.dump(content, f, protocol=pickle.HIGHEST_PROTOCOL)
+    else:
+        arrays = {}
+        for name in FIELDS:
+            arrays[name] = np.asarray(content[name])
+        arrays["distances_secondary"], arrays["distances_secondary_offsets"] \
+            = _pack(content["distances_secondary"], dtype=float)
+        for name in RAGGED:
+            arrays[name], arrays[name + "_offsets"] = _pack(content[name])
+        conflicts = content["conflicts"].get(d_center)
+        if conflicts is not None:
+            arrays["conflicts"], arrays["conflicts_offsets"] = _pack(conflicts)
+        with open(tmp_path, "wb") as f:
+            np.savez(f, **arrays)
+    # Never leave a half written cache behind
+    os.replace(tmp_path, path)
+
+def load_cache(path):
+    if np is None:
+        with open(path, "rb") as f:
+            content = pickle.load(f)
+    else:
+        with np.load(path, allow_pickle=False) as arrays:
+            content = {name: arrays[name].tolist() for name in FIELDS}
+            content["distances_secondary"] = _unpack(
+                arrays["distances_secondary"],
+                arrays["distances_secondary_offsets"])
+            for name in RAGGED:
+                content[name] = _unpack(arrays[name],
+                                        arrays[name + "_offsets"])
+            content["conflicts"] = {}
+            if "conflicts" in arrays:
+                content["conflicts"][content["d_center"]] = _unpack(
+                    arrays["conflicts"], arrays["conflicts_offsets"])
+
+    cities, centers, types, d_center = build(content, path)
+    problem = Problem.from_precomputed(cities, centers, types, d_center,
+                                       content)
+    return cities, centers, types, d_center, problem
+
+
+# ---- LOADING ----
+def load_instance(path, cache=True, cache_dir=None):
+    # Returns cities, centers, types, d_center and the Problem built on them.
+    # With cache, parsing and precomputation are skipped when the same file
+    # was already loaded.
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in READERS:
+        raise ValueError(f"Unknown instance format '{extension}', expected "
+                         f"one of {', '.join(sorted(READERS))}")
+
+    cached = cache_path(path, cache_dir) if cache else None
+    if cached is not None and os.path.exists(cached):
+        return load_cache(cached)
+
+    cities, centers, types, d_center = build(READERS[extension](path), path)
+    problem = Problem(cities, centers, types, d_center)
+    if cached is not None:
+        # Computed now so it is cached too
+        problem.conflicts(d_center)
+        save_cache(cached, cities, centers, types, d_center, problem)
+    return cities, centers, types, d_center, problem
@@ -0,0 +1,67 @@
+import collections
+import contextlib
+import time
+
+# When set, the solvers count their work. Every counting site checks this
+# flag first, so disabled instrumentation costs one global lookup.
+ENABLED = False
+
+counters = collections.Counter()
+# Accumulated wall time and number of calls of every timer
+timers = collections.defaultdict(float)
+timer_calls = collections.Counter()
+
+
+def count(name, n=1):
+    counters[name] += n
+
+def raised(exception):
+    # Counts an exception about to be raised, use as `raise raised(E)`
+    if ENABLED:
+        counters[f"raised {exception.__name__}"] += 1
+    return exception
+
+@contextlib.contextmanager
+def timer(name):
+    if not ENABLED:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timers[name] += time.perf_counter() - start
+        timer_calls[name] += 1
+
+def reset():
+    counters.clear()
+    timers.clear()
+    timer_calls.clear()
+
+def snapshot():
+    # Plain data, to send the counts of a worker process back
+    return dict(counters), dict(timers), dict(timer_calls)
+
+def merge(state):
+    worker_counters, worker_timers, worker_calls = state
+    counters.update(worker_counters)
+    for name, elapsed in worker_timers.items():
+        timers[name] += elapsed
+    timer_calls.update(worker_calls)
+
+def summary():
+    lines = ["----- PROFILE -----"]
+    if timers:
+        lines.append(f"{'timer':<44} {'calls':>10} {'seconds':>12}")
+        for name, elapsed in sorted(timers.items()):
+            lines.append(f"{name:<44} {timer_calls[name]:>10} "
+                         f"{elapsed:>12.6f}")
+    if counters:
+        lines.append(f"{'counter':<44} {'count':>10}")
+        for name, value in sorted(counters.items()):
+            lines.append(f"{name:<44} {value:>10}")
+    cities = counters.get("cities constructed")
+    if cities:
+        per_city = counters.get("candidates evaluated", 0) / cities
+        lines.append(f"{'candidates evaluated per city':<44} {per_city:>10.2f}")
+    return "\n".join(lines)
@@ -0,0 +1,155 @@
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+class CandidateKernel:
+    # Batched version of the solvers cost_increment: for one city, the cost
+    # increment of serving it from every candidate location in a few NumPy
+    # operations. The state of the locations lives in arrays (active flag,
+    # type index, primary and secondary population, largest distance class
+    # served, active conflicts) that the solver keeps in sync by calling sync
+    # after modifying a location.
+    #
+    # Same rules as cost_increment, for the pair (city, location):
+    #   active, type reaches the city and has room    0, same type
+    #   active, type does not reach the city          infeasible
+    #   active, type reaches it but has no room       upgrade to the cheapest
+    #                                                 type with more capacity
+    #                                                 that fits and reaches it
+    #                                                 and the served cities
+    #   inactive, conflicts with an active center     infeasible
+    #   inactive                                      cheapest fitting type
+    # It does not know about the city being already served by the location,
+    # which the constructions never ask for.
+    #
+    # Requires NumPy; the solvers fall back to cost_increment without it.
+    def __init__(self, problem, d_center):
+        self.problem = problem
+        self.conflicts = [np.asarray(c, dtype=np.int64)
+                          for c in problem.conflicts(d_center)]
+        types = problem.types
+        self.type_index = {t.tid: ti for ti, t in enumerate(types)}
+        self.cost = np.asarray([t.cost for t in types])
+        self.cap = np.asarray([t.cap for t in types], dtype=float)
+        # Largest distance class every type reaches (see TypeLadder)
+        working_d = problem.ladder.working_d
+        self.rank = np.asarray([
+            np.searchsorted(working_d, t.working_d, side="right") - 1
+            for t in types
+            ])
+        # TypeLadder.classes as two tables with a row per distance class:
+        # the capacities in increasing order (padded with infinity) and the
+        # cheapest type index from every capacity up (-1 past the end). An
+        # extra last row, for unreachable pairs, has no types.
+        self.n_classes = len(problem.ladder.classes)
+        n_types = len(types)
+        self.caps = np.full((self.n_classes + 1, n_types), np.inf)
+        self.cheapest_types = np.full((self.n_classes + 1, n_types + 1), -1,
+                                      dtype=np.int64)
+        for k, (caps, cheapest) in enumerate(problem.ladder.classes):
+            self.caps[k, :len(caps)] = caps
+            self.cheapest_types[k, :len(cheapest)] = [
+                self.type_index[t.tid] for t in cheapest
+                ]
+
+        # Candidates and distance classes of every city, None classes
+        # (unreachable) mapped to n_classes
+        def classes(ks):
+            return np.asarray([self.n_classes if k is None else k for k in ks],
+                              dtype=np.int64)
+        self.candidates_primary = [np.asarray(c, dtype=np.int64)
+                                   for c in problem.candidates_primary]
+        self.candidates_secondary = [np.asarray(c, dtype=np.int64)
+                                     for c in problem.candidates_secondary]
+        self.classes_primary = [classes(k) for k in problem.classes_primary]
+        self.classes_secondary = [classes(k)
+                                  for k in problem.classes_secondary]
+
+        n_locations = problem.n_locations
+        self.active = np.zeros(n_locations, dtype=bool)
+        self.type = np.zeros(n_locations, dtype=np.int64)
+        self.population_primary = np.zeros(n_locations)
+        self.population_secondary = np.zeros(n_locations)
+        self.served_class = np.full(n_locations, -1, dtype=np.int64)
+        self.active_conflicts = np.zeros(n_locations, dtype=np.int64)
+
+    def reset(self, centers):
+        # Takes the state of the location objects
+        for l in centers:
+            self.read(l)
+            self.active_conflicts[l.idx] = l.active_conflicts
+
+    def read(self, l):
+        li = l.idx
+        self.active[li] = l.active
+        self.type[li] = self.type_index[l.t.tid] if l.active else 0
+        self.population_primary[li] = l.population_primary
+        self.population_secondary[li] = l.population_secondary
+        self.served_class[li] = l.served_class
+
+    def sync(self, l):
+        # Call after activating l, changing its type or its cities
+        if l.active and not self.active[l.idx]:
+            self.active_conflicts[self.conflicts[l.idx]] += 1
+        elif not l.active and self.active[l.idx]:
+            self.active_conflicts[self.conflicts[l.idx]] -= 1
+        self.read(l)
+
+    def cheapest(self, k, load, above=None):
+        # Vectorized TypeLadder.cheapest, -1 where no type fits. Counting
+        # the capacities below load is the bisection of the ladder.
+        caps = self.caps[k]
+        i = (caps < load[:, None]).sum(axis=1)
+        if above is not None:
+            i = np.maximum(i, (caps <= above[:, None]).sum(axis=1))
+        return self.cheapest_types[k, i]
+
+    def costs(self, ci, primary=True):
+        # Candidate locations that can serve city ci, their cost increments
+        # and the type each one needs, as (li, cost, type index) in
+        # candidate order
+        population = self.problem.populations[ci]
+        if primary:
+            li = self.candidates_primary[ci]
+            k = self.classes_primary[ci]
+            load = self.population_primary[li] \
+                + 0.1 * self.population_secondary[li] + population
+        else:
+            li = self.candidates_secondary[ci]
+            k = self.classes_secondary[ci]
+            load = self.population_primary[li] \
+                + 0.1 * (self.population_secondary[li] + population)
+
+        active = self.active[li]
+        current = self.type[li]
+        reaches = k <= self.rank[current]
+        fits = load <= self.cap[current]
+
+        t = np.full(len(li), -1, dtype=np.int64)
+        cost = np.zeros(len(li), dtype=self.cost.dtype)
+        # Active with room: nothing changes
+        keep = active & reaches & fits
+        t[keep] = current[keep]
+        # Active without room: upgrade
+        upgrade = active & reaches & ~fits
+        if upgrade.any():
+            served = np.maximum(k[upgrade], self.served_class[li[upgrade]])
+            new = self.cheapest(served, load[upgrade],
+                                above=self.cap[current[upgrade]])
+            t[upgrade] = new
+            cost[upgrade] = np.where(
+                new >= 0, self.cost[np.maximum(new, 0)]
+                - self.cost[current[upgrade]], 0)
+        # Inactive and free of conflicts: open the cheapest type
+        opening = ~active & (self.active_conflicts[li] == 0)
+        if opening.any():
+            new = self.cheapest(k[opening], load[opening])
+            t[opening] = new
+            cost[opening] = np.where(new >= 0,
+                                     self.cost[np.maximum(new, 0)], 0)
+
+        feasible = np.flatnonzero(t >= 0)
+        return list(zip(li[feasible].tolist(), cost[feasible].tolist(),
+                        t[feasible].tolist()))
@@ -1,22 +1,45 @@
+import logging
+import time
+
 from models import City, LogisticCenterLocation, LogisticCenterType, Solution
 from models import (CapacityExceeded, CenterTooFar, CenterTooClose,
                     AlreadyPrimaryCenter, AlreadySecondaryCenter, Infeasible)
+from models import FEASIBLE
+import events
+import instrumentation
+
+logger = logging.getLogger(__name__)
 
 class LocalSearchSolver:
-    def __init__(self, solution, d_center):
+    # deadline, a time.time() value, stops the passes before the next
+    # center. Every move keeps the solution feasible.
+    def __init__(self, solution, d_center, deadline=None):
         self.cities = solution.cities
         self.centers = solution.centers
-        self.types = sorted(solution.types, key=lambda x: x.cost)
+        self.problem = solution.problem
+        # Running cost of the solution, updated by set_type
+        self.objective = solution.objective
+        self.types = self.problem.ladder.by_cost
         self.d_center = d_center
+        self.deadline = deadline
+        self.interrupted = False
+
+    def expired(self):
+        if self.deadline is not None and time.time() >= self.deadline:
+            self.interrupted = True
+        return self.interrupted
 
     def solve(self):
         iterations = 5
         while iterations > 0:
             for idx, l in enumerate(self.centers):
+                if self.expired():
+                    break
                 if not l.active:
                     continue
 
-                for c in l.cities_primary:
+                # Moving a city removes it from l, iterate over a copy
+                for c in list(l.cities_primary.values()):
                     # Check the cost improvement by downgrading the center and 
                     # removing the city. self.types is ordered by cost
                     original_t = l.t
@@ -34,44 +57,54 @@ class LocalSearchSolver:
                     else:
                         # Can downgrade the center yay :D
                         # Check if the city can be assigned to another center
-                        for l2 in self.centers:
-                            if l == l2 or not l2.active:
-                                continue
-                            try:
-                                # Remove the city from the old logistic center
-                                # (l) and add it to the new (l2). Update the old
-                                # logistic center type
-                                l2.add_city_primary(c)
-                                print(f"Downgrading center {l.coordinates} from"
-                                      f" type {l.t.tid} to {next_t.tid}")
-                                print(f"Changing city ({c.coordinates}) primary"
-                                      f" center from {l.coordinates} to "
-                                      f"{l2.coordinates}")
-
-                                # Make sure PC is updated in cities object
-                                for cidx, c2 in enumerate(self.cities):
-                                    if c2 == c:
-                                        self.cities[cidx].pc = l2
-
-                                self.centers[idx].cities_primary = [
-                                    x for x in l.cities_primary if x != c
-                                    ]
-                                self.centers[idx].t = next_t
-                                break
-
-                            except CenterTooFar:
+                        for li in self.problem.candidates_primary[c.idx]:
+                            l2 = self.centers[li]
+                            if l is l2 or not l2.active:
                                 continue
-                            except CapacityExceeded:
+                            if l2.has_secondary(c):
                                 continue
-                            except AlreadySecondaryCenter:
+                            if instrumentation.ENABLED:
+                                instrumentation.count(
+                                    "ls moves evaluated reassign_primary")
+                            status, _ = l2.primary_status(c)
+                            if status != FEASIBLE:
                                 continue
+                            if instrumentation.ENABLED:
+                                instrumentation.count(
+                                    "ls moves applied reassign_primary")
+                            # Remove the city from the old logistic center
+                            # (l) and add it to the new (l2). Update the old
+                            # logistic center type
+                            l2.assign_city_primary(c)
+                            logger.debug("Downgrading center %s from type %s"
+                                         " to %s", l.coordinates, l.t.tid,
+                                         next_t.tid)
+                            logger.debug("Changing city %s primary center"
+                                         " from %s to %s", c.coordinates,
+                                         l.coordinates, l2.coordinates)
+
+                            # assign_city_primary already pointed the city to
+                            # l2
+                            self.centers[idx].remove_city_primary(c)
+                            delta = self.centers[idx].set_type(next_t)
+                            logger.debug("Cost %s (%+g)", self.objective.total,
+                                         delta)
+                            if events.ENABLED:
+                                events.emit("move", kind="reassign_primary",
+                                            city=c.idx, source=l.idx,
+                                            target=l2.idx,
+                                            type=next_t.tid, delta=delta,
+                                            cost=self.objective.total)
+                            break
 
             # Same but with secondary cities
             for idx, l in enumerate(self.centers):
+                if self.expired():
+                    break
                 if not l.active:
                     continue
 
-                for c in l.cities_secondary:
+                for c in list(l.cities_secondary.values()):
                     # Check the cost improvement by downgrading the center and 
                     # removing the city. self.types is ordered by cost
                     original_t = l.t
@@ -89,36 +122,46 @@ class LocalSearchSolver:
                     else:
                         # Can downgrade the center yay :D
                         # Check if the city can be assigned to another center
-                        for l2 in self.centers:
-                            if l == l2 or not l2.active:
-                                continue
-                            try:
-                                # Remove the city from the old logistic center
-                                # (l) and add it to the new (l2). Update the old
-                                # logistic center type
-                                l2.add_city_secondary(c)
-                                print(f"Downgrading center {l.coordinates} from"
-                                      f" type {l.t.tid} to {next_t.tid}")
-                                print(f"Changing city ({c.coordinates}) secondary"
-                                      f" center from {l.coordinates} to "
-                                      f"{l2.coordinates}")
-
-                                # Make sure PC is updated in cities object
-                                for cidx, c2 in enumerate(self.cities):
-                                    if c2 == c:
-                                        self.cities[cidx].pc = l2
-
-                                self.centers[idx].cities_secondary = [
-                                    x for x in l.cities_secondary if x != c
-                                    ]
-                                self.centers[idx].t = next_t
-                                break
-
-                            except CenterTooFar:
+                        for li in self.problem.candidates_secondary[c.idx]:
+                            l2 = self.centers[li]
+                            if l is l2 or not l2.active:
                                 continue
-                            except CapacityExceeded:
-                                continue
-                            except AlreadyPrimaryCenter:
+                            if instrumentation.ENABLED:
+                                instrumentation.count(
+                                    "ls moves evaluated reassign_secondary")
+                            status, _ = l2.secondary_status(c)
+                            if status != FEASIBLE:
                                 continue
+                            if instrumentation.ENABLED:
+                                instrumentation.count(
+                                    "ls moves applied reassign_secondary")
+                            # Remove the city from the old logistic center
+                            # (l) and add it to the new (l2). Update the old
+                            # logistic center type
+                            l2.assign_city_secondary(c)
+                            logger.debug("Downgrading center %s from type %s"
+                                         " to %s", l.coordinates, l.t.tid,
+                                         next_t.tid)
+                            logger.debug("Changing city %s secondary center"
+                                         " from %s to %s", c.coordinates,
+                                         l.coordinates, l2.coordinates)
+
+                            # assign_city_secondary already pointed the city to
+                            # l2
+                            self.centers[idx].remove_city_secondary(c)
+                            delta = self.centers[idx].set_type(next_t)
+                            logger.debug("Cost %s (%+g)", self.objective.total,
+                                         delta)
+                            if events.ENABLED:
+                                events.emit("move", kind="reassign_secondary",
+                                            city=c.idx, source=l.idx,
+                                            target=l2.idx,
+                                            type=next_t.tid, delta=delta,
+                                            cost=self.objective.total)
+                            break
             iterations -= 1
-        return Solution(self.cities, self.centers, self.types)
+            if self.interrupted:
+                break
+        # Same objects, see GreedySolver.solve
+        return Solution(self.cities, self.centers, self.types, self.problem,
+                        deep_copy=False)
@@ -0,0 +1,294 @@
+import bisect
+import logging
+import math
+
+import events
+import instrumentation
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+logger = logging.getLogger(__name__)
+
+
+def gap(cost, bound):
+    # Relative optimality gap of a solution cost against a lower bound
+    if bound is None or cost is None:
+        return None
+    if cost <= 0:
+        return 0.0
+    return max(0.0, (cost - bound) / cost)
+
+def target_cost(bound, target_gap):
+    # Largest cost whose gap against bound is at most target_gap
+    if bound is None or target_gap is None:
+        return None
+    if target_gap >= 1:
+        return math.inf
+    return bound / (1 - target_gap)
+
+def format_gap(cost, bound):
+    return f"gap {100 * gap(cost, bound):.2f}% to lower bound {bound:g}"
+
+
+class LagrangianBound:
+    # Lower bound on the cost of any feasible solution, from a Lagrangian
+    # relaxation. With y[l, t] the choice of type t at location l and
+    # x[c, l] / z[c, l] the primary / secondary assignments, the constraints
+    # "every city has one primary center" and "every city has one secondary
+    # center" are relaxed with multipliers u[c] and v[c]:
+    #
+    #   L(u, v) = sum(u) + sum(v)
+    #             + sum over l of min(0, min over t of cost_t - value(l, t))
+    #
+    # where value(l, t) is the most a center of type t at l can collect from
+    # the cities it reaches: u[c] per city served as primary (load pop[c])
+    # and v[c] per city served as secondary (load 0.1 pop[c]), within the
+    # capacity of t. Dropping the d_center distances, the primary !=
+    # secondary rule and integrality of the knapsack only makes the bound
+    # weaker, so value is a fractional knapsack solved greedily by
+    # value / load. Every L(u, v) is a valid lower bound; the subgradient
+    # method searches for the largest one.
+    #
+    # upper_bound, the cost of a known solution, sets the Polyak step
+    # target and proves optimality when reached. Without it the target is
+    # a little above the best bound so far. The loop stops after iterations
+    # subgradient steps, when the step size vanishes, or when the gap
+    # against upper_bound is at most target_gap.
+    def __init__(self, problem, upper_bound=None, iterations=300,
+                 target_gap=None, step=2.0, patience=10, verbose=True):
+        self.problem = problem
+        self.upper_bound = upper_bound
+        self.iterations = iterations
+        self.target_gap = target_gap
+        self.step = step
+        # Iterations without improvement before halving the step
+        self.patience = patience
+        self.verbose = verbose
+        self.bound = None
+        self.iterations_run = 0
+
+        # Position of every type among the types sorted by working distance,
+        # tied types taking the last position of the tie: a type can serve
+        # a pair of distance class k (see TypeLadder) if its rank is >= k
+        working_d = problem.ladder.working_d
+        types = problem.types
+        self.ranks = [bisect.bisect_right(working_d, t.working_d) - 1
+                      for t in types]
+        self.costs = [t.cost for t in types]
+        self.caps = [t.cap for t in types]
+        self.integral = all(float(c).is_integer() for c in self.costs)
+
+        # Knapsack items: every candidate (city, location) pair, as primary
+        # and as secondary
+        populations = problem.populations
+        self.item_location = []
+        self.item_city = []
+        self.item_primary = []
+        self.item_class = []
+        self.item_load = []
+        for ci in range(problem.n_cities):
+            for li, k in zip(problem.candidates_primary[ci],
+                             problem.classes_primary[ci]):
+                self._add_item(ci, li, True, k, populations[ci])
+            for li, k in zip(problem.candidates_secondary[ci],
+                             problem.classes_secondary[ci]):
+                self._add_item(ci, li, False, k, 0.1 * populations[ci])
+
+    def _add_item(self, ci, li, primary, k, load):
+        if k is None:
+            return
+        self.item_location.append(li)
+        self.item_city.append(ci)
+        self.item_primary.append(primary)
+        self.item_class.append(k)
+        self.item_load.append(load)
+
+    def initial_multipliers(self):
+        # The cheapest cost per unit of load, times the load of the city
+        unit = min([c / cap for c, cap in zip(self.costs, self.caps)
+                    if cap > 0], default=0)
+        u = [unit * p for p in self.problem.populations]
+        v = [0.1 * unit * p for p in self.problem.populations]
+        return u, v
+
+    def finish(self, value):
+        # With integer costs, so is the cost of every solution
+        if self.integral:
+            return math.ceil(value - 1e-6)
+        return value
+
+    def solve(self):
+        if np is not None:
+            evaluate = self.evaluate_numpy
+            u, v = (np.asarray(m, dtype=float)
+                    for m in self.initial_multipliers())
+        else:
+            evaluate = self.evaluate
+            u, v = self.initial_multipliers()
+
+        best = -math.inf
+        step = self.step
+        stalled = 0
+        for iteration in range(self.iterations):
+            self.iterations_run = iteration + 1
+            value, g_u, g_v = evaluate(u, v)
+            if instrumentation.ENABLED:
+                instrumentation.count("lagrangian iterations")
+            if value > best + 1e-9:
+                best = value
+                stalled = 0
+                if events.ENABLED:
+                    events.emit("bound", iteration=iteration, bound=value)
+            else:
+                stalled += 1
+                if stalled >= self.patience:
+                    step /= 2
+                    stalled = 0
+            if self.verbose and iteration % 10 == 0:
+                logger.info("Lagrangian iteration %s, bound %s, step %s",
+                            iteration, best, step)
+
+            if self.upper_bound is not None:
+                if best >= self.upper_bound - 1e-9 or (
+                        self.target_gap is not None and
+                        gap(self.upper_bound, self.finish(best))
+                        <= self.target_gap):
+                    break
+            if np is not None:
+                norm = float(g_u @ g_u + g_v @ g_v)
+            else:
+                norm = sum(g * g for g in g_u) + sum(g * g for g in g_v)
+            if norm == 0 or step < 1e-4:
+                # The relaxed assignments are feasible, or the steps do not
+                # move the multipliers anymore
+                break
+
+            if self.upper_bound is not None:
+                target = self.upper_bound
+            else:
+                target = best + 0.05 * max(abs(best), 1)
+            t = step * (target - value) / norm
+            if np is not None:
+                u = u + t * g_u
+                v = v + t * g_v
+            else:
+                u = [a + t * g for a, g in zip(u, g_u)]
+                v = [a + t * g for a, g in zip(v, g_v)]
+
+        self.bound = self.finish(max(best, 0))
+        if self.verbose:
+            logger.info("Lagrangian lower bound %s after %s iterations",
+                        self.bound, self.iterations_run)
+        return self.bound
+
+    # ---- EVALUATION ----
+    # Both return L(u, v) and its subgradient: 1 minus the (fractional)
+    # number of primary and secondary centers every city gets.
+    def evaluate_numpy(self, u, v):
+        if not hasattr(self, "_arrays"):
+            self._arrays = (
+                np.asarray(self.item_location, dtype=np.int64),
+                np.asarray(self.item_city, dtype=np.int64),
+                np.asarray(self.item_primary, dtype=bool),
+                np.asarray(self.item_class, dtype=np.int64),
+                np.asarray(self.item_load, dtype=float),
+                )
+        location, city, primary, k, load = self._arrays
+        n_locations = self.problem.n_locations
+        n_cities = self.problem.n_cities
+
+        value = np.where(primary, u[city], v[city])
+        keep = value > 0
+        location, city, primary, k, load, value = (
+            a[keep] for a in (location, city, primary, k, load, value))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ratio = np.where(load > 0, value / load, np.inf)
+        # By location, and by decreasing value per unit of load
+        order = np.lexsort((-ratio, location))
+        location, city, primary, k, load, value = (
+            a[order] for a in (location, city, primary, k, load, value))
+
+        options = [np.zeros(n_locations)]
+        fractions = []
+        for cost, cap, rank in zip(self.costs, self.caps, self.ranks):
+            fits = k <= rank
+            l_t, w, val = location[fits], load[fits], value[fits]
+            # Load taken before every item within its location
+            cumulative = np.cumsum(w)
+            counts = np.bincount(l_t, minlength=n_locations)
+            starts = np.cumsum(counts) - counts
+            used = counts > 0
+            base = np.repeat((cumulative - w)[starts[used]], counts[used])
+            before = cumulative - w - base
+            with np.errstate(divide="ignore", invalid="ignore"):
+                fraction = np.clip(
+                    np.where(w > 0, (cap - before) / w, 1.0), 0, 1)
+            collected = np.bincount(l_t, weights=fraction * val,
+                                    minlength=n_locations)
+            options.append(cost - collected)
+            fractions.append((fits, fraction))
+
+        options = np.vstack(options)
+        choice = np.argmin(options, axis=0)
+        total = float(u.sum() + v.sum() + options[choice,
+                                                   np.arange(n_locations)].sum())
+
+        served_primary = np.zeros(n_cities)
+        served_secondary = np.zeros(n_cities)
+        for t, (fits, fraction) in enumerate(fractions):
+            chosen = choice[location[fits]] == t + 1
+            taken = fraction * chosen
+            p = primary[fits]
+            served_primary += np.bincount(city[fits][p], weights=taken[p],
+                                          minlength=n_cities)
+            served_secondary += np.bincount(city[fits][~p],
+                                            weights=taken[~p],
+                                            minlength=n_cities)
+        return total, 1 - served_primary, 1 - served_secondary
+
+    def evaluate(self, u, v):
+        # Pure Python version of evaluate_numpy
+        n_locations = self.problem.n_locations
+        items = [[] for _ in range(n_locations)]
+        for li, ci, primary, k, load in zip(
+                self.item_location, self.item_city, self.item_primary,
+                self.item_class, self.item_load):
+            value = u[ci] if primary else v[ci]
+            if value > 0:
+                ratio = value / load if load > 0 else math.inf
+                items[li].append((-ratio, ci, primary, k, load, value))
+
+        total = sum(u) + sum(v)
+        served_primary = [0.0] * len(u)
+        served_secondary = [0.0] * len(v)
+        for li in range(n_locations):
+            best_option = 0
+            best_taken = []
+            for cost, cap, rank in zip(self.costs, self.caps, self.ranks):
+                remaining = cap
+                collected = 0
+                taken = []
+                for _, ci, primary, k, load, value in sorted(items[li]):
+                    if k > rank:
+                        continue
+                    if remaining <= 0 and load > 0:
+                        break
+                    fraction = 1.0 if load <= remaining \
+                        else remaining / load
+                    remaining -= fraction * load
+                    collected += fraction * value
+                    taken.append((ci, primary, fraction))
+                if cost - collected < best_option:
+                    best_option = cost - collected
+                    best_taken = taken
+            total += best_option
+            for ci, primary, fraction in best_taken:
+                if primary:
+                    served_primary[ci] += fraction
+                else:
+                    served_secondary[ci] += fraction
+        return (total, [1 - s for s in served_primary],
+                [1 - s for s in served_secondary])
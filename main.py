@@ -1,75 +1,500 @@
 from models import Solution
+from problem import Problem
 from models import (CapacityExceeded, CenterTooFar, CenterTooClose,
                     AlreadyPrimaryCenter, Infeasible)
 
 from localsearch import LocalSearchSolver
-from greedy import GreedySolver
-from grasp import GRASPSolver
+from deltasearch import DeltaLocalSearchSolver
+from greedy import GreedySolver, RegretGreedySolver
+from grasp import (GRASPSolver, ParallelGRASPSolver, ReactiveGRASPSolver,
+                   DEFAULT_ALPHAS, REACTIVE_ALPHAS)
+from relinking import GRASPPathRelinking
+from branchbound import BranchAndBoundSolver
+from decomposition import DecompositionSolver
+from anytime import AnytimeSolver
+from portfolio import PortfolioSolver, CONFIGURATIONS, DEFAULT_CONFIGURATIONS
+from lowerbound import LagrangianBound, format_gap, target_cost
 from data import cities, centers, types, d_center
+from instances import load_instance
 
 import argparse
+import cProfile
+import logging
+import pstats
+import sys
 import time
 
+import models
+import events
+import instrumentation
+from instrumentation import timer
+
+logger = logging.getLogger(__name__)
+
+# Print the full solutions, set by --solution
+FULL_REPORT = False
+# Lower bound the solutions are compared with, set by --bound / --gap
+LOWER_BOUND = None
+# Evaluate the construction candidates with NumPy, unset by --no-batch
+BATCH = True
+# Build the greedy solution in regret order, set by --regret
+REGRET = False
+
+def report(name, solution):
+    print(f"{name}: {solution.summary()}")
+    if LOWER_BOUND is not None:
+        # The bound only holds for feasible solutions
+        if solution.violations(d_center):
+            print(f"{name}: infeasible, no gap to lower bound "
+                  f"{LOWER_BOUND:g}")
+        else:
+            print(f"{name}: {format_gap(solution.cost, LOWER_BOUND)}")
+    if FULL_REPORT:
+        print(f"----- {name.upper()} RESULTS -----")
+        solution.write(sys.stdout)
+
 def run_greedy(initial_solution):
-    print("----- RUNNING GREEDY -----")
-    gs = GreedySolver(initial_solution, d_center)
+    logger.info("----- RUNNING GREEDY -----")
+    solver = RegretGreedySolver if REGRET else GreedySolver
+    gs = solver(initial_solution, d_center, batch=BATCH)
     solution = gs.solve()
 
-    print("----- GREEDY RESULTS -----")
-    print(solution)
+    report("Greedy", solution)
     return solution
 
-def run_localsearch(initial_solution):
-    print("----- RUNNING LOCAL SEARCH -----")
+def run_localsearch(initial_solution, strategy="classic"):
+    logger.info("----- RUNNING LOCAL SEARCH -----")
 
-    lss = LocalSearchSolver(initial_solution, d_center)
+    if strategy == "classic":
+        lss = LocalSearchSolver(initial_solution, d_center)
+    else:
+        lss = DeltaLocalSearchSolver(initial_solution, d_center,
+                                     strategy=strategy)
     solution = lss.solve()
 
-    print("----- LOCAL SEARCH RESULTS -----")
-    print(solution)
+    report("Local search", solution)
     return solution
 
-def run_grasp(initial_solution):
-    print("----- RUNNING GRASP -----")
+def run_grasp(initial_solution, workers=1, iterations=3, alphas=DEFAULT_ALPHAS,
+              seed=None, time_budget=None, stall=None, reactive=False,
+              block=10, elite=None, ls="first", target=None):
+    logger.info("----- RUNNING GRASP -----")
 
-    gs = GRASPSolver(initial_solution, d_center)
-    solution = gs.solve()
+    if reactive:
+        gs = ReactiveGRASPSolver(initial_solution, d_center,
+                                 iterations=iterations, alphas=alphas,
+                                 seed=seed, time_budget=time_budget,
+                                 stall=stall, block=block,
+                                 target_cost=target, batch=BATCH)
+    elif workers == 1:
+        gs = GRASPSolver(initial_solution, d_center, iterations=iterations,
+                         alphas=alphas, seed=seed, time_budget=time_budget,
+                         stall=stall, target_cost=target, batch=BATCH)
+    else:
+        gs = ParallelGRASPSolver(initial_solution, d_center,
+                                 iterations=iterations, alphas=alphas,
+                                 seed=seed, time_budget=time_budget,
+                                 workers=workers, stall=stall,
+                                 target_cost=target, batch=BATCH)
+    if elite is not None:
+        pr = GRASPPathRelinking(gs, d_center, pool_size=elite, ls=ls)
+        solution = pr.solve()
+    else:
+        solution = gs.solve()
+
+    if solution is None:
+        # Without --time-limit there is no greedy incumbent to fall back to
+        print("GRASP: no feasible solution, every construction failed")
+    else:
+        report("GRASP", solution)
+    if reactive:
+        print("----- REACTIVE GRASP ALPHAS -----")
+        print(gs.report())
+    if elite is not None:
+        print("----- ELITE POOL -----")
+        print(pr.report())
+    return solution
+
+def run_branchbound(initial_solution, incumbent, node_limit=None,
+                    time_limit=None):
+    logger.info("----- RUNNING BRANCH AND BOUND -----")
+    bb = BranchAndBoundSolver(initial_solution, d_center, incumbent,
+                              node_limit=node_limit, time_limit=time_limit,
+                              lower_bound=LOWER_BOUND)
+    solution = bb.solve()
+
+    if solution is not None:
+        report("Branch and bound", solution)
+    print("----- BRANCH AND BOUND -----")
+    print(bb.report())
+    return solution
+
+def run_decomposition(initial_solution, tiles=2, workers=1, ls="first",
+                      overlap=None):
+    logger.info("----- RUNNING DECOMPOSITION -----")
+    ds = DecompositionSolver(initial_solution, d_center, tiles=tiles,
+                             workers=workers, ls=ls, overlap=overlap,
+                             batch=BATCH)
+    solution = ds.solve()
 
-    print("----- GRASP RESULTS -----")
-    print(solution)
+    if ds.unassigned:
+        print(f"Decomposition: infeasible, {len(ds.unassigned)} cities have "
+              f"no primary or secondary center")
+    report("Decomposition", solution)
+    print(f"Decomposition: {len(ds.repaired)} cities repaired, "
+          f"{len(ds.band)} in the boundary band, {len(ds.unassigned)} left "
+          f"unassigned")
+    return solution
+
+def run_anytime(initial_solution, time_limit, ls="first", grasp=None,
+                target=None):
+    logger.info("----- RUNNING ANYTIME -----")
+    def progress(p):
+        logger.info("%.3fs: cost %s from %s", p.elapsed, p.cost, p.origin)
+    solver = AnytimeSolver(initial_solution, d_center,
+                           deadline=time.time() + time_limit,
+                           target_cost=target, callback=progress, grasp=grasp,
+                           ls=ls, batch=BATCH)
+    solution = solver.solve()
+
+    if solution is not None:
+        report("Anytime", solution)
+    print("----- ANYTIME -----")
+    print(solver.report())
+    return solution
+
+def run_portfolio(initial_solution, time_limit, configurations, seed=None,
+                  target=None):
+    logger.info("----- RUNNING PORTFOLIO -----")
+    ps = PortfolioSolver(initial_solution, d_center,
+                         deadline=time.time() + time_limit,
+                         configurations=configurations, target_cost=target,
+                         seed=seed, batch=BATCH)
+    solution = ps.solve()
+
+    if solution is not None:
+        report("Portfolio", solution)
+    print("----- PORTFOLIO -----")
+    print(ps.report())
     return solution
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Heuristics for AMMM final project")
     parser.add_argument(
         '-a', '--algorithm', action='store', 
-        choices=['greedy', 'localsearch', 'grasp'], required=True
+        choices=['greedy', 'localsearch', 'grasp', 'bnb', 'decomposition',
+                 'portfolio'],
+        required=True,
+        help="bnb is the exact branch and bound, starting from the greedy + "
+             "local search solution; decomposition solves grid tiles of the "
+             "instance separately and repairs the boundaries between them; "
+             "portfolio races several configurations until --time-limit"
+        )
+    parser.add_argument(
+        '-d', '--debug', action='store_true',
+        help="check incremental bookkeeping against full recomputations"
+        )
+    parser.add_argument(
+        '-w', '--workers', action='store', type=int, default=1,
+        help="GRASP and decomposition worker processes, 0 for one per CPU "
+             "(default 1)"
+        )
+    parser.add_argument(
+        '-i', '--iterations', action='store', type=int, default=None,
+        help="GRASP iterations, 0 for unlimited with --grasp-budget (default 3)"
+        )
+    parser.add_argument(
+        '--grasp-budget', action='store', type=float, default=None,
+        help="GRASP wall-clock budget in seconds"
+        )
+    parser.add_argument(
+        '--alphas', action='store', default=None,
+        help="comma separated GRASP alpha schedule, iteration i uses the "
+             "i-th value cyclically (default 0,0.1,0.2)"
+        )
+    parser.add_argument(
+        '--stall', action='store', type=int, default=None,
+        help="stop GRASP after this many iterations without improvement "
+             "(per worker)"
+        )
+    parser.add_argument(
+        '--reactive', action='store_true',
+        help="reactive GRASP: draw the alphas with probabilities learnt from "
+             "the solutions they build (single process, default alphas "
+             f"{','.join(str(a) for a in REACTIVE_ALPHAS)}, 100 iterations)"
+        )
+    parser.add_argument(
+        '--reactive-block', action='store', type=int, default=10,
+        help="iterations between updates of the reactive GRASP probabilities"
+        )
+    parser.add_argument(
+        '--bnb-nodes', action='store', type=int, default=None,
+        help="branch and bound node limit"
+        )
+    parser.add_argument(
+        '--bnb-budget', action='store', type=float, default=None,
+        help="branch and bound wall-clock budget in seconds"
+        )
+    parser.add_argument(
+        '--elite', action='store', type=int, default=None, metavar='SIZE',
+        help="improve every GRASP construction with the delta local search "
+             "(--ls first or best, first by default), keep an elite pool of "
+             "SIZE diverse solutions and relink them (single process)"
+        )
+    parser.add_argument(
+        '--bound', action='store_true',
+        help="compute a Lagrangian lower bound and report the optimality "
+             "gap of every solution"
+        )
+    parser.add_argument(
+        '--gap', action='store', type=float, default=None,
+        help="stop GRASP once a solution is within this relative gap of the "
+             "lower bound, e.g. 0.05 (implies --bound)"
+        )
+    parser.add_argument(
+        '--seed', action='store', type=int, default=None,
+        help="seed for reproducible GRASP runs"
+        )
+    parser.add_argument(
+        '--time-limit', action='store', type=float, default=None,
+        metavar='SECONDS',
+        help="run greedy, localsearch or grasp as an anytime solver that "
+             "returns the best feasible solution found within SECONDS (not "
+             "counting the instance loading); grasp keeps iterating until "
+             "then unless -i or --stall stop it before"
+        )
+    parser.add_argument(
+        '--portfolio', action='store',
+        default=','.join(DEFAULT_CONFIGURATIONS), metavar='CONFIGS',
+        help="comma separated configurations raced by -a portfolio, one "
+             "process each, among " + ', '.join(CONFIGURATIONS) +
+             " (default %(default)s)"
+        )
+    parser.add_argument(
+        '--tiles', action='store', type=int, default=2, metavar='N',
+        help="decomposition in an N x N grid of tiles (default 2)"
+        )
+    parser.add_argument(
+        '--overlap', action='store', type=float, default=None,
+        help="distance the tiles reach past their cells, 3 times the largest "
+             "working distance by default"
+        )
+    parser.add_argument(
+        '--ls', action='store', choices=['classic', 'first', 'best'],
+        default='classic',
+        help="local search: the classic downgrade passes, or the delta "
+             "evaluation engine with first or best improvement"
+        )
+    parser.add_argument(
+        '--regret', action='store_true',
+        help="assign the cities of the greedy by largest regret instead of "
+             "in input order"
+        )
+    parser.add_argument(
+        '--no-batch', action='store_true',
+        help="evaluate the construction candidates one by one instead of "
+             "with the NumPy kernel"
+        )
+    parser.add_argument(
+        '--instance', action='store', default=None,
+        help="instance file (.dat, .json or .csv), data.py is used otherwise"
+        )
+    parser.add_argument(
+        '--no-cache', action='store_true',
+        help="do not read or write the binary cache of --instance"
+        )
+    parser.add_argument(
+        '-v', '--verbose', action='count', default=0,
+        help="log the solvers progress, -vv to log every assignment and move"
+        )
+    parser.add_argument(
+        '--solution', action='store_true',
+        help="print the full solutions, not only their summary"
+        )
+    parser.add_argument(
+        '--events', action='store', default=None, metavar='FILE',
+        help="write the assignments, GRASP iterations and local search "
+             "moves to FILE, one JSON object per line"
+        )
+    parser.add_argument(
+        '--profile', action='store_true',
+        help="count the solvers work and time every phase, and print a "
+             "summary at the end"
+        )
+    parser.add_argument(
+        '--cprofile', action='store', default=None, metavar='FILE',
+        help="run the algorithm under cProfile, dump the pstats data to FILE "
+             "and print the most expensive functions"
         )
     args = parser.parse_args()
+    models.DEBUG = args.debug
+    instrumentation.ENABLED = args.profile
+    FULL_REPORT = args.solution
+    BATCH = not args.no_batch
+    REGRET = args.regret
+    levels = [logging.WARNING, logging.INFO, logging.DEBUG]
+    logging.basicConfig(level=levels[min(args.verbose, len(levels) - 1)],
+                        format="%(message)s")
+    if args.events is not None:
+        events.open_stream(args.events)
+
+    if args.reactive and args.workers != 1:
+        parser.error("--reactive runs in a single process, use -w 1")
+    if args.elite is not None and args.workers != 1:
+        parser.error("--elite runs in a single process, use -w 1")
+    if args.elite is not None and args.elite < 1:
+        parser.error("--elite needs a pool of at least one solution")
+    configurations = [c for c in args.portfolio.split(',') if c]
+    if args.algorithm == "portfolio":
+        if args.time_limit is None:
+            parser.error("-a portfolio needs --time-limit")
+        for c in configurations:
+            if c not in CONFIGURATIONS:
+                parser.error(f"Unknown portfolio configuration {c}")
+        if not configurations or len(set(configurations)) \
+                != len(configurations):
+            parser.error("--portfolio needs distinct configurations")
+    elif args.time_limit is not None:
+        if args.algorithm not in ("greedy", "localsearch", "grasp"):
+            parser.error("--time-limit works with greedy, localsearch, grasp "
+                         "and portfolio")
+        if args.time_limit <= 0:
+            parser.error("--time-limit must be positive")
+        if args.workers != 1 or args.elite is not None:
+            parser.error("--time-limit runs GRASP in a single process, "
+                         "without --elite")
+        if args.grasp_budget is None:
+            args.grasp_budget = args.time_limit
+    if args.iterations is None and args.grasp_budget is None \
+            and args.stall is None:
+        args.iterations = 100 if args.reactive else 3
+    elif args.iterations == 0:
+        args.iterations = None
+    if args.iterations is None and args.grasp_budget is None \
+            and args.stall is None:
+        parser.error("-i 0 needs --grasp-budget or --stall")
+    if args.tiles < 1:
+        parser.error("--tiles needs at least one tile")
+    alphas = REACTIVE_ALPHAS if args.reactive else DEFAULT_ALPHAS
+    if args.alphas is not None:
+        alphas = [float(a) for a in args.alphas.split(',')]
+
+    with timer("phase precompute"):
+        if args.instance is not None:
+            cities, centers, types, d_center, problem = load_instance(
+                args.instance, cache=not args.no_cache
+                )
+        else:
+            problem = Problem(cities, centers, types, d_center)
+        initial_solution = Solution(cities, centers, types, problem)
+
+    if args.bound or args.gap is not None:
+        with timer("phase lower bound"):
+            start = time.time()
+            lagrangian = LagrangianBound(problem)
+            LOWER_BOUND = lagrangian.solve()
+        print(f"Lower bound: {LOWER_BOUND} ({lagrangian.iterations_run} "
+              f"subgradient iterations, {time.time() - start:f}s)")
 
-    initial_solution = Solution(cities, centers, types)
+    profiler = None
+    if args.cprofile is not None:
+        profiler = cProfile.Profile()
+        profiler.enable()
 
     ini_time = time.time()
+    if args.algorithm == "portfolio":
+        with timer("phase portfolio"):
+            run_portfolio(initial_solution, args.time_limit, configurations,
+                          seed=args.seed,
+                          target=target_cost(LOWER_BOUND, args.gap))
+        print("Time Portfolio: %f" % (time.time() - ini_time))
+    elif args.time_limit is not None:
+        grasp = None
+        if args.algorithm == "grasp":
+            solver = ReactiveGRASPSolver if args.reactive else GRASPSolver
+            grasp = solver(initial_solution, d_center,
+                           iterations=args.iterations, alphas=alphas,
+                           seed=args.seed, time_budget=args.grasp_budget,
+                           stall=args.stall, batch=BATCH)
+        with timer("phase anytime"):
+            run_anytime(
+                initial_solution, args.time_limit,
+                ls=(None if args.algorithm == "greedy" else
+                    args.ls if args.ls != "classic" else "first"),
+                grasp=grasp, target=target_cost(LOWER_BOUND, args.gap)
+                )
+        print("Time Anytime: %f" % (time.time() - ini_time))
+        # The algorithm already ran
+        args.algorithm = None
+
     if args.algorithm == "greedy":
-        run_greedy(initial_solution)
+        with timer("phase greedy"):
+            run_greedy(initial_solution)
         time_greedy = time.time() - ini_time
         print("Time Greedy: %f" % time_greedy)
 
     if args.algorithm == "localsearch":
-        greedy_solution = run_greedy(initial_solution)
+        with timer("phase greedy"):
+            greedy_solution = run_greedy(initial_solution)
         time_greedy = time.time() - ini_time
-        run_localsearch(greedy_solution)
+        with timer("phase local search"):
+            run_localsearch(greedy_solution, args.ls)
         time_localsearch = time.time() - ini_time - time_greedy
         print("Time Greedy: %f" % time_greedy)
         print("Time LS: %f" % time_localsearch)
 
     if args.algorithm == "grasp":
-        grasp_solution = run_grasp(initial_solution)
+        with timer("phase grasp"):
+            grasp_solution = run_grasp(
+                initial_solution, workers=args.workers or None,
+                iterations=args.iterations, alphas=alphas, seed=args.seed,
+                time_budget=args.grasp_budget, stall=args.stall,
+                reactive=args.reactive, block=args.reactive_block,
+                elite=args.elite,
+                ls=args.ls if args.ls != "classic" else "first",
+                target=target_cost(LOWER_BOUND, args.gap)
+                )
         time_grasp = time.time() - ini_time
-        run_localsearch(grasp_solution)
+        if grasp_solution is not None:
+            with timer("phase local search"):
+                run_localsearch(grasp_solution, args.ls)
         time_localsearch = time.time() - ini_time - time_grasp
         print("Time GRASP: %f" % time_grasp)
         print("Time LS: %f" % time_localsearch)
 
+    if args.algorithm == "bnb":
+        with timer("phase greedy"):
+            greedy_solution = run_greedy(initial_solution)
+        with timer("phase local search"):
+            incumbent = run_localsearch(greedy_solution, args.ls)
+        time_heuristic = time.time() - ini_time
+        with timer("phase branch and bound"):
+            run_branchbound(initial_solution, incumbent,
+                            node_limit=args.bnb_nodes,
+                            time_limit=args.bnb_budget)
+        time_bnb = time.time() - ini_time - time_heuristic
+        print("Time Greedy + LS: %f" % time_heuristic)
+        print("Time B&B: %f" % time_bnb)
+
+    if args.algorithm == "decomposition":
+        with timer("phase decomposition"):
+            run_decomposition(
+                initial_solution, tiles=args.tiles,
+                workers=args.workers or None,
+                ls=args.ls if args.ls != "classic" else "first",
+                overlap=args.overlap
+                )
+        print("Time Decomposition: %f" % (time.time() - ini_time))
+
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(args.cprofile)
+        print(f"----- CPROFILE (written to {args.cprofile}) -----")
+        pstats.Stats(profiler).sort_stats("cumulative").print_stats(25)
+
+    if args.profile:
+        print(instrumentation.summary())
+    events.close_stream()
+
 
 
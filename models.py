@@ -2,6 +2,13 @@ import math
 import io
 import copy
 
+from problem import Problem
+import instrumentation
+from instrumentation import raised
+
+# When set, every load update is checked against a full recomputation
+DEBUG = False
+
 def distance(a, b):
     return math.sqrt(math.pow((a[0] - b[0]), 2) + math.pow((a[1] - b[1]), 2))
 
@@ -24,12 +31,45 @@ class AlreadySecondaryCenter(Exception):
 class Infeasible(Exception):
     pass
 
+# ---- FEASIBILITY STATUS ------
+# Returned by the non-raising checks of LogisticCenterLocation, meant for the
+# solvers inner loops where raising and catching exceptions is too slow.
+FEASIBLE = 0
+CAPACITY_EXCEEDED = 1
+CENTER_TOO_FAR = 2
+CENTER_TOO_CLOSE = 3
+ALREADY_PRIMARY = 4
+ALREADY_SECONDARY = 5
+
+STATUS_EXCEPTIONS = {
+    CAPACITY_EXCEEDED: CapacityExceeded,
+    CENTER_TOO_FAR: CenterTooFar,
+    CENTER_TOO_CLOSE: CenterTooClose,
+    ALREADY_PRIMARY: AlreadyPrimaryCenter,
+    ALREADY_SECONDARY: AlreadySecondaryCenter,
+}
+
 # ---- MODELS ----
+def key(obj):
+    # Identity of a city or location: its index in the problem, which is
+    # stable across copies of a solution. Objects outside any problem are
+    # only equal to themselves.
+    return obj.idx if obj.idx is not None else id(obj)
+
+class Objective:
+    # Running total cost of the active centers of a solution, shared by all
+    # its locations and kept up to date by their mutations (activate,
+    # deactivate and set_type)
+    def __init__(self, total=0):
+        self.total = total
+
 class City:
     def __init__(self, x, y, population):
         self.x = x
         self.y = y
         self.population = population
+        # Index in the problem, set when a Problem is built
+        self.idx = None
         # Primary center
         self.pc = None
         self.sc = None
@@ -39,17 +79,37 @@ class City:
         return (self.x, self.y)
 
     def __eq__(self, other):
-        return self.x == other.x and self.y == other.y
+        return isinstance(other, City) and key(self) == key(other)
+
+    def __hash__(self):
+        return hash(key(self))
 
 class LogisticCenterLocation:
     def __init__(self, x, y, t=None):
         self.x = x
         self.y = y
         self.t = t
-        self.cities_primary = []
-        self.cities_secondary = []
+        # Assigned cities by key, in assignment order
+        self.cities_primary = {}
+        self.cities_secondary = {}
+        # Running population totals of the assigned cities, so loads are O(1)
+        self.population_primary = 0
+        self.population_secondary = 0
+        # Largest distance class (see TypeLadder.distance_class) of the
+        # assigned cities as primary and as secondary, -1 without cities. A
+        # new type must cover it to keep serving all of them.
+        self.class_primary = -1
+        self.class_secondary = -1
         # Indicates if there's an actual logistic center or not
         self.active = False
+        # Number of active centers closer than d_center, kept up to date by
+        # activate and deactivate
+        self.active_conflicts = 0
+        # Index and problem are set when a Problem is built
+        self.idx = None
+        self.problem = None
+        # Set when a Solution is built on the location
+        self.objective = None
 
     @property
     def cost(self):
@@ -59,86 +119,250 @@ class LogisticCenterLocation:
     def coordinates(self):
         return (self.x, self.y)
 
+    @property
+    def served_class(self):
+        return max(self.class_primary, self.class_secondary)
+
     @property
     def curr_load(self):
-        return sum([x.population for x in self.cities_primary]) \
-               + 0.1 * sum([x.population for x in self.cities_secondary])
+        if DEBUG:
+            self.check_load()
+        return self.population_primary + 0.1 * self.population_secondary
+
+    def check_load(self):
+        # Compare the running totals against a full recomputation
+        expected_primary = sum([
+            x.population for x in self.cities_primary.values()
+            ])
+        expected_secondary = sum([
+            x.population for x in self.cities_secondary.values()
+            ])
+        assert math.isclose(self.population_primary, expected_primary), \
+            f"Primary load of {self.coordinates} is {self.population_primary}," \
+            f" expected {expected_primary}"
+        assert math.isclose(self.population_secondary, expected_secondary), \
+            f"Secondary load of {self.coordinates} is " \
+            f"{self.population_secondary}, expected {expected_secondary}"
+
+    def city_distance(self, city):
+        if self.problem is None:
+            return distance(self.coordinates, city.coordinates)
+        return self.problem.distances.city_to_location(city.idx, self.idx)
+
+    def location_distance(self, location):
+        if self.problem is None:
+            return distance(self.coordinates, location.coordinates)
+        return self.problem.distances.location_to_location(
+            self.idx, location.idx)
+
+    def activation_status(self, locations, d_center):
+        if instrumentation.ENABLED:
+            instrumentation.count("activation checks")
+        if self.problem is None:
+            return self._scan_activation_status(locations, d_center)
+        if DEBUG:
+            expected = sum([
+                1 for l in locations
+                if l is not self and l.active
+                and self.location_distance(l) < d_center
+                ])
+            assert self.active_conflicts == expected, \
+                f"{self.coordinates} has {self.active_conflicts} active " \
+                f"conflicts, expected {expected}"
+        if self.active_conflicts > 0:
+            if instrumentation.ENABLED:
+                instrumentation.count("activation checks rejected")
+            return CENTER_TOO_CLOSE
+        return FEASIBLE
+
+    def _scan_activation_status(self, locations, d_center):
+        for l in locations:
+            if l.active and (self.location_distance(l) < d_center):
+                if instrumentation.ENABLED:
+                    instrumentation.count("activation checks rejected")
+                return CENTER_TOO_CLOSE
+        return FEASIBLE
 
     def activate(self, locations, d_center):
-        for l in locations:
-            if l.active and (distance(self.coordinates, l.coordinates) < d_center):
-                raise CenterTooClose
+        if self.activation_status(locations, d_center) != FEASIBLE:
+            raise raised(CenterTooClose)
 
+        if instrumentation.ENABLED:
+            instrumentation.count("activations")
         self.active = True
+        self._update_conflicts(locations, d_center, 1)
+        # Returns the cost delta, as all the mutations
+        return self._add_cost(self._type_cost(self.t))
+
+    def deactivate(self, locations, d_center):
+        self.active = False
+        self._update_conflicts(locations, d_center, -1)
+        return self._add_cost(-self._type_cost(self.t))
+
+    def set_type(self, t):
+        # Changes the type of the center. Solvers must use this instead of
+        # setting t, so the solution cost stays up to date.
+        delta = 0
+        if self.active:
+            delta = self._type_cost(t) - self._type_cost(self.t)
+        self.t = t
+        return self._add_cost(delta)
+
+    @staticmethod
+    def _type_cost(t):
+        return t.cost if t is not None else 0
+
+    def _add_cost(self, delta):
+        if self.objective is not None:
+            self.objective.total += delta
+        return delta
+
+    def _update_conflicts(self, locations, d_center, delta):
+        if self.problem is None:
+            return
+        for lj in self.problem.conflicts(d_center)[self.idx]:
+            locations[lj].active_conflicts += delta
 
     def next_load_with_city_primary(self, city):
-        return sum(
-            [x.population for x in self.cities_primary] + [city.population]
-            ) + 0.1 * sum([x.population for x in self.cities_secondary])
+        return self.curr_load + city.population
 
     def next_load_without_city_primary(self, city):
-        return sum(
-            [x.population for x in self.cities_primary]) - city.population \
-             + 0.1 * sum([x.population for x in self.cities_secondary])
+        return self.curr_load - city.population
 
     def next_load_with_city_secondary(self, city):
-        return sum([x.population for x in self.cities_primary]) + 0.1 * sum(
-                        [x.population for x in self.cities_secondary] 
-                        + [city.population]
-                        )
+        return self.population_primary \
+               + 0.1 * (self.population_secondary + city.population)
 
     def next_load_without_city_secondary(self, city):
-        return sum([x.population for x in self.cities_primary]) \
-               + 0.1 * sum([x.population for x in self.cities_secondary]) \
-                        - city.population
-
-    def is_primary(self, x, y):
-        for c in self.cities_primary:
-            if c.x == x and c.y == y:
-                return True
-        return False
-
-    def is_secondary(self, x, y):
-        for c in self.cities_secondary:
-            if c.x == x and c.y == y:
-                return True
-        return False
+        return self.population_primary \
+               + 0.1 * (self.population_secondary - city.population)
+
+    def has_primary(self, city):
+        return key(city) in self.cities_primary
+
+    def has_secondary(self, city):
+        return key(city) in self.cities_secondary
+
+    def primary_status(self, city, t=None):
+        # Feasibility of adding city as primary with type t (the current type
+        # by default), and the resulting load. Does not raise.
+        if instrumentation.ENABLED:
+            instrumentation.count("feasibility checks primary")
+        if t is None:
+            t = self.t
+        load = self.next_load_with_city_primary(city)
+        if (self.city_distance(city) > t.working_d):
+            return CENTER_TOO_FAR, load
+        if (load > t.cap):
+            return CAPACITY_EXCEEDED, load
+        return FEASIBLE, load
+
+    def secondary_status(self, city, t=None):
+        # Same as primary_status for the city as secondary
+        if instrumentation.ENABLED:
+            instrumentation.count("feasibility checks secondary")
+        if t is None:
+            t = self.t
+        load = self.next_load_with_city_secondary(city)
+        if self.has_primary(city):
+            return ALREADY_PRIMARY, load
+        if (self.city_distance(city) > 3*t.working_d):
+            return CENTER_TOO_FAR, load
+        if (load > t.cap):
+            return CAPACITY_EXCEEDED, load
+        return FEASIBLE, load
 
     def check_city_primary(self, city):
-        if (distance(self.coordinates, city.coordinates) > self.t.working_d):
-            raise CenterTooFar
-        if (self.next_load_with_city_primary(city) > self.t.cap):
-            raise CapacityExceeded
+        status, _ = self.primary_status(city)
+        if status != FEASIBLE:
+            raise raised(STATUS_EXCEPTIONS[status])
         return True
 
     def check_city_secondary(self, city):
-        if self.is_primary(city.x, city.y):
-            raise AlreadyPrimaryCenter
-        if (distance(self.coordinates, city.coordinates) > 3*self.t.working_d):
-            raise CenterTooFar
-        if (self.next_load_with_city_secondary(city) > self.t.cap):
-            raise CapacityExceeded
+        status, _ = self.secondary_status(city)
+        if status != FEASIBLE:
+            raise raised(STATUS_EXCEPTIONS[status])
         return True
 
     def add_city_primary(self, city):
-        if self.is_secondary(city.x, city.y):
-            raise AlreadySecondaryCenter
-        if (distance(self.coordinates, city.coordinates) > self.t.working_d):
-            raise CenterTooFar
-        if (self.next_load_with_city_primary(city) > self.t.cap):
-            raise CapacityExceeded
-        self.cities_primary.append(city)
-        city.pc = self
+        if self.has_secondary(city):
+            raise raised(AlreadySecondaryCenter)
+        self.check_city_primary(city)
+        self.assign_city_primary(city)
 
     def add_city_secondary(self, city):
-        if self.is_primary(city.x, city.y):
-            raise AlreadyPrimaryCenter
-        if (distance(self.coordinates, city.coordinates) > 3*self.t.working_d):
-            raise CenterTooFar
-        if (self.next_load_with_city_secondary(city) > self.t.cap):
-            raise CapacityExceeded
-        self.cities_secondary.append(city)
+        self.check_city_secondary(city)
+        self.assign_city_secondary(city)
+
+    def assign_city_primary(self, city):
+        # Adds the city without any feasibility check
+        self.cities_primary[key(city)] = city
+        self.population_primary += city.population
+        self.class_primary = max(self.class_primary,
+                                 self.city_class(city, secondary=False))
+        city.pc = self
+        if DEBUG:
+            self.check_load()
+
+    def assign_city_secondary(self, city):
+        # Adds the city without any feasibility check
+        self.cities_secondary[key(city)] = city
+        self.population_secondary += city.population
+        self.class_secondary = max(self.class_secondary,
+                                   self.city_class(city, secondary=True))
         city.sc = self
+        if DEBUG:
+            self.check_load()
+
+    def remove_city_primary(self, city):
+        removed = self.cities_primary.pop(key(city), None)
+        if removed is not None:
+            self.population_primary -= removed.population
+            if self.city_class(removed, secondary=False) \
+                    >= self.class_primary:
+                self.class_primary = self.largest_class(
+                    self.cities_primary, secondary=False)
+        if DEBUG:
+            self.check_load()
+
+    def remove_city_secondary(self, city):
+        removed = self.cities_secondary.pop(key(city), None)
+        if removed is not None:
+            self.population_secondary -= removed.population
+            if self.city_class(removed, secondary=True) \
+                    >= self.class_secondary:
+                self.class_secondary = self.largest_class(
+                    self.cities_secondary, secondary=True)
+        if DEBUG:
+            self.check_load()
+
+    def city_class(self, city, secondary=False):
+        # Distance class of city from this location, one past the last class
+        # if no type reaches it
+        if self.problem is None:
+            return -1
+        ladder = self.problem.ladder
+        k = ladder.distance_class(self.city_distance(city), secondary)
+        return len(ladder.working_d) if k is None else k
+
+    def largest_class(self, cities, secondary=False):
+        return max([self.city_class(c, secondary) for c in cities.values()],
+                   default=-1)
+
+    def served_class_without(self, city, primary=True):
+        # served_class once city is removed, as primary or as secondary
+        if primary:
+            cities, own, other = (self.cities_primary, self.class_primary,
+                                  self.class_secondary)
+        else:
+            cities, own, other = (self.cities_secondary, self.class_secondary,
+                                  self.class_primary)
+        if self.city_class(city, secondary=not primary) >= own:
+            # city may be the farthest one
+            own = max([self.city_class(c, secondary=not primary)
+                       for k, c in cities.items() if k != key(city)],
+                      default=-1)
+        return max(own, other)
 
     def check_cost_improve(self, city, t, primary=True):
         # Check if cost can be improve by removing city and assigning the center
@@ -149,12 +373,18 @@ class LogisticCenterLocation:
             next_load = self.next_load_without_city_secondary(city)
 
         if t.cost < self.t.cost and t.cap >= next_load:
-            # Center can be downgraded without the city
-            return True
+            # Center can be downgraded without the city, if t still reaches
+            # the cities it keeps serving
+            served = self.served_class_without(city, primary)
+            return served < 0 or self.problem.ladder.reaches(t, served)
         return False
 
     def __eq__(self, other):
-        return self.x == other.x and self.y == other.y
+        return isinstance(other, LogisticCenterLocation) \
+               and key(self) == key(other)
+
+    def __hash__(self):
+        return hash(key(self))
 
 class LogisticCenterType:
     def __init__(self, tid, cap, working_d, cost):
@@ -167,34 +397,116 @@ class LogisticCenterType:
         return self.tid == other.tid
 
 class Solution:
-    def __init__(self, cities, centers, types):
-        self.cities = copy.deepcopy(cities)
-        self.centers = copy.deepcopy(centers)
-        self.types = copy.deepcopy(types)
+    def __init__(self, cities, centers, types, problem=None, deep_copy=True):
+        if problem is None:
+            problem = Problem.of(cities, centers, types)
+        # Shared by all the copies, see Problem.__deepcopy__
+        self.problem = problem
+        if deep_copy:
+            # One memo for all, so the copied cities and centers point to
+            # each other and not to separate copies
+            memo = {}
+            self.cities = copy.deepcopy(cities, memo)
+            self.centers = copy.deepcopy(centers, memo)
+            self.types = copy.deepcopy(types, memo)
+        else:
+            # Take ownership of objects nobody else will modify
+            self.cities = cities
+            self.centers = centers
+            self.types = types
+
+        self.objective = Objective(self.full_cost())
+        for l in self.centers:
+            l.objective = self.objective
 
     @property
     def cost(self):
+        if DEBUG:
+            assert math.isclose(self.objective.total, self.full_cost()), \
+                f"Running cost is {self.objective.total}, expected " \
+                f"{self.full_cost()}"
+        return self.objective.total
+
+    def full_cost(self):
+        # Recomputed from every center
         total_cost = 0
         for l in self.centers:
             if l.active:
                 total_cost += l.cost
         return total_cost
 
-    def __str__(self):
-        str_buf = io.StringIO()
+    def violations(self, d_center):
+        # Full check of the constraints, independent of the solvers
+        # bookkeeping. Returns a list of messages, empty when feasible.
+        found = []
+        for c in self.cities:
+            if c.pc is None or c.sc is None:
+                found.append(f"City {c.coordinates} has no primary or "
+                             f"secondary center")
+                continue
+            if c.pc is c.sc:
+                found.append(f"City {c.coordinates} has the same primary and "
+                             f"secondary center")
+            if not c.pc.active or not c.sc.active:
+                found.append(f"City {c.coordinates} is served by an inactive "
+                             f"location")
+                continue
+            if c.pc.city_distance(c) > c.pc.t.working_d:
+                found.append(f"City {c.coordinates} is too far from its "
+                             f"primary center {c.pc.coordinates}")
+            if c.sc.city_distance(c) > 3 * c.sc.t.working_d:
+                found.append(f"City {c.coordinates} is too far from its "
+                             f"secondary center {c.sc.coordinates}")
+
+        active = [l for l in self.centers if l.active]
+        for l in active:
+            load = sum([c.population for c in l.cities_primary.values()]) \
+                   + 0.1 * sum([
+                       c.population for c in l.cities_secondary.values()
+                       ])
+            if load > l.t.cap + 1e-9:
+                found.append(f"Center {l.coordinates} has load {load} over "
+                             f"its capacity {l.t.cap}")
+        conflicts = self.problem.conflicts(d_center)
+        for l in active:
+            for lj in conflicts[l.idx]:
+                l2 = self.centers[lj]
+                if lj > l.idx and l2.active:
+                    found.append(f"Centers {l.coordinates} and "
+                                 f"{l2.coordinates} are too close")
+        return found
+
+    def write(self, f):
+        # Writes the full report to the file f, line by line
         for idx, c in enumerate(self.cities):
-            str_buf.write(f"City {idx} {c.x, c.y}:\n")
-            str_buf.write(f"\tPrimary center: ({c.pc.x}, {c.pc.y}) of type "
-                          f"{c.pc.t.tid}\n")
-            str_buf.write(f"\tSecondary center: ({c.sc.x}, {c.sc.y}) of type "
-                          f"{c.sc.t.tid}\n")
+            f.write(f"City {idx} {c.x, c.y}:\n")
+            for role, l in (("Primary", c.pc), ("Secondary", c.sc)):
+                if l is None:
+                    # Left unassigned by a solver that could not repair it
+                    f.write(f"\t{role} center: unassigned\n")
+                else:
+                    f.write(f"\t{role} center: ({l.x}, {l.y}) of type "
+                            f"{l.t.tid}\n")
 
         total_cost = 0
         for idx, l in enumerate(self.centers):
             if l.active:
-                str_buf.write(
-                    f"Location {idx}, has a center of type {l.t.tid}.\n"
-                    )
+                f.write(f"Location {idx}, has a center of type {l.t.tid}.\n")
                 total_cost += l.cost
-        str_buf.write(f"Total cost: {total_cost}\n")
+        f.write(f"Total cost: {total_cost}\n")
+
+    def summary(self):
+        # One line with the cost and the centers of every type
+        by_type = {}
+        for l in self.centers:
+            if l.active:
+                by_type[l.t.tid] = by_type.get(l.t.tid, 0) + 1
+        centers = ", ".join(f"{n} of type {tid}"
+                            for tid, n in sorted(by_type.items()))
+        return f"cost {self.cost}, {sum(by_type.values())} centers " \
+               f"({centers}), {len(self.cities)} cities"
+
+    def __str__(self):
+        str_buf = io.StringIO()
+        self.write(str_buf)
         return str_buf.getvalue()
@@ -0,0 +1,230 @@
+import logging
+import math
+import multiprocessing
+import time
+from concurrent.futures import (ProcessPoolExecutor, FIRST_COMPLETED,
+                                wait)
+
+from anytime import AnytimeSolver, FINISHED
+from branchbound import BranchAndBoundSolver
+from compact import CompactSolution
+from greedy import GreedySolver, RegretGreedySolver
+from grasp import GRASPSolver, ReactiveGRASPSolver
+import events
+import instrumentation
+
+logger = logging.getLogger(__name__)
+
+# Configurations a portfolio can race, see run_configuration
+CONFIGURATIONS = ("greedy+ls", "regret+ls", "grasp+ls", "reactive+ls", "bnb")
+DEFAULT_CONFIGURATIONS = ("greedy+ls", "regret+ls", "grasp+ls",
+                          "reactive+ls")
+# Status of a branch and bound that explored the whole tree
+OPTIMAL = "optimal"
+
+
+class SharedIncumbent:
+    # State shared by the processes of a portfolio: the cost of the best
+    # solution found by any of them, and the flag telling them to stop
+    def __init__(self):
+        self.best = multiprocessing.Value("d", math.inf)
+        self.stopped = multiprocessing.Event()
+
+    def cost(self):
+        return self.best.value
+
+    def offer(self, cost):
+        with self.best.get_lock():
+            if cost < self.best.value:
+                self.best.value = cost
+
+    def stop(self):
+        self.stopped.set()
+
+    def cancelled(self):
+        return self.stopped.is_set()
+
+
+def run_configuration(name, solution, d_center, deadline, target_cost=None,
+                      seed=None, shared=None, batch=True):
+    # Runs one configuration until the deadline, the target cost or the
+    # stop of shared. Returns the AnytimeSolver, with the times and the
+    # reason it stopped, and the best solution.
+    #   greedy+ls     greedy + delta local search
+    #   regret+ls     regret greedy + delta local search
+    #   grasp+ls      greedy + local search, then GRASP iterations, every one
+    #                 improved with the local search
+    #   reactive+ls   the same with reactive GRASP
+    #   bnb           greedy + local search, then the branch and bound,
+    #                 pruning with the best cost of the whole portfolio. Its
+    #                 status is OPTIMAL when it explores the whole tree.
+    if name not in CONFIGURATIONS:
+        raise ValueError(f"Unknown portfolio configuration {name}")
+    cancelled = shared.cancelled if shared is not None else None
+
+    def progress(p):
+        if shared is not None:
+            shared.offer(p.cost)
+
+    grasp = None
+    if name in ("grasp+ls", "reactive+ls"):
+        budget = max(0.0, deadline - time.time())
+        solver = GRASPSolver if name == "grasp+ls" else ReactiveGRASPSolver
+        grasp = solver(solution, d_center, iterations=None, seed=seed,
+                       time_budget=budget, verbose=False, batch=batch)
+    anytime = AnytimeSolver(
+        solution, d_center, deadline=deadline, target_cost=target_cost,
+        callback=progress, grasp=grasp, batch=batch, verbose=False,
+        greedy=RegretGreedySolver if name == "regret+ls" else GreedySolver,
+        cancelled=cancelled
+        )
+    best = anytime.solve()
+    if name != "bnb" or anytime.status != FINISHED:
+        return anytime, best
+
+    bb = BranchAndBoundSolver(
+        solution, d_center, incumbent=best,
+        time_limit=max(0.0, deadline - time.time()), verbose=False,
+        upper_bound=shared.cost if shared is not None else None,
+        cancelled=cancelled
+        )
+    found = bb.solve()
+    if anytime.incumbent.offer(found, "branch and bound"):
+        best = found
+    if bb.complete:
+        # Nothing cheaper than the best of the portfolio exists
+        anytime.status = OPTIMAL
+    else:
+        anytime.stop()
+    return anytime, best
+
+
+# ---- WORKERS ----
+# State of a pool worker process, set when it starts
+_worker_state = None
+
+def _init_worker(problem, initial, d_center, shared, batch, profile):
+    global _worker_state
+    instrumentation.ENABLED = profile
+    # Only the main process writes the event stream
+    events.ENABLED = False
+    initial.problem = problem
+    _worker_state = (initial, d_center, shared, batch)
+
+def _run_worker(name, deadline, target_cost, seed):
+    # Runs a configuration, and sends back its best solution (compact) with
+    # the times and the instrumentation counts of the worker
+    initial, d_center, shared, batch = _worker_state
+    instrumentation.reset()
+    anytime, best = run_configuration(
+        name, initial.to_solution(d_center), d_center, deadline,
+        target_cost=target_cost, seed=seed, shared=shared, batch=batch
+        )
+    incumbent = anytime.incumbent
+    result = None
+    if best is not None:
+        result = (best.cost, CompactSolution.from_solution(best),
+                  incumbent.origin, incumbent.time_to_best)
+    return (name, result, anytime.status, incumbent.time_to_target,
+            instrumentation.snapshot())
+
+
+class PortfolioSolver:
+    # Races several configurations (see run_configuration), one per worker
+    # process, until the deadline (a time.time() value). Every worker
+    # publishes the cost of its new best solutions in a SharedIncumbent;
+    # the branch and bound prunes with it. As soon as the best shared cost
+    # reaches target_cost, the branch and bound proves it optimal, or the
+    # deadline passes, the controller tells all the workers to stop, and
+    # each one sends back its best solution. The
+    # winner is the cheapest one, ties going to the one that found it
+    # first (each configuration timing itself from its own start).
+    def __init__(self, solution, d_center, deadline,
+                 configurations=DEFAULT_CONFIGURATIONS, target_cost=None,
+                 seed=None, batch=True, verbose=True):
+        if not configurations:
+            raise ValueError("The portfolio needs a configuration")
+        for name in configurations:
+            if name not in CONFIGURATIONS:
+                raise ValueError(f"Unknown portfolio configuration {name}")
+        self.problem = solution.problem
+        self.initial = CompactSolution.from_solution(solution)
+        self.d_center = d_center
+        self.deadline = deadline
+        self.configurations = list(configurations)
+        self.target_cost = target_cost
+        self.seed = seed
+        self.batch = batch
+        self.verbose = verbose
+        # Filled by solve: per configuration (result, status, time to
+        # target), and the winning configuration
+        self.results = {}
+        self.winner = None
+
+    def reached(self, cost):
+        return self.target_cost is not None and cost <= self.target_cost
+
+    def solve(self):
+        shared = SharedIncumbent()
+        initargs = (self.problem, self.initial, self.d_center, shared,
+                    self.batch, instrumentation.ENABLED)
+        events.flush()
+        with ProcessPoolExecutor(max_workers=len(self.configurations),
+                                 initializer=_init_worker,
+                                 initargs=initargs) as pool:
+            pending = {
+                pool.submit(_run_worker, name, self.deadline,
+                            self.target_cost, self.seed)
+                for name in self.configurations
+                }
+            while pending:
+                # Wakes up often enough to see the target and the deadline
+                done, pending = wait(pending, timeout=0.1,
+                                     return_when=FIRST_COMPLETED)
+                for future in done:
+                    name, result, status, to_target, state = future.result()
+                    instrumentation.merge(state)
+                    self.results[name] = (result, status, to_target)
+                    if status == OPTIMAL:
+                        shared.stop()
+                    if self.verbose:
+                        logger.info("Configuration %s finished (%s), cost %s",
+                                    name, status,
+                                    None if result is None else result[0])
+                if not shared.cancelled() and (
+                        self.reached(shared.cost())
+                        or time.time() >= self.deadline):
+                    if self.verbose:
+                        logger.info("Stopping the portfolio, best cost %s",
+                                    shared.cost())
+                    shared.stop()
+
+        found = [(result[0], result[3], self.configurations.index(name),
+                  name) for name, (result, _, _) in self.results.items()
+                 if result is not None]
+        if not found:
+            return None
+        self.winner = min(found)[3]
+        cost, compact, _, _ = self.results[self.winner][0]
+        if events.ENABLED:
+            events.emit("portfolio", winner=self.winner, cost=cost)
+        compact.problem = self.problem
+        return compact.to_solution(self.d_center)
+
+    def report(self):
+        lines = [f"{'configuration':<14} {'cost':>10} {'best after':>11} "
+                 f"{'target after':>13}  stopped by"]
+        for name in self.configurations:
+            result, status, to_target = self.results.get(
+                name, (None, None, None))
+            cost = "-" if result is None else f"{result[0]:g}"
+            best_after = "-" if result is None else f"{result[3]:.3f}s"
+            target_after = "-" if to_target is None else f"{to_target:.3f}s"
+            lines.append(f"{name:<14} {cost:>10} {best_after:>11} "
+                         f"{target_after:>13}  {status}")
+        if self.winner is None:
+            lines.append("No configuration found a feasible solution")
+        else:
+            result = self.results[self.winner][0]
+            lines.append(f"Winner: {self.winner} ({result[2]})")
+        return "\n".join(lines)
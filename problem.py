@@ -0,0 +1,221 @@
+import math
+import bisect
+
+from spatial import LocationGrid
+
+
+def _distance(a, b):
+    # Same formula as models.distance, kept here to avoid a circular import
+    return math.sqrt(math.pow((a[0] - b[0]), 2) + math.pow((a[1] - b[1]), 2))
+
+
+class CandidateDistances:
+    # Distances between every city and its candidate locations (see
+    # Problem._build_candidates), stored aligned with the candidate lists.
+    # Any other city x location pair, and every location x location pair,
+    # is computed on demand from the coordinates: the solvers never ask for
+    # them in their inner loops, and a full matrix does not scale.
+    def __init__(self, city_coordinates, location_coordinates, candidates,
+                 distances):
+        self.city_coordinates = city_coordinates
+        self.location_coordinates = location_coordinates
+        # Per city, the candidate locations in increasing order and the
+        # distance to each one
+        self.candidates = candidates
+        self.distances = distances
+
+    def city_to_location(self, city_idx, location_idx):
+        candidates = self.candidates[city_idx]
+        i = bisect.bisect_left(candidates, location_idx)
+        if i < len(candidates) and candidates[i] == location_idx:
+            return self.distances[city_idx][i]
+        return _distance(self.city_coordinates[city_idx],
+                         self.location_coordinates[location_idx])
+
+    def location_to_location(self, location_idx, other_idx):
+        return _distance(self.location_coordinates[location_idx],
+                         self.location_coordinates[other_idx])
+
+
+class TypeLadder:
+    # Center types ordered by cost and by capacity, and tables to find the
+    # cheapest type that covers a distance and a load with two bisections.
+    # Distance classes: class k holds the types whose working distance is
+    # at least the k-th smallest one.
+    def __init__(self, types):
+        self.types = list(types)
+        self.by_cost = sorted(self.types, key=lambda t: t.cost)
+        self.by_capacity = sorted(self.types, key=lambda t: t.cap)
+        rank = {id(t): r for r, t in enumerate(self.by_cost)}
+
+        by_working_d = sorted(self.types, key=lambda t: t.working_d)
+        self.working_d = [t.working_d for t in by_working_d]
+        self.working_d_secondary = [3*t.working_d for t in by_working_d]
+        # Per class, the capacities of its types in increasing order and the
+        # cheapest type among those with at least that capacity
+        self.classes = []
+        for k in range(len(by_working_d)):
+            covering = sorted(by_working_d[k:], key=lambda t: t.cap)
+            cheapest = [None] * len(covering)
+            best = None
+            for i in reversed(range(len(covering))):
+                if best is None or rank[id(covering[i])] < rank[id(best)]:
+                    best = covering[i]
+                cheapest[i] = best
+            self.classes.append(([t.cap for t in covering], cheapest))
+
+    def distance_class(self, d, secondary=False):
+        # Class of the types that can serve a city at distance d, None if no
+        # type reaches it
+        working_d = self.working_d_secondary if secondary else self.working_d
+        k = bisect.bisect_left(working_d, d)
+        return k if k < len(working_d) else None
+
+    def reaches(self, t, k):
+        # True if type t serves the cities of distance class k (-1 for no
+        # cities)
+        if k < 0:
+            return True
+        return k < len(self.working_d) and t.working_d >= self.working_d[k]
+
+    def cheapest(self, k, load, above=None):
+        # Cheapest type of class k with capacity for load (and more capacity
+        # than above, if given), None if there is none. k may be one past the
+        # last class, which no type covers.
+        if k >= len(self.classes):
+            return None
+        caps, cheapest = self.classes[k]
+        i = bisect.bisect_left(caps, load)
+        if above is not None:
+            i = max(i, bisect.bisect_right(caps, above))
+        return cheapest[i] if i < len(caps) else None
+
+
+class Problem:
+    # Instance level data shared (never copied) by every solution and solver.
+    # Building a Problem numbers the cities and locations it is given and
+    # attaches itself to the locations. d_center is optional, when given the
+    # conflict counts of rebuilt solutions are kept for it.
+    def __init__(self, cities, centers, types, d_center=None):
+        self._set_instance(cities, centers, types, d_center)
+        self._build_candidates()
+        # d_center conflict graphs, built on demand
+        self._conflicts = {}
+
+    def _set_instance(self, cities, centers, types, d_center):
+        for idx, c in enumerate(cities):
+            c.idx = idx
+        for idx, l in enumerate(centers):
+            l.idx = idx
+            l.problem = self
+
+        self.n_cities = len(cities)
+        self.n_locations = len(centers)
+        self.types = list(types)
+        self.d_center = d_center
+        self.ladder = TypeLadder(self.types)
+        self.populations = [c.population for c in cities]
+        self.city_coordinates = [c.coordinates for c in cities]
+        self.location_coordinates = [l.coordinates for l in centers]
+
+    def precomputed(self):
+        # Everything computed from the instance, to be cached (see
+        # instances.py) and given back to from_precomputed
+        return {
+            "distances_secondary": self.distances.distances,
+            "candidates_primary": self.candidates_primary,
+            "candidates_secondary": self.candidates_secondary,
+            "classes_primary": self.classes_primary,
+            "classes_secondary": self.classes_secondary,
+            "conflicts": dict(self._conflicts),
+            }
+
+    @classmethod
+    def from_precomputed(cls, cities, centers, types, d_center, precomputed):
+        # Builds the problem skipping all the precomputation
+        problem = cls.__new__(cls)
+        problem._set_instance(cities, centers, types, d_center)
+        problem.candidates_primary = precomputed["candidates_primary"]
+        problem.candidates_secondary = precomputed["candidates_secondary"]
+        problem.distances = CandidateDistances(
+            problem.city_coordinates, problem.location_coordinates,
+            problem.candidates_secondary, precomputed["distances_secondary"]
+            )
+        problem.classes_primary = precomputed["classes_primary"]
+        problem.classes_secondary = precomputed["classes_secondary"]
+        problem._conflicts = dict(precomputed["conflicts"])
+        return problem
+
+    def _build_candidates(self):
+        # A location can only serve a city as primary center if it is within
+        # the largest working distance, and as secondary center within three
+        # times that. Candidates are kept in location order so the solvers
+        # break ties the same way as when scanning every location.
+        max_working_d = max([t.working_d for t in self.types], default=0)
+        grid = LocationGrid(self.location_coordinates, 3 * max_working_d)
+        self.candidates_primary = []
+        self.candidates_secondary = []
+        # Distance class (see TypeLadder) of every candidate pair, aligned
+        # with the candidate lists
+        self.classes_primary = []
+        self.classes_secondary = []
+        # Distance of every secondary candidate, the only ones stored (every
+        # primary candidate is a secondary one too)
+        distances_secondary = []
+        for ci, (x, y) in enumerate(self.city_coordinates):
+            primary = []
+            secondary = []
+            classes_primary = []
+            classes_secondary = []
+            distances = []
+            for li in sorted(grid.near(x, y)):
+                d = _distance((x, y), self.location_coordinates[li])
+                if d <= 3 * max_working_d:
+                    secondary.append(li)
+                    distances.append(d)
+                    classes_secondary.append(
+                        self.ladder.distance_class(d, secondary=True))
+                    if d <= max_working_d:
+                        primary.append(li)
+                        classes_primary.append(self.ladder.distance_class(d))
+            self.candidates_primary.append(primary)
+            self.candidates_secondary.append(secondary)
+            self.classes_primary.append(classes_primary)
+            self.classes_secondary.append(classes_secondary)
+            distances_secondary.append(distances)
+        self.distances = CandidateDistances(
+            self.city_coordinates, self.location_coordinates,
+            self.candidates_secondary, distances_secondary
+            )
+
+    def conflicts(self, d_center):
+        # For each location, the other locations closer than d_center. Two
+        # of them can not have an active center at the same time.
+        if d_center not in self._conflicts:
+            grid = LocationGrid(self.location_coordinates, d_center)
+            graph = []
+            for li, (x, y) in enumerate(self.location_coordinates):
+                graph.append(sorted(
+                    lj for lj in grid.near(x, y)
+                    if lj != li and
+                    self.distances.location_to_location(li, lj) < d_center
+                    ))
+            self._conflicts[d_center] = graph
+        return self._conflicts[d_center]
+
+    @classmethod
+    def of(cls, cities, centers, types):
+        # Reuse the problem already attached to the locations, if any
+        if centers:
+            problem = getattr(centers[0], "problem", None)
+            if problem is not None and problem.n_locations == len(centers) \
+                    and problem.n_cities == len(cities):
+                return problem
+        return cls(cities, centers, types)
+
+    def __deepcopy__(self, memo):
+        # Instance data is immutable, all the copies share it
+        return self
+
+    def __copy__(self):
+        return self
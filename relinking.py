@@ -0,0 +1,338 @@
+import heapq
+import logging
+import random
+import time
+
+from deltasearch import DeltaLocalSearchSolver
+from grasp import iteration_rng
+import events
+import instrumentation
+
+logger = logging.getLogger(__name__)
+
+# Share of the 2 * n_cities assignments in which a new elite solution must
+# differ from every other one, unless it is the best so far
+DIVERSITY = 0.02
+
+
+def distance(a, b):
+    # Assignment distance: number of primary and secondary assignments in
+    # which two CompactSolutions differ
+    return sum([x != y for x, y in zip(a.primary, b.primary)]) \
+        + sum([x != y for x, y in zip(a.secondary, b.secondary)])
+
+
+class ElitePool:
+    # The best diverse solutions found, as CompactSolutions sorted by cost.
+    # While the pool is not full any new solution enters. Once it is full a
+    # solution enters if it is better than the worst one and either better
+    # than the best one or at least min_distance away from all of them; it
+    # replaces the most similar of the solutions that are not better than
+    # it. Copies of a member never enter.
+    def __init__(self, size=10, min_distance=1):
+        if size < 1:
+            raise ValueError("The elite pool needs room for a solution")
+        self.size = size
+        self.min_distance = min_distance
+        self.solutions = []
+
+    def __len__(self):
+        return len(self.solutions)
+
+    def best(self):
+        return self.solutions[0] if self.solutions else None
+
+    def add(self, solution):
+        # Returns True if the solution entered the pool
+        distances = [distance(solution, s) for s in self.solutions]
+        if 0 in distances:
+            return False
+        if len(self.solutions) >= self.size:
+            if solution.cost >= self.solutions[-1].cost:
+                return False
+            if solution.cost >= self.solutions[0].cost \
+                    and min(distances) < self.min_distance:
+                return False
+            # Most similar among the ones not better than the new solution
+            worse = [i for i, s in enumerate(self.solutions)
+                     if s.cost >= solution.cost]
+            del self.solutions[min(worse, key=lambda i: distances[i])]
+        self.solutions.append(solution)
+        self.solutions.sort(key=lambda s: s.cost)
+        return True
+
+
+class PathRelinkingSolver(DeltaLocalSearchSolver):
+    # Walks from the initiating solution towards the guide one. Every step
+    # applies the cheapest move that gives a city one of its assignments in
+    # the guide (moving its primary or secondary center, or swapping both
+    # when the guide has them the other way round). Moves must keep the
+    # solution feasible: the target location must be active already, or
+    # not conflict with any active center. The walk stops at the guide or
+    # when no city can make progress.
+    #
+    # The moves are kept in a heap keyed by their delta when evaluated.
+    # Applying a move changes the delta of the moves sharing a location, so
+    # an entry evaluated before the last step is evaluated again when it
+    # reaches the top, and only applied if it is still the cheapest.
+    def __init__(self, solution, guide, d_center, verbose=True):
+        super().__init__(solution, d_center, verbose=verbose)
+        self.guide = guide
+        self.conflicts = self.problem.conflicts(d_center)
+        # Cities still differing from the guide, and for every location the
+        # differing cities whose current or guide assignment is in it
+        self.differing = set()
+        self.involving = [set() for _ in range(self.problem.n_locations)]
+        for ci in range(self.problem.n_cities):
+            self.track(ci)
+
+    def locations(self, ci):
+        return {self.solution.primary[ci], self.solution.secondary[ci],
+                self.guide.primary[ci], self.guide.secondary[ci]}
+
+    def track(self, ci):
+        if self.solution.primary[ci] == self.guide.primary[ci] \
+                and self.solution.secondary[ci] == self.guide.secondary[ci]:
+            return
+        self.differing.add(ci)
+        for li in self.locations(ci):
+            self.involving[li].add(ci)
+
+    def untrack(self, ci):
+        self.differing.discard(ci)
+        for li in self.locations(ci):
+            self.involving[li].discard(ci)
+
+    def openable(self, l2, leaving):
+        # Whether l2 can serve a city leaving location leaving. A closed
+        # location can open if no active center conflicts with it, except
+        # leaving when the city is its last one.
+        if self.active(l2):
+            return True
+        last = len(self.members_primary[leaving]) \
+            + len(self.members_secondary[leaving]) == 1
+        for lj in self.conflicts[l2]:
+            if self.active(lj) and not (lj == leaving and last):
+                return False
+        return True
+
+    def guided_move(self, ci):
+        # Cheapest feasible (delta, move) bringing ci closer to the guide
+        lp, ls = self.solution.primary[ci], self.solution.secondary[ci]
+        gp, gs = self.guide.primary[ci], self.guide.secondary[ci]
+        if lp == gs and ls == gp:
+            delta = self.delta({
+                lp: {"primary_out": (ci,), "secondary_in": (ci,)},
+                ls: {"secondary_out": (ci,), "primary_in": (ci,)},
+                })
+            return None if delta is None else (delta, ("swap_roles", ci))
+
+        best = None
+        if lp != gp and gp != ls and self.openable(gp, lp):
+            delta = self.delta({lp: {"primary_out": (ci,)},
+                                gp: {"primary_in": (ci,)}})
+            if delta is not None:
+                best = (delta, ("reassign_primary", (ci, gp)))
+        if ls != gs and gs != lp and self.openable(gs, ls):
+            delta = self.delta({ls: {"secondary_out": (ci,)},
+                                gs: {"secondary_in": (ci,)}})
+            if delta is not None and (best is None or delta < best[0]):
+                best = (delta, ("reassign_secondary", (ci, gs)))
+        return best
+
+    def relink(self):
+        # Returns the best solution strictly between both ends, or None if
+        # the walk does not get past its first step
+        heap = []
+        # Cities without a feasible move, evaluated again when one of their
+        # locations (or a conflict of it) changes
+        blocked = set()
+        step = 0
+
+        def push(ci):
+            found = self.guided_move(ci)
+            if found is None:
+                blocked.add(ci)
+            else:
+                heapq.heappush(heap, (found[0], ci, step, found[1]))
+
+        for ci in sorted(self.differing):
+            push(ci)
+
+        best = None
+        while heap:
+            delta, ci, evaluated, move = heapq.heappop(heap)
+            if evaluated != step:
+                # Stale entry, evaluate it again before trusting it
+                found = self.guided_move(ci)
+                if found is None:
+                    blocked.add(ci)
+                    continue
+                if heap and found[0] > heap[0][0]:
+                    heapq.heappush(heap, (found[0], ci, step, found[1]))
+                    continue
+                delta, move = found
+
+            touched = self.locations(ci)
+            was_active = {li: self.active(li) for li in touched}
+            self.untrack(ci)
+            self.apply(move)
+            self.track(ci)
+            step += 1
+            if instrumentation.ENABLED:
+                instrumentation.count("relink steps")
+            if not self.differing:
+                # Reached the guide
+                break
+            if best is None or self.solution.cost < best.cost:
+                best = self.solution.copy()
+            if ci in self.differing:
+                push(ci)
+
+            # Opening or closing a location changes which of its conflicts
+            # can open
+            for li, active in was_active.items():
+                if self.active(li) != active:
+                    touched.update(self.conflicts[li])
+            retry = set()
+            for li in touched:
+                retry.update(self.involving[li] & blocked)
+            blocked -= retry
+            for cj in retry:
+                push(cj)
+        return best
+
+
+class GRASPPathRelinking:
+    # GRASP with path relinking (Resende and Ribeiro). Every construction of
+    # grasp (a GRASPSolver or ReactiveGRASPSolver, run serially) is improved
+    # with the delta local search and then relinked with a random elite
+    # solution, starting from the better of both. The local optima and the
+    # improved relinking results feed an ElitePool of pool_size solutions.
+    # After the last iteration every pair of elite solutions is relinked
+    # once more (post-optimization). Returns the best elite solution. The
+    # target cost of grasp stops both phases. Solutions with violations (see
+    # Solution.violations) never enter the pool, so they never guide a
+    # relinking.
+    def __init__(self, grasp, d_center, pool_size=10, min_distance=None,
+                 ls="first", verbose=True):
+        self.grasp = grasp
+        self.problem = grasp.problem
+        self.d_center = d_center
+        self.ls = ls
+        self.verbose = verbose
+        if min_distance is None:
+            min_distance = max(1, int(DIVERSITY * 2 * self.problem.n_cities))
+        self.pool = ElitePool(pool_size, min_distance)
+        self.rng = random.Random(f"{grasp.seed}:relinking") \
+            if grasp.seed is not None else random.Random()
+        self.rejected = 0
+
+    def local_search(self, solution):
+        return DeltaLocalSearchSolver(solution, self.d_center,
+                                      strategy=self.ls,
+                                      verbose=False).search()
+
+    def relink(self, a, b):
+        # Relinks two CompactSolutions from the better one, and returns the
+        # local optimum reached from the best intermediate solution, or None
+        if b.cost < a.cost:
+            a, b = b, a
+        with instrumentation.timer("path relinking"):
+            intermediate = PathRelinkingSolver(a, b, self.d_center,
+                                               verbose=False).relink()
+            if intermediate is None:
+                return None
+            solution = self.local_search(intermediate)
+        if events.ENABLED:
+            events.emit("relink", start=a.cost, guide=b.cost,
+                        intermediate=intermediate.cost, cost=solution.cost)
+        return solution
+
+    def reached(self):
+        # The target cost of grasp, by the best elite solution
+        best = self.pool.best()
+        return best is not None and self.grasp.target_cost is not None \
+            and self.grasp.reached(best.to_solution(self.d_center))
+
+    def offer(self, solution, origin):
+        # Returns True if solution is the new best
+        violations = solution.to_solution(self.d_center).violations(
+            self.d_center)
+        if violations:
+            self.rejected += 1
+            if self.verbose:
+                logger.info("Rejected a solution of cost %s from %s with %s "
+                            "violations", solution.cost, origin,
+                            len(violations))
+            return False
+        best = self.pool.best()
+        if self.pool.add(solution) and self.verbose \
+                and (best is None or solution.cost < best.cost):
+            logger.info("New best elite solution from %s, cost %s",
+                        origin, solution.cost)
+        return best is None or solution.cost < best.cost
+
+    def solve(self):
+        grasp = self.grasp
+        deadline = grasp.deadline()
+        stalled = 0
+        for iter_idx in grasp.iteration_indices():
+            if deadline is not None and time.time() >= deadline:
+                break
+            if grasp.stall is not None and stalled >= grasp.stall:
+                break
+            if self.reached():
+                break
+            alpha = grasp.alpha_for(iter_idx)
+            with instrumentation.timer("grasp construction"):
+                solution = grasp.construct(alpha,
+                                           iteration_rng(grasp.seed, iter_idx))
+            grasp.record(alpha, solution)
+            if events.ENABLED:
+                events.emit("iteration", iteration=iter_idx, alpha=alpha,
+                            cost=None if solution is None else solution.cost)
+            stalled += 1
+            if solution is None:
+                continue
+
+            with instrumentation.timer("grasp local search"):
+                solution = self.local_search(solution)
+            if self.verbose:
+                logger.info("End of iteration %s with alpha %s, cost %s",
+                            iter_idx, alpha, solution.cost)
+            relinked = None
+            if len(self.pool) > 0:
+                relinked = self.relink(
+                    solution, self.rng.choice(self.pool.solutions)
+                    )
+            if self.offer(solution, f"iteration {iter_idx}"):
+                stalled = 0
+            if relinked is not None \
+                    and self.offer(relinked, f"relinking iteration {iter_idx}"):
+                stalled = 0
+
+        # Post-optimization, on the pool as it was at the end of GRASP
+        elite = list(self.pool.solutions)
+        for i, a in enumerate(elite):
+            for b in elite[i + 1:]:
+                if self.reached():
+                    break
+                relinked = self.relink(a, b)
+                if relinked is not None:
+                    self.offer(relinked, "post-optimization")
+
+        best = self.pool.best()
+        if best is None:
+            return None
+        return best.to_solution(self.d_center)
+
+    def report(self):
+        lines = [f"{'elite':>6} {'cost':>10} {'distance to best':>18}"]
+        best = self.pool.best()
+        for i, s in enumerate(self.pool.solutions):
+            lines.append(f"{i:>6} {s.cost:>10} {distance(s, best):>18}")
+        if self.rejected:
+            lines.append(f"Rejected {self.rejected} solutions with "
+                         f"violations")
+        return "\n".join(lines)
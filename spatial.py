@@ -0,0 +1,26 @@
+import math
+
+
+class LocationGrid:
+    # Uniform grid over the location coordinates. With the cell size equal
+    # to the search radius, every location within the radius of a point is
+    # in the 3x3 block of cells around it.
+    def __init__(self, coordinates, cell_size):
+        # Avoid a degenerate grid when all the working distances are 0
+        self.cell_size = cell_size if cell_size > 0 else 1.0
+        self.cells = {}
+        for idx, (x, y) in enumerate(coordinates):
+            self.cells.setdefault(self.cell(x, y), []).append(idx)
+
+    def cell(self, x, y):
+        return (math.floor(x / self.cell_size), math.floor(y / self.cell_size))
+
+    def near(self, x, y):
+        # Indices of the locations in the cells around (x, y). It is a
+        # superset of the locations within cell_size of the point.
+        cx, cy = self.cell(x, y)
+        found = []
+        for i in (cx - 1, cx, cx + 1):
+            for j in (cy - 1, cy, cy + 1):
+                found.extend(self.cells.get((i, j), ()))
+        return found
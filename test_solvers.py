@@ -0,0 +1,395 @@
+import io
+import os
+import shutil
+import time
+
+import pytest
+
+import data
+from anytime import AnytimeSolver
+from branchbound import BranchAndBoundSolver
+from compact import CompactSolution
+from decomposition import DecompositionSolver
+from generator import generate
+from deltasearch import DeltaLocalSearchSolver
+from grasp import GRASPSolver, ParallelGRASPSolver, ReactiveGRASPSolver
+from greedy import GreedySolver, RegretGreedySolver
+from instances import load_instance
+from localsearch import LocalSearchSolver
+from lowerbound import LagrangianBound
+from models import (City, LogisticCenterLocation, LogisticCenterType,
+                    Solution, distance)
+from portfolio import PortfolioSolver
+from problem import Problem
+from relinking import GRASPPathRelinking
+import kernel
+import main
+
+D_CENTER = data.d_center
+# Proved by the branch and bound
+OPTIMUM = 90
+INSTANCE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        "instances", "example.dat")
+
+PROBLEM = Problem(data.cities, data.centers, data.types, D_CENTER)
+
+
+BOXED_IN_D_CENTER = 8.5
+
+def boxed_in():
+    # Two cities and a single type. Opening (3.5, 0) for the first city,
+    # which a random construction may do, closes (10, 1), the only primary
+    # candidate of the second one. The greedy solution costs 60.
+    cities = [City(0, 0, 10), City(10, 0, 10)]
+    centers = [LogisticCenterLocation(x, y)
+               for x, y in ((0, 1), (3.5, 0), (10, 1), (20, 0))]
+    types = [LogisticCenterType(1, 100, 6, 30)]
+    return Solution(cities, centers, types, Problem(cities, centers, types))
+
+def initial():
+    # Empty solution of data.py, the solvers modify the one they are given
+    return Solution(data.cities, data.centers, data.types, PROBLEM)
+
+def greedy(initial=initial, d_center=D_CENTER):
+    return GreedySolver(initial(), d_center).solve()
+
+def grasp(initial=initial, d_center=D_CENTER, **kwargs):
+    return GRASPSolver(initial(), d_center, iterations=10, seed=1,
+                       verbose=False, **kwargs)
+
+
+# Every solver, as a function returning its solution of an instance, given
+# as a function returning an empty solution, its d_center and a target cost
+# (None if unknown)
+SOLVERS = {
+    "greedy": lambda initial, d_center, target: greedy(initial, d_center),
+    "greedy one by one":
+        lambda initial, d_center, target:
+            GreedySolver(initial(), d_center, batch=False).solve(),
+    "regret greedy":
+        lambda initial, d_center, target:
+            RegretGreedySolver(initial(), d_center).solve(),
+    "regret greedy one by one":
+        lambda initial, d_center, target:
+            RegretGreedySolver(initial(), d_center, batch=False).solve(),
+    "local search":
+        lambda initial, d_center, target:
+            LocalSearchSolver(greedy(initial, d_center), d_center).solve(),
+    "delta local search first":
+        lambda initial, d_center, target:
+            DeltaLocalSearchSolver(greedy(initial, d_center), d_center,
+                                   strategy="first", verbose=False).solve(),
+    "delta local search best":
+        lambda initial, d_center, target:
+            DeltaLocalSearchSolver(greedy(initial, d_center), d_center,
+                                   strategy="best", verbose=False).solve(),
+    "grasp":
+        lambda initial, d_center, target: grasp(initial, d_center).solve(),
+    "grasp one by one":
+        lambda initial, d_center, target:
+            grasp(initial, d_center, batch=False).solve(),
+    "reactive grasp":
+        lambda initial, d_center, target:
+            ReactiveGRASPSolver(initial(), d_center, iterations=20, seed=1,
+                                verbose=False).solve(),
+    "parallel grasp":
+        lambda initial, d_center, target:
+            ParallelGRASPSolver(initial(), d_center, iterations=6, seed=1,
+                                workers=2, verbose=False).solve(),
+    "path relinking":
+        lambda initial, d_center, target:
+            GRASPPathRelinking(grasp(initial, d_center), d_center,
+                               pool_size=3, verbose=False).solve(),
+    "branch and bound":
+        lambda initial, d_center, target:
+            BranchAndBoundSolver(initial(), d_center,
+                                 greedy(initial, d_center), time_limit=1,
+                                 verbose=False).solve(),
+    "decomposition":
+        lambda initial, d_center, target:
+            DecompositionSolver(initial(), d_center, tiles=2, workers=1,
+                                verbose=False).solve(),
+    "anytime":
+        lambda initial, d_center, target:
+            AnytimeSolver(initial(), d_center, deadline=time.time() + 5,
+                          grasp=grasp(initial, d_center),
+                          verbose=False).solve(),
+    "portfolio":
+        lambda initial, d_center, target:
+            PortfolioSolver(initial(), d_center, deadline=time.time() + 2,
+                            target_cost=target, seed=1,
+                            verbose=False).solve(),
+    }
+
+
+def generated_instance(n_cities, n_locations, **kwargs):
+    # Function returning empty solutions of a generated instance (nested
+    # types), and its d_center
+    cities, centers, types, d_center = generate(n_cities, n_locations,
+                                                **kwargs)
+    problem = Problem(cities, centers, types, d_center)
+    return lambda: Solution(cities, centers, types, problem), d_center
+
+def generated(n_cities, n_locations, **kwargs):
+    # Empty solution of a generated instance and its d_center
+    initial, d_center = generated_instance(n_cities, n_locations, **kwargs)
+    return initial(), d_center
+
+
+# Small generated instances every solver must solve without violations,
+# by name: (cities, locations, generate arguments). The generator only
+# guarantees a primary candidate, the seeds give feasible instances.
+GENERATED = {
+    "uniform": (60, 16, dict(distribution="uniform", seed=1)),
+    "clustered": (60, 16, dict(distribution="clustered",
+                               populations="pareto", mean_population=20,
+                               seed=2)),
+    "roads": (80, 24, dict(distribution="roads", populations="lognormal",
+                           mean_population=20, n_types=4, seed=2)),
+    }
+
+
+@pytest.mark.parametrize("name", sorted(SOLVERS))
+def test_solution_is_feasible(name):
+    solution = SOLVERS[name](initial, D_CENTER, OPTIMUM)
+    assert solution is not None
+    assert solution.violations(D_CENTER) == []
+    assert solution.cost >= OPTIMUM
+
+
+@pytest.mark.parametrize("instance", sorted(GENERATED))
+@pytest.mark.parametrize("name", sorted(SOLVERS))
+def test_generated_solution_is_feasible(name, instance):
+    n_cities, n_locations, kwargs = GENERATED[instance]
+    initial, d_center = generated_instance(n_cities, n_locations, **kwargs)
+    solution = SOLVERS[name](initial, d_center, None)
+    assert solution is not None
+    assert solution.violations(d_center) == []
+
+
+def test_branch_and_bound_proves_the_optimum():
+    bb = BranchAndBoundSolver(initial(), D_CENTER, greedy(), verbose=False)
+    solution = bb.solve()
+    assert bb.complete
+    assert solution.cost == OPTIMUM
+
+
+def test_lower_bound_is_below_the_optimum():
+    assert LagrangianBound(PROBLEM).solve() <= OPTIMUM
+
+
+@pytest.mark.skipif(kernel.np is None, reason="the kernel needs NumPy")
+def test_kernel_matches_cost_increment():
+    # Same candidates, costs and types as the one by one evaluation, at
+    # every step of a greedy construction
+    solver = GreedySolver(initial(), D_CENTER, batch=True)
+    for c in solver.cities:
+        for primary in (True, False):
+            if primary:
+                candidates = zip(PROBLEM.candidates_primary[c.idx],
+                                 PROBLEM.classes_primary[c.idx])
+            else:
+                candidates = zip(PROBLEM.candidates_secondary[c.idx],
+                                 PROBLEM.classes_secondary[c.idx])
+            expected = []
+            for li, k in candidates:
+                cost, t = solver.cost_increment(c, solver.centers[li],
+                                                primary=primary, k=k)
+                if cost is not None:
+                    expected.append((li, cost, t.tid))
+            batched = [(l.idx, cost, t.tid) for l, cost, t
+                       in solver.candidate_costs(c, primary=primary)]
+            assert batched == expected
+        solver.assign(c)
+
+
+def test_compact_round_trip():
+    solution = greedy()
+    rebuilt = CompactSolution.from_solution(solution).to_solution(D_CENTER)
+    assert rebuilt.cost == solution.cost
+    assert rebuilt.violations(D_CENTER) == []
+    for a, b in zip(solution.cities, rebuilt.cities):
+        assert (a.pc.idx, a.sc.idx) == (b.pc.idx, b.sc.idx)
+
+
+def test_instance_cache_round_trip(tmp_path):
+    path = str(tmp_path / "example.dat")
+    shutil.copy(INSTANCE, path)
+    cache_dir = str(tmp_path / "cache")
+    parsed = load_instance(path, cache_dir=cache_dir)
+    assert os.listdir(cache_dir)
+    cached = load_instance(path, cache_dir=cache_dir)
+
+    for (cities, centers, types, d_center, problem) in (parsed, cached):
+        assert d_center == D_CENTER
+        assert problem.candidates_primary == PROBLEM.candidates_primary
+        assert problem.candidates_secondary == PROBLEM.candidates_secondary
+        assert problem.conflicts(d_center) == PROBLEM.conflicts(D_CENTER)
+        solution = GreedySolver(Solution(cities, centers, types, problem),
+                                d_center).solve()
+        assert solution.violations(d_center) == []
+
+
+def test_secondary_load_round_trip():
+    l = LogisticCenterLocation(0, 0, data.types[0])
+    primary, secondary = City(1, 0, 50), City(2, 0, 30)
+    l.assign_city_primary(primary)
+    before = l.curr_load
+    expected = l.next_load_with_city_secondary(secondary)
+    l.assign_city_secondary(secondary)
+    assert l.curr_load == pytest.approx(expected)
+    assert l.next_load_without_city_secondary(secondary) \
+        == pytest.approx(before)
+    l.remove_city_secondary(secondary)
+    assert l.curr_load == pytest.approx(before)
+
+
+def test_distances_match_the_coordinates():
+    # Stored for the candidate pairs, computed for the rest
+    for c in data.cities:
+        for l in data.centers:
+            assert PROBLEM.distances.city_to_location(c.idx, l.idx) \
+                == pytest.approx(distance(c.coordinates, l.coordinates))
+    for l in data.centers:
+        for l2 in data.centers:
+            assert PROBLEM.distances.location_to_location(l.idx, l2.idx) \
+                == pytest.approx(distance(l.coordinates, l2.coordinates))
+
+
+@pytest.mark.parametrize("solver", [GRASPSolver, ParallelGRASPSolver])
+def test_grasp_skips_boxed_in_constructions(solver):
+    kwargs = {"workers": 2} if solver is ParallelGRASPSolver else {}
+    grasp = solver(boxed_in(), BOXED_IN_D_CENTER, iterations=10, alphas=[1],
+                   seed=1, verbose=False, **kwargs)
+    solution = grasp.solve()
+    assert solution.violations(BOXED_IN_D_CENTER) == []
+    assert solution.cost == 60
+
+
+def test_anytime_keeps_the_incumbent_when_grasp_boxes_a_city_in():
+    grasp = GRASPSolver(boxed_in(), BOXED_IN_D_CENTER, iterations=10,
+                        alphas=[1], seed=1, verbose=False)
+    anytime = AnytimeSolver(boxed_in(), BOXED_IN_D_CENTER,
+                            deadline=time.time() + 5, grasp=grasp,
+                            verbose=False)
+    solution = anytime.solve()
+    assert solution.violations(BOXED_IN_D_CENTER) == []
+    assert solution.cost == 60
+
+
+@pytest.mark.parametrize("distribution, seed", [("clustered", 3),
+                                                ("roads", 1)])
+def test_local_search_keeps_the_downgraded_centers_in_range(distribution,
+                                                            seed):
+    # Downgrades that used to shrink the range below a served city
+    initial_solution, d_center = generated(300, 300,
+                                           distribution=distribution,
+                                           seed=seed)
+    solution = GreedySolver(initial_solution, d_center).solve()
+    solution = LocalSearchSolver(solution, d_center).solve()
+    assert solution.violations(d_center) == []
+
+
+@pytest.mark.parametrize("strategy", ["first", "best"])
+def test_delta_local_search_leaves_unassigned_cities_alone(strategy):
+    # Partial solution, as the decomposition builds them
+    initial_solution, d_center = generated(100, 20, seed=3)
+    problem = initial_solution.problem
+    populations = problem.populations
+    compact = CompactSolution.from_solution(
+        GreedySolver(initial_solution, d_center).solve())
+    unassigned = range(0, problem.n_cities, 7)
+    for ci in unassigned:
+        compact.population_primary[compact.primary[ci]] -= populations[ci]
+        compact.population_secondary[compact.secondary[ci]] -= \
+            populations[ci]
+        compact.primary[ci] = compact.secondary[ci] = -1
+    result = DeltaLocalSearchSolver(compact, d_center, strategy=strategy,
+                                    verbose=False).search()
+    for ci in unassigned:
+        assert (result.primary[ci], result.secondary[ci]) == (-1, -1)
+    for li in range(problem.n_locations):
+        assert result.population_primary[li] == pytest.approx(sum(
+            populations[ci] for ci in range(problem.n_cities)
+            if result.primary[ci] == li))
+        assert result.population_secondary[li] == pytest.approx(sum(
+            populations[ci] for ci in range(problem.n_cities)
+            if result.secondary[ci] == li))
+
+
+def test_decomposition_undo_restores_the_center_type():
+    # The second city only has (0, 0) as a secondary candidate. The greedy
+    # upgrades (0, 0) to serve it as a primary city, then finds no
+    # secondary center left.
+    cities = [City(0, 1, 8), City(-1.5, 0, 5)]
+    centers = [LogisticCenterLocation(0, 0), LogisticCenterLocation(5, 0)]
+    types = [LogisticCenterType(1, 10, 2, 10), LogisticCenterType(2, 30, 2, 30)]
+    d_center = 1
+    initial_solution = Solution(cities, centers, types,
+                                Problem(cities, centers, types, d_center))
+    ds = DecompositionSolver(initial_solution, d_center, tiles=1, workers=1,
+                             verbose=False)
+    greedy = GreedySolver(initial_solution, d_center)
+    greedy.assign(initial_solution.cities[0])
+    assert ds.assign(greedy, initial_solution, [1]) == [1]
+    c = initial_solution.cities[1]
+    assert c.pc is None and c.sc is None
+    assert initial_solution.centers[0].t.tid == 1
+    assert initial_solution.cost == 20
+    # --solution reports the city instead of failing
+    out = io.StringIO()
+    initial_solution.write(out)
+    assert "\tPrimary center: unassigned\n" in out.getvalue()
+
+
+@pytest.mark.parametrize("distribution", ["uniform", "clustered", "roads"])
+def test_generated_cities_are_covered(distribution):
+    cities, centers, types, d_center = generate(
+        500, 10, distribution=distribution, seed=2)
+    cover_d = min(t.working_d for t in types) - d_center
+    for c in cities:
+        assert any(distance(c.coordinates, l.coordinates) <= cover_d
+                   for l in centers)
+    assert len({l.coordinates for l in centers}) == len(centers)
+
+
+def test_decomposition_repair_keeps_a_center_loaded_to_its_cap():
+    # (0, 5) serves both cities as secondary with a load of exactly 3,
+    # which adding 0.1 * population city by city puts over the cap
+    cities = [City(0, 0, 1), City(0.5, 0, 29)]
+    centers = [LogisticCenterLocation(0, 5), LogisticCenterLocation(0.25, 0)]
+    types = [LogisticCenterType(1, 3, 10, 10), LogisticCenterType(2, 300, 1, 20)]
+    d_center = 1
+    initial_solution = Solution(cities, centers, types,
+                                Problem(cities, centers, types, d_center))
+    ds = DecompositionSolver(initial_solution, d_center, tiles=1, workers=1,
+                             verbose=False)
+    primary, secondary = [1, 1], [0, 0]
+    assert ds.repair(primary, secondary) == []
+    assert (primary, secondary) == ([1, 1], [0, 0])
+
+
+def test_decomposition_splits_a_generated_instance():
+    # The default overlap is wider than the cells of a 3 x 3 grid
+    initial_solution, d_center = generated(1000, 200,
+                                           distribution="clustered", seed=1)
+    ds = DecompositionSolver(initial_solution, d_center, tiles=3, workers=1,
+                             verbose=False)
+    tiles, owner = ds.grid()
+    assert len(tiles) > 1
+    assert sorted(ci for tile in tiles for ci in tile.cities) == \
+        list(range(len(owner)))
+
+
+@pytest.mark.parametrize("kwargs", [dict(), dict(workers=2), dict(elite=2),
+                                    dict(reactive=True, iterations=4)])
+def test_run_grasp_reports_when_every_construction_fails(kwargs, capsys):
+    # A single location can not be both centers of the city
+    cities = [City(0, 0, 1)]
+    centers = [LogisticCenterLocation(0, 1)]
+    types = [LogisticCenterType(1, 10, 2, 10)]
+    initial_solution = Solution(cities, centers, types,
+                                Problem(cities, centers, types, main.d_center))
+    kwargs.setdefault("iterations", 3)
+    assert main.run_grasp(initial_solution, seed=1, **kwargs) is None
+    assert "GRASP: no feasible solution" in capsys.readouterr().out